@@ -10,7 +10,13 @@ import io
 import os
 import json
 import calendar
-import pyodbc
+import openpyxl
+from openpyxl.cell.cell import ERROR_CODES
+import csv
+import codecs
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 # --- PARAMETRY POŁĄCZENIA NEXO ---
 # Wklej to pod importami
@@ -71,6 +77,15 @@ st.markdown("""
 # --- PARAMETRY TABELI ---
 NAZWA_TABELI = "transactions"
 NAZWA_TABELI_PLIKOW = "saved_files"
+NAZWA_TABELI_REJESTRU = "ingest_ledger"
+# Status wpisu w rejestrze: W_TOKU przed pierwszą paczką, ZAPISANY po ostatniej
+STATUS_PLIKU_W_TOKU = "W_TOKU"
+STATUS_PLIKU_ZAPISANY = "ZAPISANY"
+NAZWA_TABELI_KART = "fuel_cards"
+NAZWA_TABELI_MIGRACJI = "schema_migrations"
+NAZWA_TABELI_MIESIECZNEJ = "transactions_monthly"
+NAZWA_TABELI_DZIENNEJ = "transactions_daily"
+NAZWA_TABELI_ZAKRESU = "transactions_extent"
 NAZWA_SCHEMATU = "public"
 NAZWA_POLACZENIA_DB = "db"
 
@@ -467,83 +482,492 @@ def pobierz_przypisania_webfleet(account, username, password, data_start, data_s
     # Jeśli nic nie znaleziono lub wystąpił błąd
     return pd.DataFrame()
 # --- KATEGORYZACJA TRANSAKCJI ---
-def kategoryzuj_transakcje(row, zrodlo):
-    usluga = ""
-    artykul = ""
-    full_text = ""
-
-    if zrodlo == 'Eurowag':
-        usluga = str(row.get('Usługa', '')).upper()
-        artykul = str(row.get('Artykuł', '')).strip().upper()
-        produkt = str(row.get('Produkt', '')).strip().upper() if 'Produkt' in row else ""
-        full_text = (usluga + " " + artykul + " " + produkt).upper()
-        
-    elif zrodlo == 'E100_PL':
-        usluga = str(row.get('Usługa', '')).strip().upper()
-        kategoria = str(row.get('Kategoria', '')).strip().upper()
-        brand = str(row.get('Brand', '')).strip().upper() 
-        full_text = (usluga + " " + kategoria + " " + brand).upper()
-        artykul = kategoria if kategoria else usluga
-
-    elif zrodlo == 'E100_EN':
-        usluga = str(row.get('Service', '')).strip().upper()
-        artykul = str(row.get('Category', '')).strip().upper()
-        full_text = (usluga + " " + artykul).upper()
-        
-    elif zrodlo == 'Fakturownia':
-        full_text = str(row.get('Produkt/usługa', '')).upper()
-        return 'PRZYCHÓD', 'Usługa transportowa' 
-    else:
-        full_text = ""
+# Kolumny tekstowe per źródło: (nazwa kolumny, czy .strip()). Pierwsza kolumna to "usługa".
+KOLUMNY_KATEGORYZACJI = {
+    'Eurowag': (('Usługa', False), ('Artykuł', True), ('Produkt', True)),
+    'E100_PL': (('Usługa', True), ('Kategoria', True), ('Brand', True)),
+    'E100_EN': (('Service', True), ('Category', True)),
+}
 
-    if 'TOLL' in full_text or 'OPŁATA DROGOWA' in full_text or 'VIATOLL' in full_text or 'E-TOLL' in full_text or 'DROGOWE' in full_text:
-        return 'OPŁATA', usluga if usluga else 'Opłata drogowa'
+def skompiluj_wzorzec(frazy):
+    return re.compile('|'.join(re.escape(f) for f in frazy))
+
+# Reguły sprawdzane po kolei - pierwsza pasująca wygrywa. Produkt None = nazwa usługi.
+REGULY_KATEGORII = [
+    (skompiluj_wzorzec(['TOLL', 'OPŁATA DROGOWA', 'VIATOLL', 'E-TOLL', 'DROGOWE']), 'OPŁATA', None),
+    (skompiluj_wzorzec(['LPG', 'AUTOGAZ', 'GAZ PŁYNNY', 'GPL', 'PROPANE', 'BUTANE']), 'PALIWO', 'LPG'),
+    (skompiluj_wzorzec(['BENZYNA', 'GASOLINE', 'PETROL', 'MOGAS', 'EUROSUPER', 'SUPER 95', 'SUPER 98',
+                        'NATURAL 95', 'UNLEADED', 'PB95', 'PB98', ' E5 ', ' E10 ', 'PB ', ' PB']), 'PALIWO', 'Benzyna'),
+    (skompiluj_wzorzec(['ADBLUE', 'AD BLUE']), 'PALIWO', 'AdBlue'),
+    (skompiluj_wzorzec(['DIESEL', 'OLEJ NAPĘDOWY']), 'PALIWO', 'Diesel'),
+    (re.compile(r'(?:^| )ON(?: |$)'), 'PALIWO', 'Diesel'),
+    (skompiluj_wzorzec(['OPENLOOP', 'VISA', 'MYJNIA', 'WASH', 'PARKING']), 'INNE', 'Płatność kartą/Inne'),
+    (skompiluj_wzorzec(['POWER MAX', 'ECTO']), 'PALIWO', 'Diesel'),
+]
 
-    if any(keyword in full_text for keyword in ['LPG', 'AUTOGAZ', 'GAZ PŁYNNY', 'GPL', 'PROPANE', 'BUTANE']):
-        return 'PALIWO', 'LPG'
+def kategoryzuj_tekst(full_text, usluga):
+    for wzorzec, typ, produkt in REGULY_KATEGORII:
+        if wzorzec.search(full_text):
+            if produkt is None:
+                return typ, usluga if usluga else 'Opłata drogowa'
+            return typ, produkt
+    return 'INNE', usluga.title() if usluga else "Inne"
 
-    benzyna_keywords = ['BENZYNA', 'GASOLINE', 'PETROL', 'MOGAS', 'EUROSUPER', 'SUPER 95', 'SUPER 98', 'NATURAL 95', 'UNLEADED', 'PB95', 'PB98', ' E5 ', ' E10 ']
-    if any(keyword in full_text for keyword in benzyna_keywords):
-        return 'PALIWO', 'Benzyna'
-        
-    if 'PB ' in full_text or ' PB' in full_text:
-        return 'PALIWO', 'Benzyna'
+def normalizuj_pole_tekstowe(wartosc, strip):
+    tekst = str(wartosc)
+    if strip: tekst = tekst.strip()
+    return tekst.upper()
 
-    if 'ADBLUE' in full_text or 'AD BLUE' in full_text:
-        return 'PALIWO', 'AdBlue'
+def kategoryzuj_transakcje(row, zrodlo):
+    if zrodlo == 'Fakturownia':
+        return 'PRZYCHÓD', 'Usługa transportowa'
 
-    if 'DIESEL' in full_text or 'OLEJ NAPĘDOWY' in full_text:
-        return 'PALIWO', 'Diesel'
-    
-    if ' ON ' in (" " + full_text + " "): 
-        return 'PALIWO', 'Diesel'
+    czesci = [normalizuj_pole_tekstowe(row.get(kol, ''), strip) for kol, strip in KOLUMNY_KATEGORYZACJI.get(zrodlo, ())]
+    usluga = czesci[0] if czesci else ""
+    return kategoryzuj_tekst(" ".join(czesci), usluga)
 
-    if 'OPENLOOP' in full_text or 'VISA' in full_text or 'MYJNIA' in full_text or 'WASH' in full_text or 'PARKING' in full_text:
-        return 'INNE', 'Płatność kartą/Inne'
-        
-    if 'POWER MAX' in full_text or 'ECTO' in full_text:
-        return 'PALIWO', 'Diesel'
+def kategoryzuj_ramke(df, zrodlo):
+    """
+    Wektorowa wersja kategoryzuj_transakcje: reguły liczone raz na unikalny
+    zestaw tekstów (usługa/artykuł/...), wynik rozkładany z powrotem na wiersze.
+    Zwraca (typ, produkt) jako Series z indeksem df.
+    """
+    if zrodlo not in KOLUMNY_KATEGORYZACJI or df.empty:
+        typ, produkt = kategoryzuj_transakcje({}, zrodlo)
+        return pd.Series(typ, index=df.index, dtype=object), pd.Series(produkt, index=df.index, dtype=object)
+
+    kody_kolumn = []
+    teksty_kolumn = []
+    for kol, strip in KOLUMNY_KATEGORYZACJI.get(zrodlo, ()):
+        if kol in df.columns:
+            wartosci = df[kol].to_numpy(dtype=object)
+            braki = pd.isna(wartosci)
+            if braki.any():
+                # None/NaN/NaT dają różne teksty ('None'/'nan'), więc nie mogą wpaść do jednego koszyka
+                wartosci = wartosci.copy()
+                wartosci[braki] = [str(v) for v in wartosci[braki]]
+            kody, unikalne = pd.factorize(wartosci)
+            teksty = [normalizuj_pole_tekstowe(v, strip) for v in unikalne]
+        else:
+            kody, teksty = np.zeros(len(df), dtype=np.intp), ['']
+        kody_kolumn.append(kody)
+        teksty_kolumn.append(teksty)
 
-    return 'INNE', usluga.title() if usluga else "Inne"
+    kombinacje, odwrotne = np.unique(np.column_stack(kody_kolumn), axis=0, return_inverse=True)
+    wyniki = []
+    for kombinacja in kombinacje:
+        czesci = [teksty_kolumn[i][k] for i, k in enumerate(kombinacja)]
+        wyniki.append(kategoryzuj_tekst(" ".join(czesci), czesci[0]))
+
+    odwrotne = np.asarray(odwrotne).reshape(-1)
+    typy = np.array([w[0] for w in wyniki], dtype=object)[odwrotne]
+    produkty = np.array([w[1] for w in wyniki], dtype=object)[odwrotne]
+    return pd.Series(typy, index=df.index), pd.Series(produkty, index=df.index)
     
+# --- CZYTNIK EXCELA (READ-ONLY) ---
+# Teksty, które pd.read_excel zamienia na NaN (domyślne na_values) + kody błędów komórek
+WARTOSCI_NA_EXCELA = frozenset([
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+]) | frozenset(ERROR_CODES)
+
+def wartosc_komorki(wartosc):
+    # Jak w pandas: liczba całkowita zapisana jako float -> int, teksty NA i błędy -> brak
+    if isinstance(wartosc, float) and wartosc.is_integer():
+        return int(wartosc)
+    if isinstance(wartosc, str) and wartosc in WARTOSCI_NA_EXCELA:
+        return None
+    return wartosc
+
+def kolumna_z_wartosci(wartosci):
+    """Typ kolumny ustalany raz dla całej kolumny: liczby (też z tekstu), daty, w pozostałych przypadkach object/str."""
+    tablica = np.empty(len(wartosci), dtype=object)
+    tablica[:] = wartosci
+    try:
+        return pd.Series(pd.to_numeric(tablica))
+    except (ValueError, TypeError):
+        kolumna = pd.Series(tablica).infer_objects()
+    if kolumna.dtype == object:
+        # Braki w kolumnie object jako NaN, tak jak zwraca je read_excel
+        kolumna = kolumna.where(kolumna.notna(), np.nan)
+    return kolumna
+
+def ramka_z_kolumn(kolumny, nazwy):
+    df = pd.DataFrame({i: kolumna_z_wartosci(wartosci) for i, wartosci in enumerate(kolumny)})
+    df.columns = nazwy
+    return df
+
+def naglowek_wielopoziomowy(wiersze_naglowka, szerokosc):
+    # Puste komórki nagłówka (scalone) uzupełniane w prawo w obrębie rodzica, jak fill_mi_header w pandas
+    poziomy = []
+    kontrolny = [True] * szerokosc
+    for poziom, wiersz in enumerate(wiersze_naglowka):
+        wiersz = list(wiersz) + [None] * (szerokosc - len(wiersz))
+        ostatnia = wiersz[0]
+        for i in range(1, szerokosc):
+            if not kontrolny[i]:
+                ostatnia = wiersz[i]
+            if wiersz[i] is None or wiersz[i] == '':
+                wiersz[i] = ostatnia
+            else:
+                kontrolny[i] = False
+                ostatnia = wiersz[i]
+        poziomy.append([f"Unnamed: {i}_level_{poziom}" if w is None or w == '' else w for i, w in enumerate(wiersz)])
+    return poziomy
+
+def nazwy_arkuszy(plik):
+    if isinstance(plik, (bytes, bytearray)):
+        plik = io.BytesIO(plik)
+    plik.seek(0)
+    if not czy_plik_excel(plik.read(4)):
+        plik.seek(0)
+        return pd.ExcelFile(plik).sheet_names
+    plik.seek(0)
+    wb = openpyxl.load_workbook(plik, read_only=True, data_only=True)
+    try:
+        return wb.sheetnames
+    finally:
+        wb.close()
+
+def wczytaj_arkusz(plik, arkusz=0, header=0, usecols=None):
+    """
+    Zamiennik pd.read_excel(engine='openpyxl') dla .xlsx: wiersze z iter_rows(values_only=True)
+    trafiają od razu do list kolumn (bez obiektów komórek i parsera tekstowego pandas), a typ każdej
+    kolumny jest ustalany raz na końcu. header: None, numer wiersza lub lista wierszy (MultiIndex);
+    usecols: lista pozycji kolumn. Stare pliki .xls idą przez pd.read_excel.
+    """
+    if isinstance(plik, (bytes, bytearray)):
+        plik = io.BytesIO(plik)
+    plik.seek(0)
+    if not czy_plik_excel(plik.read(4)):
+        plik.seek(0)
+        return pd.read_excel(plik, sheet_name=arkusz, header=header, usecols=usecols)
+    plik.seek(0)
+
+    if header is None:
+        wiersze_naglowka_nr = []
+    elif isinstance(header, int):
+        wiersze_naglowka_nr = [header]
+    else:
+        wiersze_naglowka_nr = list(header)
+    pierwszy_wiersz_danych = max(wiersze_naglowka_nr) + 1 if wiersze_naglowka_nr else 0
+
+    wb = openpyxl.load_workbook(plik, read_only=True, data_only=True)
+    try:
+        ws = wb[arkusz] if isinstance(arkusz, str) else wb.worksheets[arkusz]
+        ws.reset_dimensions()
+        wiersze_naglowka = []
+        kolumny = [[] for _ in usecols] if usecols is not None else []
+        liczba_wierszy = 0
+        puste_wiersze = 0
+        szerokosc = 0
+        for nr, wiersz in enumerate(ws.iter_rows(values_only=True)):
+            dlugosc = len(wiersz)
+            while dlugosc and (wiersz[dlugosc - 1] is None or wiersz[dlugosc - 1] == ''):
+                dlugosc -= 1
+            szerokosc = max(szerokosc, dlugosc)
+            if nr < pierwszy_wiersz_danych:
+                if nr in wiersze_naglowka_nr:
+                    wiersze_naglowka.append([None if v == '' else int(v) if isinstance(v, float) and v.is_integer() else v
+                                             for v in wiersz[:dlugosc]])
+                continue
+            if not dlugosc:
+                # Puste wiersze w środku zostają (jak w read_excel), końcowe są odcinane
+                puste_wiersze += 1
+                continue
+            if puste_wiersze:
+                for kolumna in kolumny:
+                    kolumna.extend([None] * puste_wiersze)
+                liczba_wierszy += puste_wiersze
+                puste_wiersze = 0
+
+            if usecols is not None:
+                for kolumna, i in zip(kolumny, usecols):
+                    kolumna.append(wartosc_komorki(wiersz[i]) if i < dlugosc else None)
+            else:
+                while len(kolumny) < dlugosc:
+                    kolumny.append([None] * liczba_wierszy)
+                for i, kolumna in enumerate(kolumny):
+                    kolumna.append(wartosc_komorki(wiersz[i]) if i < dlugosc else None)
+            liczba_wierszy += 1
+    finally:
+        wb.close()
+
+    if usecols is None:
+        while len(kolumny) < szerokosc:
+            kolumny.append([None] * liczba_wierszy)
+        pozycje = list(range(szerokosc))
+    else:
+        pozycje = [i for i in usecols if i < szerokosc]
+        kolumny = [kolumna for kolumna, i in zip(kolumny, usecols) if i < szerokosc]
+
+    if header is None:
+        nazwy = pozycje
+    elif len(wiersze_naglowka_nr) == 1:
+        wiersz = (wiersze_naglowka[0] if wiersze_naglowka else [])
+        wszystkie = nazwy_kolumn_naglowka(wiersz + [None] * (szerokosc - len(wiersz)))
+        nazwy = [wszystkie[i] for i in pozycje]
+    else:
+        poziomy = naglowek_wielopoziomowy(wiersze_naglowka, szerokosc)
+        nazwy = pd.MultiIndex.from_arrays([[poziom[i] for i in pozycje] for poziom in poziomy])
+    return ramka_z_kolumn(kolumny, nazwy)
+
+# --- SCHEMATY ŹRÓDEŁ ---
+# Per format: potrzebne kolumny, kolumny daty (łączone spacją) i jej format, kolumny liczbowe,
+# separator dziesiętny, kolumna numeru karty (rejestr kart), kolumny czytane jako tekst i pola bazy zasilane przez kolumny
+# (podgląd). Czytniki ładują tylko te kolumny.
+# 'format_daty_scisly': False = wartości niepasujące do formatu parsowane jeszcze bez formatu.
+DODATKOWE_KOLUMNY_FAKTUROWNI = ('Uwagi', 'Nr zamówienia', 'Opis', 'Dodatkowe pole na pozycjach faktury',
+                                'Kraj', 'Wartość netto', 'Wartość brutto')
+
+def mapuj_kolumne_fakturowni(nazwa):
+    c_lower = str(nazwa).lower().strip()
+    if 'cena' in c_lower and 'netto' in c_lower and 'pln' not in c_lower:
+        return 'Cena netto'
+    elif 'cena' in c_lower and 'brutto' in c_lower and 'pln' not in c_lower:
+        return 'Cena brutto'
+    elif 'ilość' in c_lower or 'ilosc' in c_lower:
+        return 'Ilość'
+    elif 'sprzedaj' in c_lower and 'nip' not in c_lower:
+        return 'Sprzedający'
+    elif 'nip' in c_lower and 'sprzed' in c_lower:
+        return 'NIP sprzedającego'
+    elif 'nabywca' in c_lower and 'nip' not in c_lower:
+        return 'Nabywca'
+    elif 'data wyst' in c_lower:
+        return 'Data wystawienia'
+    elif 'produkt' in c_lower or 'usługa' in c_lower:
+        return 'Produkt/usługa'
+    elif 'waluta' in c_lower:
+        return 'Waluta'
+    return None
+
+SCHEMATY_ZRODEL = {
+    'Eurowag': {
+        'kolumny': ('Data i godzina', 'Tablica rejestracyjna', 'Posiadacz karty', 'Karta', 'Kwota netto', 'Kwota brutto',
+                    'Waluta', 'Ilość', 'Kraj', 'Usługa', 'Artykuł', 'Produkt'),
+        'kolumny_daty': ('Data i godzina',),
+        'format_daty': '%Y-%m-%d %H:%M:%S',
+        'format_daty_scisly': False,
+        'liczby': ('Kwota netto', 'Kwota brutto', 'Ilość'),
+        'separator_dziesietny': '.',
+        'kolumna_karty': 'Karta',
+        'teksty': (),
+        'pola': {
+            'Data i godzina': 'data_transakcji', 'Tablica rejestracyjna': 'identyfikator',
+            'Posiadacz karty': 'identyfikator (gdy brak tablicy)', 'Karta': 'identyfikator (gdy brak posiadacza)',
+            'Kwota netto': 'kwota_netto', 'Kwota brutto': 'kwota_brutto', 'Waluta': 'waluta', 'Ilość': 'ilosc',
+            'Kraj': 'kraj', 'Usługa': 'typ / produkt', 'Artykuł': 'typ / produkt', 'Produkt': 'typ / produkt',
+        },
+    },
+    'E100_PL': {
+        'kolumny': ('Data', 'Czas', 'Numer samochodu', 'Numer karty', 'Kwota', 'Kraj', 'Waluta', 'Ilość',
+                    'Usługa', 'Kategoria', 'Brand'),
+        'kolumny_daty': ('Data', 'Czas'),
+        'format_daty': '%d.%m.%Y %H:%M:%S',
+        'format_daty_scisly': True,
+        'liczby': ('Kwota', 'Ilość'),
+        'separator_dziesietny': '.',
+        'kolumna_karty': 'Numer karty',
+        'teksty': (),
+        'pola': {
+            'Data': 'data_transakcji', 'Czas': 'data_transakcji', 'Numer samochodu': 'identyfikator',
+            'Numer karty': 'identyfikator (gdy brak numeru auta)', 'Kwota': 'kwota_brutto (netto wg VAT kraju)',
+            'Kraj': 'kraj', 'Waluta': 'waluta', 'Ilość': 'ilosc',
+            'Usługa': 'typ / produkt', 'Kategoria': 'typ / produkt', 'Brand': 'typ / produkt',
+        },
+    },
+    'E100_EN': {
+        'kolumny': ('Date', 'Time', 'Car registration number', 'Card number', 'Sum', 'Country', 'Currency', 'Quantity',
+                    'Service', 'Category'),
+        'kolumny_daty': ('Date', 'Time'),
+        'format_daty': '%d.%m.%Y %H:%M:%S',
+        'format_daty_scisly': True,
+        'liczby': ('Sum', 'Quantity'),
+        'separator_dziesietny': '.',
+        'kolumna_karty': 'Card number',
+        'teksty': (),
+        'pola': {
+            'Date': 'data_transakcji', 'Time': 'data_transakcji', 'Car registration number': 'identyfikator',
+            'Card number': 'identyfikator (gdy brak numeru auta)', 'Sum': 'kwota_brutto (netto wg VAT kraju)',
+            'Country': 'kraj', 'Currency': 'waluta', 'Quantity': 'ilosc', 'Service': 'typ / produkt', 'Category': 'typ / produkt',
+        },
+    },
+    'Fakturownia': {
+        # Nazwy kolumn różnią się między eksportami - dopasowanie jak w normalizuj_fakturownia
+        'kolumny': lambda nazwa: mapuj_kolumne_fakturowni(nazwa) is not None or nazwa in DODATKOWE_KOLUMNY_FAKTUROWNI,
+        'kolumny_daty': ('Data wystawienia',),
+        'format_daty': '%Y-%m-%d',
+        'format_daty_scisly': False,
+        'liczby': ('Cena netto', 'Cena brutto', 'Ilość', 'Wartość netto', 'Wartość brutto'),
+        'separator_dziesietny': ',',
+        'teksty': DODATKOWE_KOLUMNY_FAKTUROWNI[:4],
+        # Klucze po ujednoliceniu nazw (mapuj_kolumne_fakturowni)
+        'pola': {
+            'Data wystawienia': 'data_transakcji', 'Nabywca': 'kontrahent', 'Cena netto': 'kwota_netto (× Ilość)',
+            'Cena brutto': 'kwota_brutto (× Ilość)', 'Ilość': 'mnożnik kwot', 'Waluta': 'waluta', 'Kraj': 'kraj',
+            'Produkt/usługa': 'identyfikator (nr rej. w opisie)', 'Uwagi': 'identyfikator (nr rej. w opisie)',
+            'Nr zamówienia': 'identyfikator (nr rej. w opisie)', 'Opis': 'identyfikator (nr rej. w opisie)',
+            'Dodatkowe pole na pozycjach faktury': 'identyfikator (nr rej. w opisie)',
+            'Wartość netto': 'kwota_netto (gdy brak cen)', 'Wartość brutto': 'kwota_brutto (gdy brak cen)',
+        },
+    },
+    'Subiekt': {
+        'arkusz': 'pojazdy',
+        'naglowek': [7, 8],
+    },
+}
+
+def czy_kolumna_schematu(schemat, nazwa):
+    kolumny = schemat['kolumny']
+    return kolumny(nazwa) if callable(kolumny) else nazwa in kolumny
+
+def indeksy_kolumn_schematu(format_pliku, kolumny):
+    """Pozycje potrzebnych kolumn w nagłówku pliku (None = czytaj wszystko)."""
+    schemat = SCHEMATY_ZRODEL.get(format_pliku)
+    if not schemat or 'kolumny' not in schemat or not kolumny:
+        return None
+    return [i for i, nazwa in enumerate(kolumny) if czy_kolumna_schematu(schemat, nazwa)]
+
+def wczytaj_arkusz_subiekta(plik, waluty):
+    """
+    Arkusz 'pojazdy' z analizy Subiekta: kolumna etykiet + kolumny walut z `waluty`.
+    Waluta stoi w scalonej komórce pierwszego wiersza nagłówka, więc bierzemy całe grupy kolumn.
+    """
+    schemat = SCHEMATY_ZRODEL['Subiekt']
+    if isinstance(plik, (bytes, bytearray)):
+        plik = io.BytesIO(plik)
+    usecols = None
+    try:
+        wb = openpyxl.load_workbook(plik, read_only=True, data_only=True)
+        try:
+            wiersz_walut = schemat['naglowek'][0] + 1
+            naglowek = next(wb[schemat['arkusz']].iter_rows(min_row=wiersz_walut, max_row=wiersz_walut, values_only=True), ())
+        finally:
+            wb.close()
+        usecols = [0]
+        aktualna_waluta = None
+        for i, wartosc in enumerate(naglowek[1:], start=1):
+            if wartosc is not None:
+                aktualna_waluta = wartosc
+            if aktualna_waluta in waluty:
+                usecols.append(i)
+    except Exception:
+        usecols = None
+    return wczytaj_arkusz(plik, schemat['arkusz'], header=schemat['naglowek'], usecols=usecols)
+
+def parsuj_daty(df, zrodlo):
+    schemat = SCHEMATY_ZRODEL[zrodlo]
+    kolumny = schemat['kolumny_daty']
+    wartosci = df[kolumny[0]]
+    for kol in kolumny[1:]:
+        wartosci = wartosci + ' ' + df[kol]
+    if pd.api.types.is_datetime64_any_dtype(wartosci):
+        return wartosci
+    daty = pd.to_datetime(wartosci, format=schemat['format_daty'], errors='coerce')
+    if not schemat['format_daty_scisly']:
+        braki = daty.isna() & wartosci.notna()
+        if braki.any() and daty.isna().all():
+            daty = pd.to_datetime(wartosci, errors='coerce')
+        elif braki.any():
+            daty[braki] = pd.to_datetime(wartosci[braki], errors='coerce')
+    return daty
+
+def parsuj_liczby(seria, zrodlo):
+    # Kolumna sparsowana natywnie przez czytnik nie wymaga już konwersji tekstu
+    if pd.api.types.is_numeric_dtype(seria):
+        return seria
+    separator = SCHEMATY_ZRODEL[zrodlo]['separator_dziesietny']
+    if separator != '.':
+        seria = seria.astype(str).str.replace(separator, '.')
+    return pd.to_numeric(seria, errors='coerce')
+
+# --- DOPASOWANIE POJAZDÓW (FLOTA) ---
+# Znane pojazdy (UNIX_FLOTA_CONFIG, aliasy z UNIX_ALIAS_MAPPING i tablice już obecne w bazie) w jednym regexie
+# zbudowanym z drzewa prefiksów (trie): wspólne początki tablic są sprawdzane raz, a cała kolumna tekstów idzie
+# jednym str.extract. Wynikiem jest kanoniczny klucz pojazdu. Ogólny wzorzec tablicy zostaje jako zapas
+# dla pojazdów, których jeszcze nie ma w bazie.
+WZORZEC_TABLICY = r'\b[A-Z]{2,3}[\s-]?[0-9A-Z]{4,5}\b'
+NIE_POJAZDY = ['POLSKA', 'PRZELEW', 'BANK', 'FAKTURA', 'TRANS', 'LOGISTICS']
+
+def czy_klucz_tablicy(klucz):
+    # Sam kształt tablicy łapie też słowa (POLSKA), więc wymagamy cyfry
+    return bool(re.fullmatch(r'[A-Z]{2,3}[0-9A-Z]{4,5}', klucz)) and any(c.isdigit() for c in klucz)
+
+def wzorzec_trie(slowa):
+    """Regex dopasowujący dowolne ze `slowa`, z gałęziami jak w drzewie prefiksów."""
+    trie = {}
+    for slowo in slowa:
+        wezel = trie
+        for znak in slowo:
+            wezel = wezel.setdefault(znak, {})
+        wezel[''] = {}
+
+    def regex(wezel):
+        galezie = [re.escape(znak) + regex(dalej) for znak, dalej in sorted(wezel.items()) if znak]
+        if not galezie:
+            return ''
+        koniec_slowa = '' in wezel
+        if len(galezie) == 1 and not koniec_slowa:
+            return galezie[0]
+        return '(?:' + '|'.join(galezie) + ')' + ('?' if koniec_slowa else '')
+
+    return regex(trie)
+
+def zbuduj_dopasowanie_floty(identyfikatory=()):
+    """Zwraca (skompilowany wzorzec, słownik dopasowany klucz -> kanoniczny pojazd)."""
+    kanoniczne = {klucz: klucz for klucz in UNIX_FLOTA_CONFIG}
+    for klucz in identyfikatory:
+        klucz = str(klucz).upper().replace(' ', '').replace('-', '')
+        if czy_klucz_tablicy(klucz):
+            kanoniczne.setdefault(klucz, klucz)
+    kanoniczne.update(UNIX_ALIAS_MAPPING)
+    return re.compile(rf"\b({wzorzec_trie(kanoniczne)})\b"), kanoniczne
+
+FLOTA = zbuduj_dopasowanie_floty()
+
+@st.cache_data(ttl=600)
+def pobierz_historyczne_identyfikatory(_conn):
+    with _conn.session as s:
+        return [r[0] for r in s.execute(text(f"""
+            SELECT DISTINCT identyfikator FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} WHERE identyfikator IS NOT NULL
+        """))]
+
+def odswiez_flote(conn):
+    global FLOTA
+    FLOTA = zbuduj_dopasowanie_floty(pobierz_historyczne_identyfikatory(conn))
+
+def dopasuj_znane_pojazdy(teksty):
+    """Kanoniczny klucz pierwszego znanego pojazdu w każdym tekście (NaN, gdy go nie ma)."""
+    wzorzec, kanoniczne = FLOTA
+    # 'WPR 9335N' / 'WPR-9335N' -> 'WPR9335N', tak jak w ogólnym wzorcu tablicy
+    teksty = teksty.astype(str).str.upper().str.replace(r'\b([A-Z]{2,3})[\s-]([0-9A-Z]{4,5})\b', r'\1\2', regex=True)
+    return teksty.str.extract(wzorzec, expand=False).map(kanoniczne)
+
+def dopasuj_pojazdy(teksty, brak='Brak Pojazdu'):
+    """Znany pojazd floty, a gdy go nie ma - pierwszy ciąg w kształcie tablicy (poza NIE_POJAZDY)."""
+    znane = dopasuj_znane_pojazdy(teksty)
+    ogolne = teksty.astype(str).str.upper().str.extract(f"({WZORZEC_TABLICY})", expand=False)
+    ogolne = ogolne.str.replace(r'[\s-]', '', regex=True)
+    ogolne = ogolne.where(~ogolne.isin(NIE_POJAZDY))
+    return znane.fillna(ogolne).fillna(brak)
+
 # --- NORMALIZACJA ---
 def normalizuj_eurowag(df_eurowag, firma_tag):
     df_out = pd.DataFrame()
-    df_out['data_transakcji'] = pd.to_datetime(df_eurowag['Data i godzina'], errors='coerce')
+    df_out['data_transakcji'] = parsuj_daty(df_eurowag, 'Eurowag')
     df_out['identyfikator'] = df_eurowag['Tablica rejestracyjna'].fillna(df_eurowag['Posiadacz karty'].fillna(df_eurowag['Karta']))
-    df_out['kwota_netto'] = pd.to_numeric(df_eurowag['Kwota netto'], errors='coerce')
-    df_out['kwota_brutto'] = pd.to_numeric(df_eurowag['Kwota brutto'], errors='coerce')
+    df_out['kwota_netto'] = parsuj_liczby(df_eurowag['Kwota netto'], 'Eurowag')
+    df_out['kwota_brutto'] = parsuj_liczby(df_eurowag['Kwota brutto'], 'Eurowag')
     df_out['waluta'] = df_eurowag['Waluta']
-    df_out['ilosc'] = pd.to_numeric(df_eurowag['Ilość'], errors='coerce')
+    df_out['ilosc'] = parsuj_liczby(df_eurowag['Ilość'], 'Eurowag')
     
     if 'Kraj' in df_eurowag.columns:
         df_out['kraj'] = df_eurowag['Kraj'].str.upper().str.strip()
     else:
         df_out['kraj'] = 'Nieznany'
 
-    kategorie = df_eurowag.apply(lambda row: kategoryzuj_transakcje(row, 'Eurowag'), axis=1)
-    df_out['typ'] = [kat[0] for kat in kategorie]
-    df_out['produkt'] = [kat[1] for kat in kategorie]
+    df_out['typ'], df_out['produkt'] = kategoryzuj_ramke(df_eurowag, 'Eurowag')
     df_out['zrodlo'] = 'Eurowag'
     df_out['firma'] = firma_tag
 
@@ -552,31 +976,24 @@ def normalizuj_eurowag(df_eurowag, firma_tag):
 
 def normalizuj_e100_PL(df_e100, firma_tag):
     df_out = pd.DataFrame()
-    df_out['data_transakcji'] = pd.to_datetime(df_e100['Data'] + ' ' + df_e100['Czas'], format='%d.%m.%Y %H:%M:%S', errors='coerce')
+    df_out['data_transakcji'] = parsuj_daty(df_e100, 'E100_PL')
     
     df_out['identyfikator'] = df_e100['Numer samochodu'].fillna(df_e100['Numer karty'])
     
-    numer_karty_str = df_e100['Numer karty'].astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
-    
-    df_out.loc[numer_karty_str.str.endswith('24'), 'identyfikator'] = 'WGM8463A'
-    df_out.loc[numer_karty_str.str.endswith('40'), 'identyfikator'] = 'KACPER'
-    
-    kwota_brutto = pd.to_numeric(df_e100['Kwota'], errors='coerce')
+    kwota_brutto = parsuj_liczby(df_e100['Kwota'], 'E100_PL')
     vat_rate = df_e100['Kraj'].map(VAT_RATES).fillna(0.0) 
     df_out['kwota_netto'] = kwota_brutto / (1 + vat_rate)
     df_out['kwota_brutto'] = kwota_brutto
     
     df_out['waluta'] = df_e100['Waluta']
-    df_out['ilosc'] = pd.to_numeric(df_e100['Ilość'], errors='coerce')
+    df_out['ilosc'] = parsuj_liczby(df_e100['Ilość'], 'E100_PL')
     
     if 'Kraj' in df_e100.columns:
         df_out['kraj'] = df_e100['Kraj'].str.upper().str.strip()
     else:
         df_out['kraj'] = 'PL' 
 
-    kategorie = df_e100.apply(lambda row: kategoryzuj_transakcje(row, 'E100_PL'), axis=1)
-    df_out['typ'] = [kat[0] for kat in kategorie]
-    df_out['produkt'] = [kat[1] for kat in kategorie]
+    df_out['typ'], df_out['produkt'] = kategoryzuj_ramke(df_e100, 'E100_PL')
     
     df_out['zrodlo'] = 'E100_PL'
     df_out['firma'] = firma_tag
@@ -585,25 +1002,23 @@ def normalizuj_e100_PL(df_e100, firma_tag):
     return df_out
 def normalizuj_e100_EN(df_e100, firma_tag):
     df_out = pd.DataFrame()
-    df_out['data_transakcji'] = pd.to_datetime(df_e100['Date'] + ' ' + df_e100['Time'], format='%d.%m.%Y %H:%M:%S', errors='coerce')
+    df_out['data_transakcji'] = parsuj_daty(df_e100, 'E100_EN')
     df_out['identyfikator'] = df_e100['Car registration number'].fillna(df_e100['Card number'])
     
-    kwota_brutto = pd.to_numeric(df_e100['Sum'], errors='coerce')
+    kwota_brutto = parsuj_liczby(df_e100['Sum'], 'E100_EN')
     vat_rate = df_e100['Country'].map(VAT_RATES).fillna(0.0) 
     df_out['kwota_netto'] = kwota_brutto / (1 + vat_rate)
     df_out['kwota_brutto'] = kwota_brutto
     
     df_out['waluta'] = df_e100['Currency']
-    df_out['ilosc'] = pd.to_numeric(df_e100['Quantity'], errors='coerce')
+    df_out['ilosc'] = parsuj_liczby(df_e100['Quantity'], 'E100_EN')
 
     if 'Country' in df_e100.columns:
         df_out['kraj'] = df_e100['Country'].str.upper().str.strip()
     else:
         df_out['kraj'] = 'Nieznany'
 
-    kategorie = df_e100.apply(lambda row: kategoryzuj_transakcje(row, 'E100_EN'), axis=1)
-    df_out['typ'] = [kat[0] for kat in kategorie]
-    df_out['produkt'] = [kat[1] for kat in kategorie] 
+    df_out['typ'], df_out['produkt'] = kategoryzuj_ramke(df_e100, 'E100_EN')
     df_out['zrodlo'] = 'E100_EN'
     df_out['firma'] = firma_tag
     
@@ -616,69 +1031,45 @@ def normalizuj_fakturownia(df_fakt, firma_tag):
     
     col_map = {}
     for c in df.columns:
-        c_lower = str(c).lower().strip()
-        if 'cena' in c_lower and 'netto' in c_lower and 'pln' not in c_lower:
-            col_map[c] = 'Cena netto'
-        elif 'cena' in c_lower and 'brutto' in c_lower and 'pln' not in c_lower:
-            col_map[c] = 'Cena brutto'
-        elif 'ilość' in c_lower or 'ilosc' in c_lower:
-            col_map[c] = 'Ilość'
-        elif 'sprzedaj' in c_lower and 'nip' not in c_lower:
-            col_map[c] = 'Sprzedający'
-        elif 'nip' in c_lower and 'sprzed' in c_lower:
-            col_map[c] = 'NIP sprzedającego'
-        elif 'nabywca' in c_lower and 'nip' not in c_lower:
-            col_map[c] = 'Nabywca'
-        elif 'data wyst' in c_lower:
-            col_map[c] = 'Data wystawienia'
-        elif 'produkt' in c_lower or 'usługa' in c_lower:
-             col_map[c] = 'Produkt/usługa'
-        elif 'waluta' in c_lower:
-             col_map[c] = 'Waluta'
+        nowa_nazwa = mapuj_kolumne_fakturowni(c)
+        if nowa_nazwa:
+            col_map[c] = nowa_nazwa
 
     df.rename(columns=col_map, inplace=True)
     df = df.loc[:, ~df.columns.duplicated()]
 
     df_out = pd.DataFrame()
-    df_out['data_transakcji'] = pd.to_datetime(df['Data wystawienia'], errors='coerce')
+    df_out['data_transakcji'] = parsuj_daty(df, 'Fakturownia')
     
     if 'Nabywca' in df.columns:
         df_out['kontrahent'] = df['Nabywca']
     else:
         df_out['kontrahent'] = 'Brak Kontrahenta'
     
-    def znajdz_pojazd(row):
-        cols_to_search = ['Uwagi', 'Nr zamówienia', 'Opis', 'Dodatkowe pole na pozycjach faktury', 'Produkt/usługa']
-        text_full = ""
-        for col in cols_to_search:
-            if col in row and pd.notna(row[col]):
-                text_full += " " + str(row[col])
-        
-        match = re.search(r'\b[A-Z]{2,3}[\s-]?[0-9A-Z]{4,5}\b', text_full.upper())
-        if match:
-            found = match.group(0).replace(" ", "").replace("-", "")
-            if found not in ['POLSKA', 'PRZELEW', 'BANK', 'FAKTURA', 'TRANS', 'LOGISTICS']:
-                return found
-        return 'Brak Pojazdu'
+    # Teksty ze wszystkich pól opisu sklejone w jedną kolumnę i przeszukane naraz
+    text_full = pd.Series('', index=df.index, dtype=object)
+    for col in ['Uwagi', 'Nr zamówienia', 'Opis', 'Dodatkowe pole na pozycjach faktury', 'Produkt/usługa']:
+        if col in df.columns:
+            text_full = text_full + (' ' + df[col].map(str)).where(df[col].notna(), '')
 
-    df_out['identyfikator'] = df.apply(znajdz_pojazd, axis=1)
+    df_out['identyfikator'] = dopasuj_pojazdy(text_full)
 
     if 'Cena netto' in df.columns and 'Ilość' in df.columns:
-        cena_netto = pd.to_numeric(df['Cena netto'].astype(str).str.replace(',', '.'), errors='coerce').fillna(0.0)
-        ilosc = pd.to_numeric(df['Ilość'].astype(str).str.replace(',', '.'), errors='coerce').fillna(0.0)
+        cena_netto = parsuj_liczby(df['Cena netto'], 'Fakturownia').fillna(0.0)
+        ilosc = parsuj_liczby(df['Ilość'], 'Fakturownia').fillna(0.0)
         
         df_out['kwota_netto'] = cena_netto * ilosc
         
         if 'Cena brutto' in df.columns:
-            cena_brutto = pd.to_numeric(df['Cena brutto'].astype(str).str.replace(',', '.'), errors='coerce').fillna(0.0)
+            cena_brutto = parsuj_liczby(df['Cena brutto'], 'Fakturownia').fillna(0.0)
             df_out['kwota_brutto'] = cena_brutto * ilosc
         else:
             df_out['kwota_brutto'] = df_out['kwota_netto'] 
     else:
         if 'Wartość netto' in df.columns:
-             df_out['kwota_netto'] = pd.to_numeric(df['Wartość netto'].astype(str).str.replace(',', '.'), errors='coerce')
+             df_out['kwota_netto'] = parsuj_liczby(df['Wartość netto'], 'Fakturownia')
         if 'Wartość brutto' in df.columns:
-             df_out['kwota_brutto'] = pd.to_numeric(df['Wartość brutto'].astype(str).str.replace(',', '.'), errors='coerce')
+             df_out['kwota_brutto'] = parsuj_liczby(df['Wartość brutto'], 'Fakturownia')
 
     df_out['waluta'] = df.get('Waluta', 'PLN')
     df_out['ilosc'] = 1.0 
@@ -688,9 +1079,7 @@ def normalizuj_fakturownia(df_fakt, firma_tag):
     else:
         df_out['kraj'] = 'PL'
 
-    kategorie = df.apply(lambda row: kategoryzuj_transakcje(row, 'Fakturownia'), axis=1)
-    df_out['typ'] = [kat[0] for kat in kategorie] 
-    df_out['produkt'] = [kat[1] for kat in kategorie]
+    df_out['typ'], df_out['produkt'] = kategoryzuj_ramke(df, 'Fakturownia')
     df_out['zrodlo'] = 'Fakturownia'
     df_out['firma'] = firma_tag
 
@@ -700,104 +1089,1670 @@ def normalizuj_fakturownia(df_fakt, firma_tag):
     
     return df_out
 
+# --- REJESTR KART PALIWOWYCH ---
+# Karta -> pojazd z okresem ważności (tabela fuel_cards). card_number to pełny numer albo jego końcówka,
+# source ogranicza wpis do jednego formatu (NULL = wszystkie), valid_from/valid_to włącznie (NULL = bez limitu).
+# Poniższe wpisy zastępują dawne reguły z normalizuj_e100_PL i trafiają do nowo tworzonej tabeli.
+DOMYSLNE_KARTY = [
+    {'card_number': '24', 'vehicle': 'WGM8463A', 'source': 'E100_PL', 'valid_from': None, 'valid_to': None},
+    {'card_number': '40', 'vehicle': 'KACPER', 'source': 'E100_PL', 'valid_from': None, 'valid_to': None},
+]
+KOLUMNY_REJESTRU_KART = ['card_number', 'vehicle', 'source', 'valid_from', 'valid_to']
+SQL_DODAJ_KARTE = f"""
+    INSERT INTO {NAZWA_SCHEMATU}.{NAZWA_TABELI_KART} (card_number, vehicle, source, valid_from, valid_to)
+    VALUES (:card_number, :vehicle, :source, :valid_from, :valid_to)
+"""
+
+def przygotuj_rejestr_kart(df):
+    df = pd.DataFrame(df, columns=KOLUMNY_REJESTRU_KART)
+    df = df[df['card_number'].notna() & df['vehicle'].notna()].copy()
+    df['card_number'] = df['card_number'].astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
+    df['vehicle'] = df['vehicle'].astype(str).str.strip()
+    df['source'] = df['source'].where(df['source'].notna() & (df['source'] != ''), None)
+    df['valid_from'] = pd.to_datetime(df['valid_from'])
+    df['valid_to'] = pd.to_datetime(df['valid_to'])
+    return df[(df['card_number'] != '') & (df['vehicle'] != '')].reset_index(drop=True)
+
+# Bieżący rejestr; odświeżany z bazy przez zapewnij_rejestr_kart / odswiez_rejestr_kart.
+# Wątki przetwarzania plików (przetworz_pliki_rownolegle) czytają go bezpośrednio.
+REJESTR_KART = przygotuj_rejestr_kart(DOMYSLNE_KARTY)
+
+def numery_kart(df_zrodlo, format_pliku):
+    """Numery kart jako tekst (bez '.0' z kolumn float); brak karty lub kolumny -> ''."""
+    kolumna = SCHEMATY_ZRODEL.get(format_pliku, {}).get('kolumna_karty')
+    if not kolumna or kolumna not in df_zrodlo.columns:
+        return pd.Series('', index=df_zrodlo.index, dtype=object)
+    numery = df_zrodlo[kolumna]
+    return numery.astype(str).str.replace(r'\.0$', '', regex=True).str.strip().where(numery.notna(), '')
+
+def przypisz_pojazdy_z_kart(identyfikatory, numery, daty, format_pliku, karty=None):
+    """
+    Identyfikatory po nałożeniu rejestru kart: gdy numer karty kończy się numerem z rejestru, a data
+    transakcji mieści się w okresie ważności, identyfikatorem staje się pojazd z rejestru (dłuższy numer wygrywa).
+    Jeden merge na każdą długość numeru w rejestrze - bez sprawdzania reguł wiersz po wierszu.
+    """
+    karty = REJESTR_KART if karty is None else karty
+    karty = karty[karty['source'].isna() | (karty['source'] == format_pliku)]
+    if karty.empty or identyfikatory.empty:
+        return identyfikatory
+    wynik = identyfikatory.to_numpy(dtype=object, copy=True)
+    przypisane = np.zeros(len(wynik), dtype=bool)
+    numery = numery.reset_index(drop=True)
+    dlugosci_numerow = numery.str.len().to_numpy()
+    kandydaci_wszyscy = pd.DataFrame({'data': pd.to_datetime(daty).to_numpy(), 'wiersz': np.arange(len(wynik))})
+    dlugosci_kart = karty['card_number'].str.len()
+    for dlugosc in sorted(dlugosci_kart.unique(), reverse=True):
+        maska = ~przypisane & (dlugosci_numerow >= dlugosc)
+        if not maska.any():
+            continue
+        kandydaci = kandydaci_wszyscy[maska].assign(card_number=numery[maska].str[-dlugosc:].to_numpy())
+        trafienia = kandydaci.merge(karty[dlugosci_kart == dlugosc], on='card_number')
+        w_okresie = ((trafienia['valid_from'].isna() | (trafienia['data'] >= trafienia['valid_from']))
+                     & (trafienia['valid_to'].isna() | (trafienia['data'] < trafienia['valid_to'] + pd.Timedelta(days=1))))
+        trafienia = trafienia[w_okresie].drop_duplicates('wiersz')
+        wiersze = trafienia['wiersz'].to_numpy()
+        wynik[wiersze] = trafienia['vehicle'].to_numpy()
+        przypisane[wiersze] = True
+    return pd.Series(wynik, index=identyfikatory.index, name=identyfikatory.name)
+
+def zapewnij_rejestr_kart(conn):
+    """Tworzy tabelę rejestru kart (z DOMYSLNE_KARTY), jeśli jej nie ma."""
+    with conn.session as s:
+        istnieje = s.execute(text("SELECT to_regclass(:t)"), {"t": f"{NAZWA_SCHEMATU}.{NAZWA_TABELI_KART}"}).scalar()
+        if istnieje is None:
+            s.execute(text(f"""
+                CREATE TABLE {NAZWA_SCHEMATU}.{NAZWA_TABELI_KART} (
+                    id SERIAL PRIMARY KEY,
+                    card_number VARCHAR(64) NOT NULL,
+                    vehicle VARCHAR(255) NOT NULL,
+                    source VARCHAR(50),
+                    valid_from DATE,
+                    valid_to DATE
+                );
+            """))
+            s.execute(text(SQL_DODAJ_KARTE), DOMYSLNE_KARTY)
+            s.commit()
+
+def pobierz_rejestr_kart(conn):
+    with conn.session as s:
+        wiersze = s.execute(text(f"""
+            SELECT {', '.join(KOLUMNY_REJESTRU_KART)} FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_KART} ORDER BY card_number, valid_from
+        """)).fetchall()
+    return pd.DataFrame(wiersze, columns=KOLUMNY_REJESTRU_KART)
+
+def odswiez_rejestr_kart(conn):
+    global REJESTR_KART
+    REJESTR_KART = przygotuj_rejestr_kart(pobierz_rejestr_kart(conn))
+
+def zapisz_rejestr_kart(conn, df):
+    """Zastępuje zawartość rejestru kart (edycja w panelu admina)."""
+    df = przygotuj_rejestr_kart(df)
+    with conn.session as s:
+        s.execute(text(f"DELETE FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_KART}"))
+        if not df.empty:
+            s.execute(text(SQL_DODAJ_KARTE), [
+                {**karta, 'valid_from': None if pd.isna(karta['valid_from']) else karta['valid_from'].date(),
+                 'valid_to': None if pd.isna(karta['valid_to']) else karta['valid_to'].date()}
+                for karta in df.to_dict('records')
+            ])
+        s.commit()
+    odswiez_rejestr_kart(conn)
+    return len(df)
+
 # --- WCZYTYWANIE PLIKÓW ---
+NORMALIZATORY = {
+    'Eurowag': normalizuj_eurowag,
+    'E100_PL': normalizuj_e100_PL,
+    'E100_EN': normalizuj_e100_EN,
+    'Fakturownia': normalizuj_fakturownia,
+}
+
+OPISY_FORMATOW_EXCEL = {
+    'E100_PL': "E100 (Polski - Excel)",
+    'E100_EN': "E100 (Angielski - Excel)",
+    'Eurowag': "Eurowag (Excel)",
+    'Fakturownia': "Fakturownia (Prawdziwy Excel)",
+}
+
+def wykryj_format_excel(nazwa_arkusza, cols):
+    cols = [str(c) for c in cols]
+    if nazwa_arkusza == 'Transactions':
+        if 'Numer samochodu' in cols and 'Kwota' in cols:
+            return 'E100_PL'
+        if 'Car registration number' in cols and 'Sum' in cols:
+            return 'E100_EN'
+        return None
+    if 'Data i godzina' in cols and ('Posiadacz karty' in cols or 'Artykuł' in cols):
+        return 'Eurowag'
+    if any('Sprzedaj' in c for c in cols) and any('Nabywca' in c for c in cols):
+        return 'Fakturownia'
+    return None
+
+def wykryj_format_csv(cols):
+    cols = [str(c) for c in cols]
+    if any('Sprzedaj' in c for c in cols) or any('NIP' in c for c in cols) or any('Data wyst' in c for c in cols):
+        return 'Fakturownia'
+    return None
+
+def normalizuj_wg_formatu(df, format_pliku, firma_tag, z_tekstami_zrodlowymi=False):
+    """
+    Normalizacja + przypisanie pojazdów z rejestru kart. Z `z_tekstami_zrodlowymi` ramka ma dodatkowo
+    kolumny dla stagingu (teksty kategorii, numer karty, identyfikator sprzed rejestru).
+    """
+    if format_pliku == 'Eurowag' and 'Posiadacz karty' not in df.columns:
+        df['Posiadacz karty'] = None
+    df_out = NORMALIZATORY[format_pliku](df, firma_tag)
+    numery = numery_kart(df, format_pliku).loc[df_out.index]
+    if z_tekstami_zrodlowymi:
+        df_out = dolacz_teksty_zrodlowe(df_out, df, format_pliku, numery)
+    df_out['identyfikator'] = przypisz_pojazdy_z_kart(df_out['identyfikator'], numery, df_out['data_transakcji'], format_pliku)
+    return df_out
+
+# --- ROZPOZNAWANIE FORMATU (SNIFFER) ---
+ROZMIAR_PROBKI_CSV = 64 * 1024
+KODOWANIA_CSV = ['utf-8-sig', 'cp1250', 'latin1']
+SEPARATORY_CSV = [',', ';', '\t']
+
+def nazwy_kolumn_naglowka(naglowek):
+    # Te same nazwy co w pd.read_excel: puste -> 'Unnamed: N', powtórzone -> 'X.1', 'X.2'...
+    nazwy = []
+    licznik = {}
+    for i, nazwa in enumerate(naglowek):
+        if nazwa is None or (isinstance(nazwa, str) and not nazwa.strip()):
+            nazwa = f"Unnamed: {i}"
+        if nazwa in licznik:
+            licznik[nazwa] += 1
+            nazwa = f"{nazwa}.{licznik[nazwa]}"
+        else:
+            licznik[nazwa] = 0
+        nazwy.append(nazwa)
+    return nazwy
+
+def czy_plik_excel(plik_bytes):
+    # .xlsx to archiwum ZIP
+    return plik_bytes[:4] == b'PK\x03\x04'
+
+def rozpoznaj_skoroszyt(wb):
+    """Na podstawie nazw arkuszy i samego wiersza nagłówka zwraca (format, arkusz, kolumny)."""
+    arkusz = 'Transactions' if 'Transactions' in wb.sheetnames else wb.sheetnames[0]
+    naglowek = next(wb[arkusz].iter_rows(min_row=1, max_row=1, values_only=True), None)
+    kolumny = nazwy_kolumn_naglowka(naglowek) if naglowek else []
+    format_pliku = wykryj_format_excel(arkusz if arkusz == 'Transactions' else None, kolumny)
+    if not format_pliku and 'pojazdy' in wb.sheetnames:
+        return 'Subiekt', 'pojazdy', []
+    return format_pliku, arkusz, kolumny
+
+def rozpoznaj_csv(probka, ucieta=True):
+    """Kodowanie, separator i format CSV ustalane na pierwszych KB pliku. Zwraca (format, kodowanie, separator, kolumny)."""
+    for enc in KODOWANIA_CSV:
+        try:
+            # Koniec próbki mógł przeciąć znak wielobajtowy - dekoder przyrostowy (final=False) odkłada taki
+            # niepełny znak zamiast zgłaszać błąd; pozycje w UnicodeDecodeError utf-8-sig są przesunięte o BOM
+            tekst = codecs.getincrementaldecoder(enc)().decode(probka, final=not ucieta)
+        except UnicodeDecodeError:
+            continue
+        break
+    else:
+        return None, None, None, []
+
+    linie = tekst.splitlines()
+    naglowek = linie[0] if linie else ""
+    separator = max(SEPARATORY_CSV, key=lambda sep: len(next(csv.reader([naglowek], delimiter=sep))))
+    kolumny = next(csv.reader([naglowek], delimiter=separator))
+    return wykryj_format_csv(kolumny), enc, separator, kolumny
+
+def rozpoznaj_plik(plik_bytes):
+    """
+    Ustala format źródła (Eurowag / E100_PL / E100_EN / Fakturownia / Subiekt) i parametry odczytu
+    wyłącznie z nagłówka: nazw arkuszy i pierwszego wiersza (Excel) lub pierwszych KB (CSV).
+    """
+    if czy_plik_excel(plik_bytes):
+        profil = {'format': None, 'typ_pliku': 'excel', 'arkusz': None, 'kolumny': []}
+        try:
+            wb = openpyxl.load_workbook(io.BytesIO(plik_bytes), read_only=True, data_only=True)
+            try:
+                profil['format'], profil['arkusz'], profil['kolumny'] = rozpoznaj_skoroszyt(wb)
+            finally:
+                wb.close()
+        except Exception:
+            pass
+        return profil
+
+    probka = plik_bytes[:ROZMIAR_PROBKI_CSV]
+    format_pliku, enc, sep, kolumny = rozpoznaj_csv(probka, ucieta=len(plik_bytes) > len(probka))
+    return {'format': format_pliku, 'typ_pliku': 'csv', 'kodowanie': enc, 'separator': sep, 'kolumny': kolumny}
+
+def parametry_csv(profil):
+    """usecols / dtype / decimal dla read_csv wynikające ze schematu formatu."""
+    schemat = SCHEMATY_ZRODEL.get(profil.get('format'))
+    indeksy = indeksy_kolumn_schematu(profil.get('format'), profil.get('kolumny'))
+    if not schemat or not indeksy:
+        return {}
+    nazwy = [profil['kolumny'][i] for i in indeksy]
+    parametry = {'usecols': indeksy}
+    teksty = {nazwa: str for nazwa in nazwy if nazwa in schemat['teksty']}
+    if teksty:
+        parametry['dtype'] = teksty
+    # Przy separatorze ',' i przecinku dziesiętnym liczby zostają tekstem - zamienia je parsuj_liczby
+    if schemat['separator_dziesietny'] != profil['separator']:
+        parametry['decimal'] = schemat['separator_dziesietny']
+    return parametry
+
+def wczytaj_csv(bufor, profil, **kwargs):
+    return pd.read_csv(bufor, sep=profil['separator'], encoding=profil['kodowanie'], on_bad_lines='skip',
+                       **parametry_csv(profil), **kwargs)
+
+def wczytaj_wg_profilu(plik_bytes, profil):
+    """Jednokrotny odczyt pliku z parametrami ustalonymi przez rozpoznaj_plik (silnik C dla CSV)."""
+    if profil['typ_pliku'] == 'excel':
+        return wczytaj_arkusz(plik_bytes, profil['arkusz'], usecols=indeksy_kolumn_schematu(profil['format'], profil['kolumny']))
+    try:
+        return wczytaj_csv(io.BytesIO(plik_bytes), profil)
+    except UnicodeDecodeError:
+        # Próbka była poprawnym UTF-8, ale dalsza część pliku już nie
+        profil['kodowanie'] = 'cp1250'
+        return wczytaj_csv(io.BytesIO(plik_bytes), profil)
+
+def przetworz_plik_do_ramki(nazwa_pliku_base, plik_bytes, wybrana_firma_upload, hash_pliku_val=None):
+    """
+    Wykrywa format, parsuje i normalizuje jeden plik. Nie korzysta ze st.*, więc może działać
+    w wątku puli (przetworz_pliki_rownolegle). Zwraca (DataFrame lub None, format, czas w s, lista komunikatów, błąd lub None).
+    Z `hash_pliku_val` wynik jest brany ze stagingu (jeśli był) albo do niego zapisywany.
+    """
+    start = time.time()
+    komunikaty = []
+    format_pliku = None
+    try:
+        if hash_pliku_val:
+            meta = metadane_stagingu(hash_pliku_val)
+            if meta is not None:
+                komunikaty.append(f"    -> Odtworzono ze stagingu ({meta['format']}, bez ponownego parsowania)")
+                return wczytaj_ze_stagingu(hash_pliku_val, wybrana_firma_upload), meta['format'], time.time() - start, komunikaty, None
+
+        profil = rozpoznaj_plik(plik_bytes)
+        format_pliku = profil['format']
+        if format_pliku == 'Subiekt':
+            return None, format_pliku, time.time() - start, komunikaty, f"Plik {nazwa_pliku_base} to analiza z Subiekta - wgraj go w zakładce Rentowność."
+        if not format_pliku:
+            return None, None, time.time() - start, komunikaty, f"Nie udało się rozpoznać formatu pliku: {nazwa_pliku_base}"
+
+        if profil['typ_pliku'] == 'excel':
+            komunikaty.append(f"    -> Wykryto format {OPISY_FORMATOW_EXCEL[format_pliku]}")
+        df = wczytaj_wg_profilu(plik_bytes, profil)
+        if profil['typ_pliku'] == 'csv':
+            komunikaty.append(f"    -> Wczytano jako CSV (Kodowanie: {profil['kodowanie']}, Separator: '{profil['separator']}')")
+            komunikaty.append("    -> Wykryto format Fakturownia (CSV)")
+        df_out = normalizuj_wg_formatu(df, format_pliku, wybrana_firma_upload, z_tekstami_zrodlowymi=bool(hash_pliku_val))
+        if hash_pliku_val:
+            try:
+                zapisz_do_stagingu(hash_pliku_val, nazwa_pliku_base, format_pliku, df_out)
+            except Exception as e:
+                komunikaty.append(f"    -> Nie zapisano do stagingu: {e}")
+            df_out = df_out.drop(columns=kolumny_zrodlowe_stagingu(df_out))
+        return df_out, format_pliku, time.time() - start, komunikaty, None
+    except Exception as e:
+        return None, format_pliku, time.time() - start, komunikaty, f"Błąd przetwarzania pliku {nazwa_pliku_base}: {e}"
+
+def przetworz_pliki_rownolegle(zadania, wybrana_firma_upload):
+    """
+    Uruchamia przetworz_plik_do_ramki dla listy (nazwa, bajty, hash pliku) na puli wątków.
+    Wyniki wracają w kolejności zadań, niezależnie od tego, który plik skończy się pierwszy.
+    Wątki, nie procesy: fork wielowątkowego serwera Streamlit jest niebezpieczny, a spawn/forkserver musiałyby
+    importować skrypt aplikacji. Parsowanie CSV i pandas/numpy w dużej części zwalniają GIL.
+    """
+    if len(zadania) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(zadania), os.cpu_count() or 1)) as pula:
+            return list(pula.map(lambda z: przetworz_plik_do_ramki(z[0], z[1], wybrana_firma_upload, z[2]), zadania))
+    return [przetworz_plik_do_ramki(nazwa, dane, wybrana_firma_upload, h) for nazwa, dane, h in zadania]
+
 def wczytaj_i_zunifikuj_pliki(przeslane_pliki, wybrana_firma_upload):
-    lista_df_zunifikowanych = []
-    
+    zadania = []
     for plik in przeslane_pliki:
-        nazwa_pliku_base = plik.name
+        try:
+            plik_bytes = plik.getvalue()
+            zadania.append((plik.name, plik_bytes, hash_pliku(plik_bytes)))
+        except Exception as e:
+            st.error(f"Nie udało się pobrać zawartości pliku {plik.name}: {e}")
+
+    wyniki = przetworz_pliki_rownolegle(zadania, wybrana_firma_upload)
+
+    lista_df_zunifikowanych = []
+    for (nazwa_pliku_base, _, _), (df_pliku, _, _, komunikaty, blad) in zip(zadania, wyniki):
         st.write(f" - Przetwarzam: {nazwa_pliku_base} (Firma: {wybrana_firma_upload})")
+        for komunikat in komunikaty:
+            st.write(komunikat)
+        if blad:
+            st.error(blad)
+        elif df_pliku is not None:
+            lista_df_zunifikowanych.append(df_pliku)
+
+    if not lista_df_zunifikowanych:
+        return None, "Nie udało się zunifikować żadnych danych."
         
+    polaczone_df = pd.concat(lista_df_zunifikowanych, ignore_index=True)
+    return polaczone_df, None
+
+# --- REJESTR WGRANYCH PLIKÓW (LEDGER) ---
+# Klucz naturalny transakcji - jego hash (row_hash) ma unikalny indeks, duplikaty odpadają przy INSERT
+KOLUMNY_KLUCZA_NATURALNEGO = ['data_transakcji', 'identyfikator', 'kwota_brutto', 'waluta', 'produkt', 'firma']
+ROZMIAR_PACZKI_HASHY = 10000
+# Wiersze wysyłane jednym COPY FROM STDIN (paczka CSV w pamięci)
+ROZMIAR_PACZKI_COPY = 50000
+TABELA_TYMCZASOWA_COPY = "tmp_transakcje_copy"
+INDEKS_KLUCZA_NATURALNEGO = f"uq_{NAZWA_TABELI}_row_hash"
+
+def hash_pliku(plik_bytes):
+    return hashlib.sha256(plik_bytes).hexdigest()
+
+def tekst_identyfikatora(wartosc):
+    # 7001234524 i 7001234524.0 (ta sama karta z kolumny int/float) mają dać ten sam klucz
+    if isinstance(wartosc, (float, np.floating)) and float(wartosc).is_integer():
+        return str(int(wartosc))
+    return str(wartosc)
+
+def oblicz_hashe_wierszy(df):
+    """
+    Hash klucza naturalnego wiersza (data, identyfikator, kwota brutto, waluta, produkt, firma).
+    Wiersz z brakiem w którejkolwiek kolumnie klucza dostaje None - tak jak w SQL (NULL <> NULL)
+    taki wiersz nigdy nie jest traktowany jako duplikat.
+    """
+    if df.empty:
+        return pd.Series(dtype=object, index=df.index)
+    braki = df[KOLUMNY_KLUCZA_NATURALNEGO].isna().any(axis=1)
+    daty = pd.to_datetime(df['data_transakcji']).dt.strftime('%Y-%m-%d %H:%M:%S.%f').fillna('')
+    klucze = (
+        daty
+        + '|' + df['identyfikator'].map(tekst_identyfikatora)
+        + '|' + df['kwota_brutto'].map(lambda v: repr(float(v)) if pd.notna(v) else '')
+        + '|' + df['waluta'].astype(str)
+        + '|' + df['produkt'].astype(str)
+        + '|' + df['firma'].astype(str)
+    )
+    hashe = [hashlib.blake2b(k.encode('utf-8'), digest_size=16).hexdigest() for k in klucze]
+    return pd.Series(hashe, index=df.index, dtype=object).where(~braki, None)
+
+@st.cache_resource
+def zapewnij_schemat_ingestu(_conn):
+    """
+    Doprowadza schemat do aktualnej wersji (brakujące migracje, bez kasowania danych) i wczytuje rejestr kart.
+    Raz na proces (st.cache_resource) - kolejne wywołania przy przeładowaniach strony nic nie robią;
+    nieudana próba nie trafia do cache, więc następne wywołanie ją powtórzy.
+    """
+    zastosuj_migracje(_conn)
+    odswiez_rejestr_kart(_conn)
+
+def zapewnij_unikalny_klucz(conn):
+    """
+    Jednorazowo: usuwa stare duplikaty klucza naturalnego (zostaje wiersz o najniższym id) i zakłada
+    unikalny indeks na row_hash w miejsce zwykłego. Wiersze z NULL w kluczu mają row_hash NULL i indeks ich nie blokuje.
+    """
+    with conn.session as s:
+        if s.execute(text("SELECT to_regclass(:n)"), {"n": f"{NAZWA_SCHEMATU}.{INDEKS_KLUCZA_NATURALNEGO}"}).scalar():
+            return
+        s.execute(text(f"""
+            DELETE FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} a
+            USING {NAZWA_SCHEMATU}.{NAZWA_TABELI} b
+            WHERE a.row_hash = b.row_hash AND a.id > b.id
+        """))
+        s.execute(text(f"CREATE UNIQUE INDEX {INDEKS_KLUCZA_NATURALNEGO} ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} (row_hash)"))
+        s.execute(text(f"DROP INDEX IF EXISTS {NAZWA_SCHEMATU}.idx_{NAZWA_TABELI}_row_hash"))
+        s.commit()
+
+def uzupelnij_hashe_wierszy(conn):
+    """
+    Wylicza row_hash dla rekordów zapisanych bez niego (sprzed rejestru). Rekord, którego klucz już jest
+    w bazie, to duplikat - jest usuwany, tak jak robiło to dawne czyszczenie duplikatów.
+    """
+    warunek = " AND ".join(f"{k} IS NOT NULL" for k in KOLUMNY_KLUCZA_NATURALNEGO)
+    while True:
+        with conn.session as s:
+            wiersze = s.execute(text(f"""
+                SELECT id, {', '.join(KOLUMNY_KLUCZA_NATURALNEGO)} FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI}
+                WHERE row_hash IS NULL AND {warunek}
+                ORDER BY id
+                LIMIT {ROZMIAR_PACZKI_HASHY}
+            """)).fetchall()
+        if not wiersze:
+            return
+        df = pd.DataFrame(wiersze, columns=['id'] + KOLUMNY_KLUCZA_NATURALNEGO)
+        hashe = oblicz_hashe_wierszy(df)
+        duplikaty = hashe.duplicated() | hashe.isin(istniejace_hashe(conn, hashe.unique()))
+        with conn.session as s:
+            if duplikaty.any():
+                s.execute(text(f"DELETE FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} WHERE id = ANY(CAST(:ids AS INTEGER[]))"),
+                          {"ids": df.loc[duplikaty, 'id'].tolist()})
+            s.execute(text(f"""
+                UPDATE {NAZWA_SCHEMATU}.{NAZWA_TABELI} t SET row_hash = v.h
+                FROM (SELECT unnest(CAST(:ids AS INTEGER[])) AS id, unnest(CAST(:hashe AS TEXT[])) AS h) v
+                WHERE t.id = v.id
+            """), {"ids": df.loc[~duplikaty, 'id'].tolist(), "hashe": hashe[~duplikaty].tolist()})
+            s.commit()
+
+def pobierz_wpis_rejestru(conn, hash_pliku_val, firma):
+    """Wpis pliku zapisanego w całości; plik przerwany w trakcie (status W_TOKU) nie jest pomijany."""
+    with conn.session as s:
+        wpis = s.execute(text(f"""
+            SELECT file_name, rows_inserted, ingested_at FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_REJESTRU}
+            WHERE file_hash = :h AND firma = :f AND status = '{STATUS_PLIKU_ZAPISANY}'
+        """), {"h": hash_pliku_val, "f": firma}).fetchone()
+    return wpis
+
+def komunikat_pominietego_pliku(nazwa_pliku, wpis):
+    nazwa_wgranego, dodane, kiedy = wpis
+    return f"Pomijam {nazwa_pliku}: identyczny plik ('{nazwa_wgranego}') wgrano {pd.Timestamp(kiedy):%Y-%m-%d %H:%M} ({dodane} nowych rekordów)."
+
+def istniejace_hashe(conn, hashe):
+    znalezione = set()
+    hashe = list(hashe)
+    with conn.session as s:
+        for i in range(0, len(hashe), ROZMIAR_PACZKI_HASHY):
+            paczka = hashe[i:i + ROZMIAR_PACZKI_HASHY]
+            wynik = s.execute(text(f"""
+                SELECT row_hash FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} WHERE row_hash = ANY(CAST(:hashe AS CHAR(32)[]))
+            """), {"hashe": paczka})
+            znalezione.update(r[0] for r in wynik)
+    return znalezione
+
+def csv_dla_copy(df):
+    """Paczka w formacie CSV dla COPY (NULL jako \\N, więc pusty tekst zostaje pustym tekstem)."""
+    df = df.copy()
+    if 'identyfikator' in df.columns:
+        # Karta z kolumny float bez '.0' - tak samo jak w row_hash
+        df['identyfikator'] = df['identyfikator'].map(tekst_identyfikatora).where(df['identyfikator'].notna(), None)
+    bufor = io.StringIO()
+    df.to_csv(bufor, index=False, header=False, na_rep='\\N', date_format='%Y-%m-%d %H:%M:%S.%f')
+    bufor.seek(0)
+    return bufor
+
+def zapisz_przez_copy(conn, df):
+    """
+    Zapis masowy: paczki po ROZMIAR_PACZKI_COPY idą przez COPY FROM STDIN do tabeli tymczasowej,
+    a z niej jednym INSERT ... SELECT ... ON CONFLICT DO NOTHING (klucz naturalny) do transakcji; w tym samym
+    zapytaniu nowe wiersze trafiają do zestawień (miesięcznego i dziennego) i zakresu danych. Zwraca (liczba zapisanych, czas w sekundach).
+    """
+    start = time.time()
+    kolumny = ', '.join(df.columns)
+    zapewnij_partycje(conn, df['data_transakcji'])
+    surowe = conn.engine.raw_connection()
+    try:
+        kursor = surowe.cursor()
+        kursor.execute(f"""
+            CREATE TEMP TABLE {TABELA_TYMCZASOWA_COPY} ON COMMIT DROP AS
+            SELECT {kolumny} FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} WITH NO DATA
+        """)
+        for i in range(0, len(df), ROZMIAR_PACZKI_COPY):
+            kursor.copy_expert(
+                f"COPY {TABELA_TYMCZASOWA_COPY} ({kolumny}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                csv_dla_copy(df.iloc[i:i + ROZMIAR_PACZKI_COPY])
+            )
+        # Wstawione wiersze (RETURNING) od razu dopisują się do zestawienia miesięcznego i zakresu danych - ta sama transakcja
+        kursor.execute(f"""
+            WITH nowe AS (
+                INSERT INTO {NAZWA_SCHEMATU}.{NAZWA_TABELI} ({kolumny})
+                SELECT {kolumny} FROM {TABELA_TYMCZASOWA_COPY}
+                ON CONFLICT (row_hash, data_transakcji) DO NOTHING
+                RETURNING *
+            ), zestawienie AS ({sql_dopisz_do_zestawienia('nowe')}
+            ), dzienne AS ({sql_dopisz_do_zestawienia('nowe', tabela=NAZWA_TABELI_DZIENNEJ)}
+            ), zakres AS ({sql_dopisz_do_zakresu('nowe')})
+            SELECT COUNT(*) FROM nowe
+        """)
+        dodane = kursor.fetchone()[0]
+        surowe.commit()
+    except Exception:
+        surowe.rollback()
+        raise
+    finally:
+        surowe.close()
+    return dodane, time.time() - start
+
+def opis_predkosci(wiersze, czas_s):
+    return f"{wiersze / czas_s:,.0f} rek./s" if czas_s > 0 else "-"
+
+def zapisz_nowe_wiersze(conn, df):
+    """
+    Zapisuje wiersze z hashem klucza naturalnego i oczyszczonym identyfikatorem przez COPY - wiersze, których
+    klucz już jest w bazie, odrzuca unikalny indeks (ON CONFLICT DO NOTHING). Zwraca (liczba faktycznie zapisanych, czas zapisu w s).
+    """
+    if df.empty:
+        return 0, 0.0
+    df = df.copy()
+    df['row_hash'] = oblicz_hashe_wierszy(df)
+    df = df[df['row_hash'].isna() | ~df['row_hash'].duplicated()]
+    # Czyścimy tekst w postaci, w jakiej identyfikator trafi do bazy (karta bez '.0')
+    df['identyfikator_clean'] = bezpieczne_czyszczenie_klucza(
+        df['identyfikator'].map(tekst_identyfikatora).where(df['identyfikator'].notna(), None))
+    wynik = zapisz_przez_copy(conn, df)
+    with conn.session as s:
+        zapisz_pojazdy(s, df['identyfikator_clean'].dropna().unique())
+        s.commit()
+    if wynik[0]:
+        # Kostka powstaje z zestawienia dziennego, które właśnie się zmieniło
+        pobierz_kostke_kosztow.clear()
+    return wynik
+
+def rozpocznij_wpis_rejestru(conn, hash_pliku_val, nazwa_pliku, format_pliku, firma):
+    """
+    Wpis W_TOKU przed zapisem pierwszej paczki (paczki są zatwierdzane osobno). Jeśli plik przerwie się w połowie,
+    jego wiersze w bazie mają w rejestrze wpis W_TOKU - a zarejestruj_plik zmienia go na ZAPISANY dopiero na końcu.
+    """
+    with conn.session as s:
+        s.execute(text(f"""
+            INSERT INTO {NAZWA_SCHEMATU}.{NAZWA_TABELI_REJESTRU} (file_hash, firma, file_name, format, status)
+            VALUES (:h, :f, :n, :fmt, '{STATUS_PLIKU_W_TOKU}')
+            ON CONFLICT (file_hash, firma) DO UPDATE SET
+                file_name = EXCLUDED.file_name, format = EXCLUDED.format, status = EXCLUDED.status,
+                ingested_at = CURRENT_TIMESTAMP
+        """), {"h": hash_pliku_val, "f": firma, "n": nazwa_pliku, "fmt": format_pliku})
+        s.commit()
+
+def zarejestruj_plik(conn, hash_pliku_val, nazwa_pliku, format_pliku, firma, liczba_wierszy, dodane, data_min, data_max, czas_s):
+    """Kończy wpis pliku (status ZAPISANY) - po zapisaniu wszystkich jego paczek."""
+    with conn.session as s:
+        s.execute(text(f"""
+            INSERT INTO {NAZWA_SCHEMATU}.{NAZWA_TABELI_REJESTRU}
+                (file_hash, firma, file_name, format, row_count, rows_inserted, date_min, date_max, duration_s, status)
+            VALUES (:h, :f, :n, :fmt, :rc, :ri, :dmin, :dmax, :t, '{STATUS_PLIKU_ZAPISANY}')
+            ON CONFLICT (file_hash, firma) DO UPDATE SET
+                file_name = EXCLUDED.file_name, row_count = EXCLUDED.row_count, rows_inserted = EXCLUDED.rows_inserted,
+                date_min = EXCLUDED.date_min, date_max = EXCLUDED.date_max, duration_s = EXCLUDED.duration_s,
+                status = EXCLUDED.status, ingested_at = CURRENT_TIMESTAMP
+        """), {
+            "h": hash_pliku_val, "f": firma, "n": nazwa_pliku, "fmt": format_pliku,
+            "rc": int(liczba_wierszy), "ri": int(dodane),
+            "dmin": None if pd.isna(data_min) else pd.Timestamp(data_min).to_pydatetime(),
+            "dmax": None if pd.isna(data_max) else pd.Timestamp(data_max).to_pydatetime(),
+            "t": float(czas_s)
+        })
+        s.commit()
+
+def wgraj_pliki_do_bazy(przeslane_pliki, wybrana_firma_upload, conn, pomin_znane_pliki=True):
+    """
+    Import z rejestrem: identyczne pliki (SHA-256) są pomijane od razu, pozostałe parsowane
+    równolegle, a do bazy trafiają tylko wiersze o nowym kluczu naturalnym. Zwraca liczbę dodanych rekordów.
+    """
+    zapewnij_schemat_ingestu(conn)
+
+    zadania = []
+    widziane = set()
+    for plik in przeslane_pliki:
         try:
             plik_bytes = plik.getvalue()
         except Exception as e:
-            st.error(f"Nie udało się pobrać zawartości pliku: {e}")
+            st.error(f"Nie udało się pobrać zawartości pliku {plik.name}: {e}")
             continue
+        h = hash_pliku(plik_bytes)
+        if h in widziane:
+            st.info(f"Pomijam {plik.name}: ten sam plik jest już w tej partii.")
+            continue
+        widziane.add(h)
+        if pomin_znane_pliki:
+            wpis = pobierz_wpis_rejestru(conn, h, wybrana_firma_upload)
+            if wpis is not None:
+                st.info(komunikat_pominietego_pliku(plik.name, wpis))
+                continue
+        zadania.append((plik.name, plik_bytes, h))
 
-        sukces_pliku = False
+    wyniki = przetworz_pliki_rownolegle(zadania, wybrana_firma_upload)
 
-        if nazwa_pliku_base.lower().endswith(('.xls', '.xlsx')):
+    suma_dodanych = 0
+    for (nazwa_pliku_base, _, h), (df_pliku, format_pliku, czas_s, komunikaty, blad) in zip(zadania, wyniki):
+        st.write(f" - Przetwarzam: {nazwa_pliku_base} (Firma: {wybrana_firma_upload})")
+        for komunikat in komunikaty:
+            st.write(komunikat)
+        if blad:
+            st.error(blad)
+            continue
+        start = time.time()
+        rozpocznij_wpis_rejestru(conn, h, nazwa_pliku_base, format_pliku, wybrana_firma_upload)
+        dodane, czas_zapisu = zapisz_nowe_wiersze(conn, df_pliku)
+        zarejestruj_plik(conn, h, nazwa_pliku_base, format_pliku, wybrana_firma_upload, len(df_pliku), dodane,
+                         df_pliku['data_transakcji'].min(), df_pliku['data_transakcji'].max(), czas_s + time.time() - start)
+        st.write(f"    -> Nowe rekordy: {dodane} z {len(df_pliku)} (reszta była już w bazie), zapis: {opis_predkosci(len(df_pliku), czas_zapisu)}")
+        suma_dodanych += dodane
+    return suma_dodanych
+
+def pobierz_rejestr_plikow(conn):
+    try:
+        return conn.query(f"SELECT * FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_REJESTRU} ORDER BY ingested_at DESC", ttl=0)
+    except Exception:
+        return pd.DataFrame()
+
+# --- STAGING (CACHE ZNORMALIZOWANYCH PLIKÓW) ---
+# Znormalizowane ramki zapisywane w Parquet (pyarrow przychodzi razem ze streamlit), klucz: hash pliku + wersja.
+# Podbić WERSJA_NORMALIZACJI przy każdej zmianie parsowania/normalizuj_* (zmiana reguł kategorii ani rejestru kart
+# jej nie wymaga - kategorie i pojazdy z kart są liczone od nowa przy odczycie z zapisanych tekstów źródłowych).
+KATALOG_STAGINGU = os.path.join(os.path.dirname(os.path.abspath(__file__)), "staging")
+WERSJA_NORMALIZACJI = 2
+PREFIKS_KOLUMN_KATEGORII = "kat__"
+KOLUMNA_NUMERU_KARTY = "karta__numer"
+KOLUMNA_IDENTYFIKATORA_BAZOWEGO = "karta__identyfikator"
+PLIK_METADANYCH_STAGINGU = "_meta.json"
+
+def katalog_stagingu(hash_pliku_val):
+    return os.path.join(KATALOG_STAGINGU, f"{hash_pliku_val}_v{WERSJA_NORMALIZACJI}")
+
+def dolacz_teksty_zrodlowe(df_out, df_zrodlo, format_pliku, numery):
+    """
+    Dokłada do znormalizowanej ramki teksty, z których liczona jest kategoria (jako str - jak w kategoryzuj_ramke),
+    numer karty i identyfikator sprzed rejestru kart.
+    """
+    df_out = df_out.copy()
+    for kol, _ in KOLUMNY_KATEGORYZACJI.get(format_pliku, ()):
+        if kol in df_zrodlo.columns:
+            df_out[PREFIKS_KOLUMN_KATEGORII + kol] = df_zrodlo.loc[df_out.index, kol].map(str)
+    df_out[KOLUMNA_NUMERU_KARTY] = numery
+    df_out[KOLUMNA_IDENTYFIKATORA_BAZOWEGO] = df_out['identyfikator']
+    return df_out
+
+def ramka_do_parquet(df):
+    # Kolumny object z mieszanymi typami (np. tablice + numery kart) jako tekst - tak i tak trafiają do VARCHAR.
+    # Numer karty z kolumny float bez '.0', tak jak w kluczu row_hash.
+    df = df.reset_index(drop=True)
+    for kol in df.columns[df.dtypes == object]:
+        df[kol] = df[kol].where(df[kol].isna(), df[kol].map(tekst_identyfikatora))
+    return df
+
+def rozpocznij_staging(hash_pliku_val):
+    os.makedirs(KATALOG_STAGINGU, exist_ok=True)
+    katalog_tmp = f"{katalog_stagingu(hash_pliku_val)}.tmp-{os.getpid()}"
+    shutil.rmtree(katalog_tmp, ignore_errors=True)
+    os.makedirs(katalog_tmp)
+    return katalog_tmp
+
+def dopisz_do_stagingu(katalog_tmp, numer_paczki, df):
+    ramka_do_parquet(df).to_parquet(os.path.join(katalog_tmp, f"part-{numer_paczki:05d}.parquet"), index=False)
+
+def zakoncz_staging(katalog_tmp, hash_pliku_val, nazwa_pliku, format_pliku, liczba_wierszy):
+    with open(os.path.join(katalog_tmp, PLIK_METADANYCH_STAGINGU), 'w', encoding='utf-8') as f:
+        json.dump({
+            'hash': hash_pliku_val, 'nazwa': nazwa_pliku, 'format': format_pliku, 'wiersze': int(liczba_wierszy),
+            'wersja': WERSJA_NORMALIZACJI, 'utworzono': pd.Timestamp.now().isoformat(timespec='seconds')
+        }, f, ensure_ascii=False)
+    docelowy = katalog_stagingu(hash_pliku_val)
+    try:
+        os.rename(katalog_tmp, docelowy)
+    except OSError:
+        # Ten sam plik zapisał już inny proces
+        shutil.rmtree(katalog_tmp, ignore_errors=True)
+
+def zapisz_do_stagingu(hash_pliku_val, nazwa_pliku, format_pliku, df):
+    katalog_tmp = rozpocznij_staging(hash_pliku_val)
+    try:
+        dopisz_do_stagingu(katalog_tmp, 0, df)
+        zakoncz_staging(katalog_tmp, hash_pliku_val, nazwa_pliku, format_pliku, len(df))
+    except Exception:
+        shutil.rmtree(katalog_tmp, ignore_errors=True)
+        raise
+
+def metadane_stagingu(hash_pliku_val):
+    sciezka = os.path.join(katalog_stagingu(hash_pliku_val), PLIK_METADANYCH_STAGINGU)
+    if not os.path.exists(sciezka):
+        return None
+    with open(sciezka, encoding='utf-8') as f:
+        return json.load(f)
+
+def kolumny_kategorii_stagingu(df):
+    return [k for k in df.columns if k.startswith(PREFIKS_KOLUMN_KATEGORII)]
+
+def kolumny_zrodlowe_stagingu(df):
+    return kolumny_kategorii_stagingu(df) + [k for k in (KOLUMNA_NUMERU_KARTY, KOLUMNA_IDENTYFIKATORA_BAZOWEGO) if k in df.columns]
+
+def kategorie_ze_stagingu(df, format_pliku):
+    teksty = df[kolumny_kategorii_stagingu(df)].rename(columns=lambda k: k[len(PREFIKS_KOLUMN_KATEGORII):])
+    return kategoryzuj_ramke(teksty, format_pliku)
+
+def identyfikatory_ze_stagingu(df, format_pliku):
+    numery = df[KOLUMNA_NUMERU_KARTY].fillna('')
+    return przypisz_pojazdy_z_kart(df[KOLUMNA_IDENTYFIKATORA_BAZOWEGO], numery, df['data_transakcji'], format_pliku)
+
+def paczki_ze_stagingu(hash_pliku_val, firma_tag, z_kategoriami_zapisanymi=False):
+    """Paczki (po jednym pliku part-*) znormalizowanych danych z kategoriami i pojazdami z kart wg bieżących reguł."""
+    meta = metadane_stagingu(hash_pliku_val)
+    katalog = katalog_stagingu(hash_pliku_val)
+    for nazwa in sorted(os.listdir(katalog)):
+        if not nazwa.endswith('.parquet'):
+            continue
+        df = pd.read_parquet(os.path.join(katalog, nazwa))
+        if z_kategoriami_zapisanymi:
+            df['typ_zapisany'], df['produkt_zapisany'] = df['typ'], df['produkt']
+            df['identyfikator_zapisany'] = df['identyfikator']
+        df['typ'], df['produkt'] = kategorie_ze_stagingu(df, meta['format'])
+        df['identyfikator'] = identyfikatory_ze_stagingu(df, meta['format'])
+        df = df.drop(columns=kolumny_zrodlowe_stagingu(df))
+        df['firma'] = firma_tag
+        yield nazwa, df
+
+def wczytaj_ze_stagingu(hash_pliku_val, firma_tag):
+    if metadane_stagingu(hash_pliku_val) is None:
+        return None
+    paczki = [df for _, df in paczki_ze_stagingu(hash_pliku_val, firma_tag)]
+    return pd.concat(paczki, ignore_index=True) if paczki else None
+
+def lista_stagingu():
+    wpisy = []
+    if not os.path.isdir(KATALOG_STAGINGU):
+        return pd.DataFrame(wpisy)
+    for nazwa in sorted(os.listdir(KATALOG_STAGINGU)):
+        sciezka = os.path.join(KATALOG_STAGINGU, nazwa)
+        meta_sciezka = os.path.join(sciezka, PLIK_METADANYCH_STAGINGU)
+        if not os.path.exists(meta_sciezka):
+            continue
+        with open(meta_sciezka, encoding='utf-8') as f:
+            meta = json.load(f)
+        meta['aktualna'] = meta.get('wersja') == WERSJA_NORMALIZACJI
+        meta['rozmiar_mb'] = round(sum(os.path.getsize(os.path.join(sciezka, p)) for p in os.listdir(sciezka)) / 1e6, 2)
+        wpisy.append(meta)
+    return pd.DataFrame(wpisy)
+
+def usun_nieaktualny_staging():
+    """Kasuje wpisy starszych wersji normalizacji i porzucone katalogi tymczasowe. Zwraca liczbę usuniętych."""
+    if not os.path.isdir(KATALOG_STAGINGU):
+        return 0
+    usuniete = 0
+    for nazwa in os.listdir(KATALOG_STAGINGU):
+        if '.tmp-' in nazwa or not nazwa.endswith(f"_v{WERSJA_NORMALIZACJI}"):
+            shutil.rmtree(os.path.join(KATALOG_STAGINGU, nazwa), ignore_errors=True)
+            usuniete += 1
+    return usuniete
+
+def wgraj_ze_stagingu(conn, hashe, wybrana_firma_upload):
+    """Ponowny import bez parsowania plików źródłowych. Zwraca liczbę dodanych rekordów."""
+    zapewnij_schemat_ingestu(conn)
+    suma_dodanych = 0
+    for h in hashe:
+        meta = metadane_stagingu(h)
+        start = time.time()
+        df = wczytaj_ze_stagingu(h, wybrana_firma_upload)
+        if df is None:
+            continue
+        dodane, czas_zapisu = zapisz_nowe_wiersze(conn, df)
+        zarejestruj_plik(conn, h, meta['nazwa'], meta['format'], wybrana_firma_upload, len(df), dodane,
+                         df['data_transakcji'].min(), df['data_transakcji'].max(), time.time() - start)
+        st.write(f" - {meta['nazwa']}: {dodane} nowych z {len(df)}, zapis: {opis_predkosci(len(df), czas_zapisu)}")
+        suma_dodanych += dodane
+    return suma_dodanych
+
+def przelicz_kategorie_ze_stagingu(conn, hashe):
+    """
+    Po zmianie reguł kategorii lub rejestru kart: przelicza typ/produkt i identyfikator dla wierszy z plików
+    w stagingu i poprawia je w bazie (dopasowanie po row_hash; produkt i identyfikator wchodzą do klucza,
+    więc row_hash też jest przeliczany). Dotknięte miesiące zestawienia są liczone od nowa. Zwraca liczbę zmian.
+    """
+    zapewnij_schemat_ingestu(conn)
+    zmienione = 0
+    for h in hashe:
+        with conn.session as s:
+            firmy = [r[0] for r in s.execute(text(f"""
+                SELECT firma FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_REJESTRU} WHERE file_hash = :h
+            """), {"h": h})]
+        for firma in firmy:
+            for _, df in paczki_ze_stagingu(h, firma, z_kategoriami_zapisanymi=True):
+                maska = ((df['typ'] != df['typ_zapisany']) | (df['produkt'] != df['produkt_zapisany'])
+                         | (df['identyfikator'] != df['identyfikator_zapisany']))
+                if not maska.any():
+                    continue
+                df_stare = df.loc[maska].drop(columns=['typ', 'produkt', 'identyfikator']).rename(columns={
+                    'typ_zapisany': 'typ', 'produkt_zapisany': 'produkt', 'identyfikator_zapisany': 'identyfikator'})
+                df_nowe = df.loc[maska]
+                # Dwa wiersze, które po przeliczeniu mają ten sam klucz, naruszyłyby unikalny indeks w jednym UPDATE
+                nowe_hashe = oblicz_hashe_wierszy(df_nowe)
+                jednoznaczne = (nowe_hashe.isna() | ~nowe_hashe.duplicated()).values
+                df_stare, df_nowe, nowe_hashe = df_stare[jednoznaczne], df_nowe[jednoznaczne], nowe_hashe[jednoznaczne]
+                identyfikatory_nowe = df_nowe['identyfikator'].map(tekst_identyfikatora)
+                with conn.session as s:
+                    wynik = s.execute(text(f"""
+                        UPDATE {NAZWA_SCHEMATU}.{NAZWA_TABELI} t
+                        SET typ = v.typ, produkt = v.produkt, identyfikator = v.identyfikator,
+                            identyfikator_clean = v.identyfikator_clean, row_hash = v.nowy_hash
+                        FROM (SELECT unnest(CAST(:stare AS TEXT[])) AS stary_hash, unnest(CAST(:nowe AS TEXT[])) AS nowy_hash,
+                                     unnest(CAST(:typy AS TEXT[])) AS typ, unnest(CAST(:produkty AS TEXT[])) AS produkt,
+                                     unnest(CAST(:identyfikatory AS TEXT[])) AS identyfikator,
+                                     unnest(CAST(:oczyszczone AS TEXT[])) AS identyfikator_clean) v
+                        WHERE t.row_hash = v.stary_hash
+                          AND NOT EXISTS (SELECT 1 FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} x WHERE x.row_hash = v.nowy_hash)
+                    """), {
+                        "stare": oblicz_hashe_wierszy(df_stare).tolist(), "nowe": nowe_hashe.tolist(),
+                        "typy": df_nowe['typ'].tolist(), "produkty": df_nowe['produkt'].tolist(),
+                        "identyfikatory": identyfikatory_nowe.tolist(),
+                        "oczyszczone": bezpieczne_czyszczenie_klucza(identyfikatory_nowe).tolist()
+                    })
+                    zapisz_pojazdy(s, bezpieczne_czyszczenie_klucza(identyfikatory_nowe).dropna().unique())
+                    # Zmiana typu/produktu/pojazdu przesuwa kwoty między grupami zestawienia - przeliczamy jego miesiące
+                    daty = df_nowe['data_transakcji'].dropna()
+                    if wynik.rowcount and not daty.empty:
+                        przelicz_zestawienie(s, daty.min(), daty.max())
+                    s.commit()
+                if wynik.rowcount:
+                    pobierz_kostke_kosztow.clear()
+                zmienione += wynik.rowcount
+        aktualizuj_kategorie_stagingu(h)
+    return zmienione
+
+def aktualizuj_kategorie_stagingu(hash_pliku_val):
+    # Zapisane typ/produkt/identyfikator mają odpowiadać temu, co po przeliczeniu jest w bazie
+    meta = metadane_stagingu(hash_pliku_val)
+    katalog = katalog_stagingu(hash_pliku_val)
+    for nazwa in sorted(os.listdir(katalog)):
+        if nazwa.endswith('.parquet'):
+            sciezka = os.path.join(katalog, nazwa)
+            df = pd.read_parquet(sciezka)
+            df['typ'], df['produkt'] = kategorie_ze_stagingu(df, meta['format'])
+            df['identyfikator'] = identyfikatory_ze_stagingu(df, meta['format'])
+            ramka_do_parquet(df).to_parquet(sciezka, index=False)
+
+# --- WCZYTYWANIE STRUMIENIOWE (DUŻE PLIKI) ---
+ROZMIAR_PACZKI = 50000
+
+def paczki_excel(plik, rozmiar_paczki=ROZMIAR_PACZKI):
+    """
+    Otwiera skoroszyt w trybie read-only i zwraca (format, szacowana_liczba_wierszy, generator paczek).
+    Paczki to DataFrame'y po max `rozmiar_paczki` wierszy - cały arkusz nigdy nie jest w pamięci.
+    """
+    plik.seek(0)
+    wb = openpyxl.load_workbook(plik, read_only=True, data_only=True)
+    format_pliku, nazwa_arkusza, kolumny = rozpoznaj_skoroszyt(wb)
+    if format_pliku not in NORMALIZATORY:
+        wb.close()
+        return format_pliku, 0, None
+
+    ws = wb[nazwa_arkusza]
+    # Tylko kolumny ze schematu formatu; max_col dopełnia krótsze wiersze pustymi komórkami
+    indeksy = indeksy_kolumn_schematu(format_pliku, kolumny) or list(range(len(kolumny)))
+    nazwy = [kolumny[i] for i in indeksy]
+    wiersze = ws.iter_rows(min_row=2, max_col=max(indeksy) + 1, values_only=True)
+
+    def generator():
+        try:
+            kolumny = [[] for _ in indeksy]
+            liczba = 0
+            for wiersz in wiersze:
+                wartosci = [wartosc_komorki(wiersz[i]) for i in indeksy]
+                if all(v is None for v in wartosci):
+                    continue
+                for kolumna, wartosc in zip(kolumny, wartosci):
+                    kolumna.append(wartosc)
+                liczba += 1
+                if liczba >= rozmiar_paczki:
+                    yield ramka_z_kolumn(kolumny, nazwy)
+                    kolumny = [[] for _ in indeksy]
+                    liczba = 0
+            if liczba:
+                yield ramka_z_kolumn(kolumny, nazwy)
+        finally:
+            wb.close()
+
+    szacowane_wiersze = max((ws.max_row or 1) - 1, 0)
+    return format_pliku, szacowane_wiersze, generator()
+
+def paczki_csv(plik, rozmiar_paczki=ROZMIAR_PACZKI):
+    # Kodowanie i separator z nagłówka, potem jeden przebieg silnikiem C paczkami
+    plik.seek(0)
+    probka = plik.read(ROZMIAR_PROBKI_CSV)
+    ucieta = bool(plik.read(1))
+    format_pliku, enc, sep, kolumny = rozpoznaj_csv(probka, ucieta=ucieta)
+    plik.seek(0)
+    if format_pliku not in NORMALIZATORY:
+        return format_pliku, enc, sep, None
+    profil = {'format': format_pliku, 'kodowanie': enc, 'separator': sep, 'kolumny': kolumny}
+    return format_pliku, enc, sep, czytaj_paczki_csv(plik, profil, rozmiar_paczki)
+
+def czytaj_paczki_csv(plik, profil, rozmiar_paczki):
+    """
+    Paczki read_csv jak w wczytaj_wg_profilu: gdy dalsza część pliku nie jest już UTF-8, odczyt rusza
+    od nowa w cp1250 i pomija wiersze wydane wcześniej (te paczki są już zapisane).
+    """
+    wydane = 0
+    try:
+        for paczka in wczytaj_csv(plik, profil, chunksize=rozmiar_paczki):
+            wydane += len(paczka)
+            yield paczka
+        return
+    except UnicodeDecodeError:
+        if profil['kodowanie'] == 'cp1250':
+            raise
+        profil['kodowanie'] = 'cp1250'
+    plik.seek(0)
+    do_pominiecia = wydane
+    for paczka in wczytaj_csv(plik, profil, chunksize=rozmiar_paczki):
+        if do_pominiecia >= len(paczka):
+            do_pominiecia -= len(paczka)
+            continue
+        yield paczka.iloc[do_pominiecia:]
+        do_pominiecia = 0
+
+def normalizuj_paczki(paczki, format_pliku, wybrana_firma_upload, katalog_tmp):
+    """Normalizuje kolejne paczki i od razu dopisuje je do stagingu. Zwraca (liczba surowych wierszy, ramka)."""
+    zapisuj = True
+    for numer, paczka in enumerate(paczki):
+        df_paczka = normalizuj_wg_formatu(paczka, format_pliku, wybrana_firma_upload, z_tekstami_zrodlowymi=True)
+        if zapisuj:
             try:
-                xls = pd.ExcelFile(io.BytesIO(plik_bytes), engine='openpyxl')
-                
-                if 'Transactions' in xls.sheet_names:
-                    df_e100 = pd.read_excel(xls, sheet_name='Transactions')
-                    col_e100 = df_e100.columns
-                    # Poprawione wykrywanie kolumn
-                    if 'Numer samochodu' in col_e100 and 'Kwota' in col_e100:
-                        st.write("    -> Wykryto format E100 (Polski - Excel)")
-                        lista_df_zunifikowanych.append(normalizuj_e100_PL(df_e100, wybrana_firma_upload))
-                        sukces_pliku = True
-                    elif 'Car registration number' in col_e100 and 'Sum' in col_e100:
-                        st.write("    -> Wykryto format E100 (Angielski - Excel)")
-                        lista_df_zunifikowanych.append(normalizuj_e100_EN(df_e100, wybrana_firma_upload))
-                        sukces_pliku = True
-                
-                elif 'Sheet0' in xls.sheet_names or len(xls.sheet_names) > 0:
-                    df_check = pd.read_excel(xls, sheet_name=0)
-                    cols = df_check.columns
-                    if 'Data i godzina' in cols and ('Posiadacz karty' in cols or 'Artykuł' in cols):
-                         st.write("    -> Wykryto format Eurowag (Excel)")
-                         if 'Posiadacz karty' not in cols: df_check['Posiadacz karty'] = None
-                         lista_df_zunifikowanych.append(normalizuj_eurowag(df_check, wybrana_firma_upload))
-                         sukces_pliku = True
-                    elif any('Sprzedaj' in c for c in cols) and any('Nabywca' in c for c in cols):
-                         st.write("    -> Wykryto format Fakturownia (Prawdziwy Excel)")
-                         lista_df_zunifikowanych.append(normalizuj_fakturownia(df_check, wybrana_firma_upload))
-                         sukces_pliku = True
+                dopisz_do_stagingu(katalog_tmp, numer, df_paczka)
             except Exception:
-                pass 
+                # Brak miejsca/uprawnień nie może przerwać importu - plik po prostu nie trafi do stagingu
+                zapisuj = False
+                shutil.rmtree(katalog_tmp, ignore_errors=True)
+        yield len(paczka), df_paczka.drop(columns=kolumny_zrodlowe_stagingu(df_paczka))
 
-        if sukces_pliku:
-            continue
+def wczytaj_strumieniowo_do_bazy(przeslane_pliki, wybrana_firma_upload, conn, rozmiar_paczki=ROZMIAR_PACZKI, pomin_znane_pliki=True):
+    """
+    Tryb dla dużych eksportów: czyta, normalizuje i zapisuje do bazy paczkami po `rozmiar_paczki`
+    wierszy, więc zużycie pamięci nie zależy od wielkości pliku. Zwraca liczbę zapisanych rekordów.
+    """
+    zapewnij_schemat_ingestu(conn)
+    suma_zapisanych = 0
+    for plik in przeslane_pliki:
+        nazwa_pliku_base = plik.name
+        st.write(f" - Przetwarzam strumieniowo: {nazwa_pliku_base} (Firma: {wybrana_firma_upload})")
+        start = time.time()
+
+        h = hash_pliku(plik.getbuffer())
+        if pomin_znane_pliki:
+            wpis = pobierz_wpis_rejestru(conn, h, wybrana_firma_upload)
+            if wpis is not None:
+                st.info(komunikat_pominietego_pliku(nazwa_pliku_base, wpis))
+                continue
 
-        separators = [',', ';', '\t']
-        encodings = ['utf-8', 'cp1250', 'latin1', 'utf-8-sig']
-        df_csv = None
-        
-        for enc in encodings:
-            for sep in separators:
-                try:
-                    buffer = io.BytesIO(plik_bytes)
-                    temp_df = pd.read_csv(buffer, sep=sep, encoding=enc, engine='python', on_bad_lines='skip')
-                    cols = temp_df.columns
-                    is_fakt = any('Sprzedaj' in c for c in cols) or any('NIP' in c for c in cols) or any('Data wyst' in c for c in cols)
-                    if is_fakt: 
-                        df_csv = temp_df
+        pasek = st.progress(0.0, text=f"{nazwa_pliku_base}: start...")
+        katalog_tmp = None
+        try:
+            meta = metadane_stagingu(h)
+            if meta is not None:
+                # Ten plik był już znormalizowany - paczki prosto ze stagingu
+                format_pliku, szacowane_wiersze = meta['format'], meta['wiersze']
+                st.write(f"    -> Odtworzono ze stagingu ({format_pliku}, bez ponownego parsowania)")
+                paczki_znormalizowane = ((len(df), df) for _, df in paczki_ze_stagingu(h, wybrana_firma_upload))
+            else:
+                plik.seek(0)
+                format_pliku, paczki, szacowane_wiersze = None, None, 0
+                if czy_plik_excel(plik.read(4)):
+                    format_pliku, szacowane_wiersze, paczki = paczki_excel(plik, rozmiar_paczki)
+                    if paczki is not None:
+                        st.write(f"    -> Wykryto format {OPISY_FORMATOW_EXCEL[format_pliku]}")
+                else:
+                    format_pliku, enc, sep, paczki = paczki_csv(plik, rozmiar_paczki)
+                    if paczki is not None:
                         st.write(f"    -> Wczytano jako CSV (Kodowanie: {enc}, Separator: '{sep}')")
-                        break
-                except Exception:
+                if format_pliku == 'Subiekt':
+                    pasek.empty()
+                    st.error(f"Plik {nazwa_pliku_base} to analiza z Subiekta - wgraj go w zakładce Rentowność.")
                     continue
-            if df_csv is not None:
-                break
-        
-        if df_csv is not None:
-            st.write("    -> Wykryto format Fakturownia (CSV)")
-            lista_df_zunifikowanych.append(normalizuj_fakturownia(df_csv, wybrana_firma_upload))
-            sukces_pliku = True
+                if paczki is None:
+                    pasek.empty()
+                    st.error(f"Nie udało się rozpoznać formatu pliku: {nazwa_pliku_base}")
+                    continue
+                katalog_tmp = rozpocznij_staging(h)
+                paczki_znormalizowane = normalizuj_paczki(paczki, format_pliku, wybrana_firma_upload, katalog_tmp)
+
+            rozpocznij_wpis_rejestru(conn, h, nazwa_pliku_base, format_pliku, wybrana_firma_upload)
+            rozmiar_pliku = getattr(plik, 'size', None) or len(plik.getbuffer())
+            wiersze_pliku = 0
+            znormalizowane_pliku = 0
+            zapisane_pliku = 0
+            czas_zapisu = 0.0
+            data_min, data_max = pd.NaT, pd.NaT
+            for liczba_wierszy, df_paczka in paczki_znormalizowane:
+                wiersze_pliku += liczba_wierszy
+                if not df_paczka.empty:
+                    znormalizowane_pliku += len(df_paczka)
+                    data_min = pd.Series([data_min, df_paczka['data_transakcji'].min()]).min()
+                    data_max = pd.Series([data_max, df_paczka['data_transakcji'].max()]).max()
+                    dodane, czas_paczki = zapisz_nowe_wiersze(conn, df_paczka)
+                    zapisane_pliku += dodane
+                    czas_zapisu += czas_paczki
+
+                if szacowane_wiersze:
+                    postep = wiersze_pliku / szacowane_wiersze
+                else:
+                    postep = plik.tell() / rozmiar_pliku if rozmiar_pliku else 0.0
+                pasek.progress(min(postep, 1.0), text=f"{nazwa_pliku_base}: {wiersze_pliku:,} wierszy przeczytanych, {zapisane_pliku:,} nowych zapisanych")
+
+            pasek.progress(1.0, text=f"{nazwa_pliku_base}: {wiersze_pliku:,} wierszy przeczytanych, {zapisane_pliku:,} nowych zapisanych")
+            st.write(f"    -> Nowe rekordy: {zapisane_pliku:,} z {znormalizowane_pliku:,}, zapis: {opis_predkosci(znormalizowane_pliku, czas_zapisu)}")
+            if katalog_tmp:
+                try:
+                    zakoncz_staging(katalog_tmp, h, nazwa_pliku_base, format_pliku, znormalizowane_pliku)
+                except Exception as e:
+                    st.warning(f"Nie zapisano {nazwa_pliku_base} do stagingu: {e}")
+                katalog_tmp = None
+            zarejestruj_plik(conn, h, nazwa_pliku_base, format_pliku, wybrana_firma_upload, znormalizowane_pliku, zapisane_pliku,
+                             data_min, data_max, time.time() - start)
+            suma_zapisanych += zapisane_pliku
+        except Exception as e:
+            st.error(f"Błąd strumieniowego wczytywania pliku {nazwa_pliku_base}: {e}")
+        finally:
+            if katalog_tmp:
+                shutil.rmtree(katalog_tmp, ignore_errors=True)
+
+    return suma_zapisanych
+
+# --- PODGLĄD (DRY-RUN) ---
+# Próbka pliku przechodzi przez te same czytniki i normalizuj_*, ale nic nie trafia do bazy ani stagingu.
+# CSV: bloki rozłożone równo po całym pliku (od początku do końca), Excel: pierwsze wiersze arkusza
+# (read-only czyta XML po kolei, więc dalsze wiersze kosztują tyle co cały plik).
+ROZMIAR_PROBKI_PODGLADU = 2000
+BLOKI_PROBKI_CSV = 8
+ROZMIAR_BLOKU_PROBKI_CSV = 32 * 1024
+
+def probka_csv(plik_bytes):
+    """Zwraca (profil, surowa próbka, szacowana liczba wierszy, czy cały plik)."""
+    profil = rozpoznaj_plik(plik_bytes)
+    if profil['format'] not in NORMALIZATORY:
+        return profil, None, 0, False
+    if len(plik_bytes) <= BLOKI_PROBKI_CSV * ROZMIAR_BLOKU_PROBKI_CSV:
+        df = wczytaj_csv(io.BytesIO(plik_bytes), profil, encoding_errors='replace')
+        return profil, df, len(df), True
+    # Każdy blok cięty po granicach wierszy i czytany z nagłówkiem z początku pliku
+    naglowek = plik_bytes[:plik_bytes.find(b'\n') + 1]
+    dane = len(plik_bytes) - len(naglowek)
+    krok = (dane - ROZMIAR_BLOKU_PROBKI_CSV) / (BLOKI_PROBKI_CSV - 1)
+    ramki = []
+    bajty_probki = 0
+    for i in range(BLOKI_PROBKI_CSV):
+        start = len(naglowek) + int(i * krok)
+        koniec = start + ROZMIAR_BLOKU_PROBKI_CSV
+        if i:
+            start = plik_bytes.find(b'\n', start - 1) + 1
+        if koniec < len(plik_bytes):
+            koniec = plik_bytes.rfind(b'\n', start, koniec) + 1
+        if koniec <= start:
+            continue
+        ramki.append(wczytaj_csv(io.BytesIO(naglowek + plik_bytes[start:koniec]), profil, encoding_errors='replace'))
+        bajty_probki += koniec - start
+    df = pd.concat(ramki, ignore_index=True)
+    szacowane = round(len(df) * dane / bajty_probki) if bajty_probki else 0
+    return profil, df, szacowane, False
+
+def probka_excel(plik_bytes):
+    """Zwraca (profil, surowa próbka, szacowana liczba wierszy z wymiaru arkusza, czy cały plik)."""
+    profil = rozpoznaj_plik(plik_bytes)
+    if profil['format'] not in NORMALIZATORY:
+        return profil, None, 0, False
+    _, szacowane, paczki = paczki_excel(io.BytesIO(plik_bytes), ROZMIAR_PROBKI_PODGLADU)
+    df = next(paczki, None)
+    # Zamknięcie generatora zamyka skoroszyt (finally w paczki_excel)
+    paczki.close()
+    if df is None:
+        return profil, None, 0, True
+    caly = len(df) < ROZMIAR_PROBKI_PODGLADU
+    return profil, df, len(df) if caly else max(szacowane, len(df)), caly
+
+def mapowanie_kolumn(format_pliku, kolumny_pliku):
+    """Tabela: kolumna pliku -> pole w bazie, z brakującymi kolumnami schematu."""
+    schemat = SCHEMATY_ZRODEL[format_pliku]
+    pola = schemat.get('pola', {})
+    wiersze = []
+    znalezione = set()
+    for kolumna in kolumny_pliku:
+        klucz = (mapuj_kolumne_fakturowni(kolumna) or kolumna) if format_pliku == 'Fakturownia' else kolumna
+        czytana = czy_kolumna_schematu(schemat, kolumna)
+        if czytana:
+            znalezione.add(klucz)
+        wiersze.append({
+            'Kolumna w pliku': str(kolumna),
+            'Pole w bazie': pola.get(klucz, 'kategoryzacja' if czytana else '—'),
+            'Status': 'wczytywana' if czytana else 'pomijana',
+        })
+    for klucz, pole in pola.items():
+        if klucz not in znalezione:
+            wiersze.append({'Kolumna w pliku': klucz, 'Pole w bazie': pole, 'Status': 'brak w pliku'})
+    return pd.DataFrame(wiersze)
+
+def podglad_pliku(plik_bytes, nazwa_pliku, wybrana_firma_upload, conn):
+    """
+    Dry-run dla jednego pliku: format, mapowanie kolumn, szacowana liczba wierszy, zakres dat,
+    waluty i szacunek nowych/zduplikowanych rekordów - liczone na próbce, bez zapisu.
+    """
+    start = time.time()
+    wynik = {'nazwa': nazwa_pliku, 'format': None, 'blad': None, 'wpis_rejestru': None}
+    h = hash_pliku(plik_bytes)
+    try:
+        wynik['wpis_rejestru'] = pobierz_wpis_rejestru(conn, h, wybrana_firma_upload)
+    except Exception:
+        pass
+
+    if czy_plik_excel(plik_bytes):
+        profil, df_probka, szacowane, caly = probka_excel(plik_bytes)
+        wynik['probka'] = 'cały arkusz' if caly else f'pierwsze {ROZMIAR_PROBKI_PODGLADU:,} wierszy arkusza'
+    else:
+        profil, df_probka, szacowane, caly = probka_csv(plik_bytes)
+        wynik['probka'] = 'cały plik' if caly else f'{BLOKI_PROBKI_CSV} bloków rozłożonych po całym pliku'
+    format_pliku = wynik['format'] = profil['format']
+    if format_pliku == 'Subiekt':
+        wynik['blad'] = "Analiza z Subiekta - wgraj ją w zakładce Rentowność."
+    elif format_pliku not in NORMALIZATORY:
+        wynik['blad'] = "Nie udało się rozpoznać formatu pliku."
+    elif df_probka is None:
+        wynik['blad'] = "Arkusz nie zawiera danych."
+    if wynik['blad']:
+        wynik['czas_s'] = time.time() - start
+        return wynik
+
+    wynik['mapowanie'] = mapowanie_kolumn(format_pliku, profil['kolumny'])
+    df_norm = normalizuj_wg_formatu(df_probka, format_pliku, wybrana_firma_upload)
+    wynik['wiersze_probki'] = len(df_probka)
+    wynik['wiersze_szacowane'] = szacowane
+    wynik['dokladny'] = caly
+    meta = metadane_stagingu(h)
+    if meta is not None:
+        # Plik był już znormalizowany - dokładna liczba rekordów ze stagingu
+        wynik['rekordy_szacowane'], wynik['dokladny'] = meta['wiersze'], True
+    else:
+        wynik['rekordy_szacowane'] = round(len(df_norm) * szacowane / len(df_probka))
+    # Skala: ile rekordów całego pliku przypada na jeden rekord próbki
+    skala = wynik['rekordy_szacowane'] / len(df_norm) if len(df_norm) else 0.0
+    wynik['data_min'] = df_norm['data_transakcji'].min()
+    wynik['data_max'] = df_norm['data_transakcji'].max()
+
+    waluty = df_norm.groupby(df_norm['waluta'].fillna('?'))['kwota_brutto'].agg(['size', 'sum'])
+    wynik['waluty'] = pd.DataFrame({
+        'Waluta': waluty.index,
+        'Rekordów w próbce': waluty['size'].values,
+        'Udział %': (waluty['size'] / max(len(df_norm), 1) * 100).round(1).values,
+        'Suma brutto (szac.)': (waluty['sum'] * skala).values,
+    }).sort_values('Rekordów w próbce', ascending=False)
+
+    # Duplikaty: powtórzenia w pliku + klucze już obecne w bazie, przeskalowane na cały plik
+    hashe = oblicz_hashe_wierszy(df_norm)
+    powtorzone = hashe.notna() & hashe.duplicated()
+    try:
+        znane = istniejace_hashe(conn, hashe.dropna().unique())
+    except Exception:
+        znane = None
+    if znane is None:
+        wynik['duplikaty_szacowane'] = None
+    else:
+        duplikaty = int((powtorzone | hashe.isin(znane)).sum())
+        wynik['duplikaty_szacowane'] = round(duplikaty * skala)
+    wynik['czas_s'] = time.time() - start
+    return wynik
+
+def podglad_plikow(przeslane_pliki, wybrana_firma_upload, conn):
+    try:
+        odswiez_rejestr_kart(conn)
+    except Exception:
+        pass
+    wyniki = []
+    for plik in przeslane_pliki:
+        try:
+            wyniki.append(podglad_pliku(plik.getvalue(), plik.name, wybrana_firma_upload, conn))
+        except Exception as e:
+            wyniki.append({'nazwa': plik.name, 'format': None, 'blad': f"Błąd podglądu: {e}", 'wpis_rejestru': None})
+    return wyniki
+
+# --- KONEKTORY API KART PALIWOWYCH (EUROWAG / E100) ---
+# Przyrostowe pobieranie transakcji: tylko rekordy od znaku wodnego (czas ostatniej zapisanej transakcji,
+# trzymany w app_settings per źródło i firma). Strony są normalizowane tymi samymi normalizuj_* co pliki
+# i od razu zapisywane, więc w pamięci jest zawsze jedna strona. Kontrakt API:
+#   GET {url}{sciezka}?since=<ISO 8601>&limit=<n>[&cursor=<c>], nagłówek Authorization: Bearer <token>
+#   -> {"items": [...], "next_cursor": "<c>" lub null}, rekordy rosnąco po czasie transakcji.
+# `since` jest włącznie - rekordy z granicy przychodzą ponownie i odpada je row_hash. Znak wodny to czas z API
+# (ze strefą - w UTC), a nie zapisana data transakcji - ta jest przeliczana na czas lokalny bez strefy.
+# Lokalny serwer testowy API (dev/test): tests/api_testowe.py.
+ROZMIAR_STRONY_API = 1000
+
+# 'pola': pole rekordu API -> kolumna eksportu, który przyjmuje normalizator 'format'
+KONEKTORY_API = {
+    'Eurowag': {
+        'format': 'Eurowag',
+        'sciezka': '/transactions',
+        'pole_czasu': 'transactionDateTime',
+        'pola': {
+            'licensePlate': 'Tablica rejestracyjna', 'cardHolder': 'Posiadacz karty', 'cardNumber': 'Karta',
+            'netAmount': 'Kwota netto', 'grossAmount': 'Kwota brutto', 'currency': 'Waluta', 'quantity': 'Ilość',
+            'country': 'Kraj', 'serviceName': 'Usługa', 'articleName': 'Artykuł', 'productName': 'Produkt',
+        },
+    },
+    'E100': {
+        'format': 'E100_EN',
+        'sciezka': '/transactions',
+        'pole_czasu': 'transactionDate',
+        'pola': {
+            'carNumber': 'Car registration number', 'cardNumber': 'Card number', 'sum': 'Sum', 'country': 'Country',
+            'currency': 'Currency', 'volume': 'Quantity', 'service': 'Service', 'category': 'Category',
+        },
+    },
+}
+
+def pobierz_ustawienie(conn, klucz):
+    # Sesja zamiast conn.query - wynik conn.query jest cache'owany, a znak wodny zmienia się co synchronizację
+    try:
+        with conn.session as s:
+            wiersz = s.execute(text(f"SELECT setting_value FROM {NAZWA_SCHEMATU}.app_settings WHERE setting_key = :k"),
+                               {"k": klucz}).fetchone()
+        return wiersz[0] if wiersz else None
+    except Exception:
+        return None
+
+def zapisz_ustawienie(conn, klucz, wartosc):
+    with conn.session as s:
+        s.execute(text(f"""
+            INSERT INTO {NAZWA_SCHEMATU}.app_settings (setting_key, setting_value)
+            VALUES (:key, :val)
+            ON CONFLICT (setting_key) DO UPDATE SET setting_value = :val
+        """), {"key": klucz, "val": wartosc})
+        s.commit()
+
+def klucz_znaku_wodnego(zrodlo, firma):
+    return f"api_wm_{zrodlo}_{firma}"
+
+def pobierz_konfiguracje_konektora(conn, zrodlo):
+    return pobierz_ustawienie(conn, f"api_{zrodlo}_url"), pobierz_ustawienie(conn, f"api_{zrodlo}_token")
+
+def zapisz_konfiguracje_konektora(conn, zrodlo, url, token):
+    zapisz_ustawienie(conn, f"api_{zrodlo}_url", url.rstrip('/'))
+    zapisz_ustawienie(conn, f"api_{zrodlo}_token", token)
+
+def nowszy_znak_wodny(znak_wodny, data):
+    if pd.isna(data):
+        return znak_wodny
+    data = pd.Timestamp(data)
+    return data if znak_wodny is None or data > pd.Timestamp(znak_wodny) else pd.Timestamp(znak_wodny)
+
+def czas_rekordow_api(df_api, zrodlo):
+    """Czas transakcji rekordów API; czas z przesunięciem strefy (także różnym, np. przez zmianę czasu) - w UTC."""
+    tekst = df_api[KONEKTORY_API[zrodlo]['pole_czasu']].astype(str)
+    ze_strefa = tekst.str.contains(r'(?:Z|[+-]\d{2}:?\d{2})$').any()
+    return pd.to_datetime(tekst, format='ISO8601', errors='coerce', utc=bool(ze_strefa))
+
+def ramka_z_rekordow_api(rekordy, zrodlo):
+    """
+    Strona rekordów API jako (ramka z kolumnami eksportu - data lokalna w formacie ze SCHEMATY_ZRODEL,
+    najpóźniejszy czas rekordu z API - kandydat na znak wodny).
+    """
+    konektor = KONEKTORY_API[zrodlo]
+    schemat = SCHEMATY_ZRODEL[konektor['format']]
+    pola = konektor['pola']
+    df_api = pd.DataFrame.from_records(rekordy, columns=[konektor['pole_czasu']] + list(pola))
+    df = df_api[list(pola)].rename(columns=pola)
+    czas_api = czas_rekordow_api(df_api, zrodlo)
+    czas = czas_api.dt.tz_convert('Europe/Warsaw').dt.tz_localize(None) if czas_api.dt.tz is not None else czas_api
+    # E100: data i godzina w osobnych kolumnach ('Date' + 'Time'), format rozdzielony spacją
+    kolumny_daty = schemat['kolumny_daty']
+    formaty = schemat['format_daty'].split(' ') if len(kolumny_daty) > 1 else [schemat['format_daty']]
+    for kolumna, format_czesci in zip(kolumny_daty, formaty):
+        df[kolumna] = czas.dt.strftime(format_czesci)
+    return df, czas_api.max()
+
+def strony_api(sesja, url, token, od=None, rozmiar_strony=ROZMIAR_STRONY_API):
+    """Kolejne strony rekordów (listy słowników) od `od` włącznie, po kursorze z odpowiedzi."""
+    params = {'limit': rozmiar_strony}
+    if od is not None:
+        params['since'] = pd.Timestamp(od).isoformat()
+    naglowki = {'Authorization': f"Bearer {token}"} if token else {}
+    while True:
+        response = sesja.get(url, params=params, headers=naglowki, timeout=60)
+        response.raise_for_status()
+        dane = response.json()
+        yield dane.get('items', [])
+        kursor = dane.get('next_cursor')
+        if not kursor:
+            return
+        params['cursor'] = kursor
+
+def pobierz_transakcje_api(zrodlo, url, token, firma_tag, od=None, rozmiar_strony=ROZMIAR_STRONY_API):
+    """Zwraca kolejne (liczba pobranych rekordów, znormalizowana ramka, najpóźniejszy czas z API) dla stron API."""
+    format_pliku = KONEKTORY_API[zrodlo]['format']
+    with requests.Session() as sesja:
+        for rekordy in strony_api(sesja, url, token, od, rozmiar_strony):
+            if rekordy:
+                df, czas_max = ramka_z_rekordow_api(rekordy, zrodlo)
+                yield len(rekordy), normalizuj_wg_formatu(df, format_pliku, firma_tag), czas_max
+
+def synchronizuj_api(conn, zrodlo, firma_tag):
+    """
+    Pobiera z API źródła transakcje nowsze niż znak wodny firmy i zapisuje nowe wiersze.
+    Znak wodny przesuwa się po każdej zapisanej stronie, więc przerwana synchronizacja rusza od miejsca awarii.
+    Zwraca (pobrane, zapisane, znak wodny, czas w s).
+    """
+    url, token = pobierz_konfiguracje_konektora(conn, zrodlo)
+    if not url:
+        raise ValueError(f"Brak adresu API dla źródła {zrodlo}.")
+    zapewnij_schemat_ingestu(conn)
+    klucz = klucz_znaku_wodnego(zrodlo, firma_tag)
+    znak_wodny = pobierz_ustawienie(conn, klucz)
+    start = time.time()
+    pobrane, zapisane = 0, 0
+    for liczba, df, czas_max in pobierz_transakcje_api(zrodlo, url + KONEKTORY_API[zrodlo]['sciezka'], token, firma_tag, znak_wodny):
+        pobrane += liczba
+        if not df.empty:
+            zapisane += zapisz_nowe_wiersze(conn, df)[0]
+        znak_wodny = nowszy_znak_wodny(znak_wodny, czas_max)
+        if znak_wodny is not None:
+            zapisz_ustawienie(conn, klucz, znak_wodny.isoformat())
+    return pobrane, zapisane, znak_wodny, time.time() - start
+
+# --- ZESTAWIENIE MIESIĘCZNE ---
+# transactions_monthly trzyma sumy transakcji w grupach (firma, miesiąc, pojazd (identyfikator_clean), typ,
+# produkt, waluta, kraj, źródło). Każdy zapis przez COPY (pliki, płace, Nexo, API) dopisuje do niego swoje nowe
+# wiersze w tej samej transakcji. Źródło jest w kluczu, bo raporty pomijają Fakturownię i wyróżniają karty HOLIER.
+# NULL w kolumnach klucza zapisujemy jako '' (w kluczu głównym NULL-e nie mogą być), przy odczycie wraca NULLIF.
+# transactions_daily to to samo per dzień w węższym kluczu, bez produktu i kraju - z niego budowana jest kostka
+# sum narastających dla sum pojazdów w dowolnym zakresie dat. Zmiana reguł czyszczenia identyfikatorów
+# przebudowuje oba w całości.
+
+KOLUMNY_KLUCZA_ZESTAWIENIA = ['firma', 'identyfikator_clean', 'typ', 'produkt', 'waluta', 'kraj', 'zrodlo']
+KOLUMNY_KLUCZA_DZIENNEGO = ['firma', 'identyfikator_clean', 'typ', 'waluta', 'zrodlo']
+ZESTAWIENIA = {  # tabela -> (kolumna okresu, jednostka date_trunc, kolumny klucza)
+    NAZWA_TABELI_MIESIECZNEJ: ('miesiac', 'month', KOLUMNY_KLUCZA_ZESTAWIENIA),
+    NAZWA_TABELI_DZIENNEJ: ('dzien', 'day', KOLUMNY_KLUCZA_DZIENNEGO),
+}
+
+def sql_dopisz_do_zestawienia(zrodlo, warunek="TRUE", tabela=NAZWA_TABELI_MIESIECZNEJ):
+    """INSERT sumujący wiersze `zrodlo` (tabela albo CTE z kolumnami transakcji) do zestawienia `tabela`."""
+    okres, jednostka, kolumny_klucza = ZESTAWIENIA[tabela]
+    klucz = ', '.join(kolumny_klucza)
+    grupy = ', '.join(str(i) for i in range(1, len(kolumny_klucza) + 2))
+    return f"""
+        INSERT INTO {NAZWA_SCHEMATU}.{tabela} AS m ({okres}, {klucz}, kwota_netto, kwota_brutto, ilosc, liczba)
+        SELECT CAST(date_trunc('{jednostka}', data_transakcji) AS DATE), {', '.join(f"COALESCE({k}, '')" for k in kolumny_klucza)},
+               COALESCE(SUM(kwota_netto), 0), COALESCE(SUM(kwota_brutto), 0), COALESCE(SUM(ilosc), 0), COUNT(*)
+        FROM {zrodlo}
+        WHERE data_transakcji IS NOT NULL AND {warunek}
+        GROUP BY {grupy}
+        ORDER BY {grupy}
+        ON CONFLICT ({okres}, {klucz}) DO UPDATE SET
+            kwota_netto = m.kwota_netto + EXCLUDED.kwota_netto,
+            kwota_brutto = m.kwota_brutto + EXCLUDED.kwota_brutto,
+            ilosc = m.ilosc + EXCLUDED.ilosc,
+            liczba = m.liczba + EXCLUDED.liczba
+    """
+
+def zakres_miesiecy_sql(data_start, data_stop):
+    """Półotwarty zakres [pierwszy dzień miesiąca data_start, pierwszy dzień miesiąca po data_stop)."""
+    return (pd.Timestamp(data_start).to_period('M').start_time.to_pydatetime(),
+            (pd.Timestamp(data_stop).to_period('M') + 1).start_time.to_pydatetime())
+
+def tabela_istnieje(s, tabela):
+    """Czy tabela jest już w bazie (migracje wcześniejsze niż ta, która ją zakłada, jeszcze jej nie widzą)."""
+    return s.execute(text("SELECT to_regclass(:tabela)"), {"tabela": f"{NAZWA_SCHEMATU}.{tabela}"}).scalar() is not None
+
+def zestawienia_pojazdow(s):
+    """
+    Zestawienia z ZESTAWIENIA, które są już w bazie w kluczu identyfikator_clean - migracje wcześniejsze
+    niż te, które je zakładają (albo przenoszą na pojazd), jeszcze ich w tym układzie nie widzą.
+    """
+    gotowe = {r[0] for r in s.execute(text("""
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = :schemat AND column_name = 'identyfikator_clean' AND table_name = ANY(:tabele)
+    """), {"schemat": NAZWA_SCHEMATU, "tabele": list(ZESTAWIENIA)})}
+    return [tabela for tabela in ZESTAWIENIA if tabela in gotowe]
+
+def przelicz_zestawienie(s, data_start=None, data_stop=None, tabele=None):
+    """
+    Liczy od nowa miesiące zestawień obejmujące [data_start, data_stop] (bez dat - całe) w otwartej sesji `s`;
+    commit należy do wołającego. Blokada tabeli wstrzymuje na ten czas dopisywanie z równoległych zapisów COPY.
+    `tabele` - tylko te zestawienia (domyślnie wszystkie z ZESTAWIENIA).
+    """
+    for tabela in tabele or list(ZESTAWIENIA):
+        okres = ZESTAWIENIA[tabela][0]
+        s.execute(text(f"LOCK TABLE {NAZWA_SCHEMATU}.{tabela} IN SHARE ROW EXCLUSIVE MODE"))
+        if data_start is None:
+            s.execute(text(f"DELETE FROM {NAZWA_SCHEMATU}.{tabela}"))
+            s.execute(text(sql_dopisz_do_zestawienia(f"{NAZWA_SCHEMATU}.{NAZWA_TABELI}", tabela=tabela)))
+            continue
+        miesiac_od, miesiac_do = zakres_miesiecy_sql(data_start, data_stop)
+        params = {"miesiac_od": miesiac_od, "miesiac_do": miesiac_do}
+        s.execute(text(f"""
+            DELETE FROM {NAZWA_SCHEMATU}.{tabela} WHERE {okres} >= :miesiac_od AND {okres} < :miesiac_do
+        """), params)
+        s.execute(text(sql_dopisz_do_zestawienia(
+            f"{NAZWA_SCHEMATU}.{NAZWA_TABELI}", "data_transakcji >= :miesiac_od AND data_transakcji < :miesiac_do", tabela
+        )), params)
+
+def przebuduj_zestawienie_miesieczne(conn, data_start=None, data_stop=None, tabele=None):
+    """Przebudowa zestawień na żądanie (całych albo miesięcy z zakresu dat). Zwraca liczbę wierszy miesięcznego."""
+    with conn.session as s:
+        przelicz_zestawienie(s, data_start, data_stop, tabele)
+        s.commit()
+        return s.execute(text(f"SELECT COUNT(*) FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_MIESIECZNEJ}")).scalar()
+
+# --- ZAKRES DANYCH (METADANE) ---
+# transactions_extent: pierwsza i ostatnia data oraz liczba rekordów per firma i źródło. Domyślne zakresy dat
+# widoków czytają tę małą tabelę zamiast MIN/MAX po całych transakcjach; zapis przez COPY poszerza zakres
+# w tej samej transakcji, a usuwanie rekordów przelicza go od nowa.
+
+def sql_dopisz_do_zakresu(zrodlo):
+    """INSERT poszerzający zakres dat i liczbę rekordów o wiersze `zrodlo` (tabela albo CTE z kolumnami transakcji)."""
+    return f"""
+        INSERT INTO {NAZWA_SCHEMATU}.{NAZWA_TABELI_ZAKRESU} AS z (firma, zrodlo, data_min, data_max, liczba)
+        SELECT COALESCE(firma, ''), COALESCE(zrodlo, ''), MIN(data_transakcji), MAX(data_transakcji), COUNT(*)
+        FROM {zrodlo}
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        ON CONFLICT (firma, zrodlo) DO UPDATE SET
+            data_min = LEAST(z.data_min, EXCLUDED.data_min),
+            data_max = GREATEST(z.data_max, EXCLUDED.data_max),
+            liczba = z.liczba + EXCLUDED.liczba
+    """
+
+def przelicz_zakres_danych(s):
+    """Liczy zakres danych od nowa z transakcji w otwartej sesji `s` (po usunięciu rekordów); commit należy do wołającego."""
+    s.execute(text(f"DELETE FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_ZAKRESU}"))
+    s.execute(text(sql_dopisz_do_zakresu(f"{NAZWA_SCHEMATU}.{NAZWA_TABELI}")))
+
+def pobierz_zakresy_danych(conn):
+    try:
+        return conn.query(f"""
+            SELECT firma, zrodlo, data_min, data_max, liczba FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_ZAKRESU} ORDER BY firma, zrodlo
+        """, ttl=0)
+    except Exception:
+        return pd.DataFrame()
+
+def pobierz_zakres_dat(conn):
+    """Domyślny zakres dat widoków: (pierwszy, ostatni dzień z danymi) albo (None, None) przy pustej bazie."""
+    zakresy = pobierz_zakresy_danych(conn)
+    if zakresy.empty or zakresy['data_min'].isna().all():
+        return None, None
+    return pd.Timestamp(zakresy['data_min'].min()).date(), pd.Timestamp(zakresy['data_max'].max()).date()
+
+# --- PARTYCJE MIESIĘCZNE ---
+# transactions jest partycjonowana zakresami data_transakcji po miesiącu (transactions_RRRR_MM), rekordy bez daty
+# trafiają do transactions_default. Zapytania z zakresem dat czytają tylko partycje tego zakresu, a cały miesiąc
+# usuwa się przez DROP jego partycji. Brakujące partycje zakłada zapis przez COPY, zanim wstawi wiersze - we własnej
+# krótkiej transakcji pod blokadą doradczą, żeby dwa równoległe zapisy nowego miesiąca nie zakładały tej samej partycji.
+BLOKADA_PARTYCJI = 2017_2101
+
+NAZWA_PARTYCJI_DOMYSLNEJ = f"{NAZWA_TABELI}_default"
+SQL_LISTA_PARTYCJI = f"""
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = CAST('{NAZWA_SCHEMATU}.{NAZWA_TABELI}' AS regclass)
+"""
+
+def nazwa_partycji(miesiac):
+    return f"{NAZWA_TABELI}_{miesiac:%Y_%m}"
+
+def sql_partycji_miesiaca(miesiac):
+    """CREATE TABLE partycji dla miesiąca zaczynającego się w `miesiac`."""
+    nastepny = miesiac + pd.offsets.MonthBegin(1)
+    return f"""
+        CREATE TABLE IF NOT EXISTS {NAZWA_SCHEMATU}.{nazwa_partycji(miesiac)} PARTITION OF {NAZWA_SCHEMATU}.{NAZWA_TABELI}
+        FOR VALUES FROM ('{miesiac:%Y-%m-%d}') TO ('{nastepny:%Y-%m-%d}')
+    """
+
+def brakujace_partycje(daty, istniejace):
+    """Pierwsze dni miesięcy z `daty`, które nie mają jeszcze partycji (nazwy w `istniejace`)."""
+    miesiace = pd.to_datetime(pd.Series(daty)).dropna().dt.to_period('M').unique()
+    return [m.start_time for m in sorted(miesiace) if nazwa_partycji(m.start_time) not in istniejace]
+
+def zapewnij_partycje(conn, daty):
+    """
+    Zakłada brakujące partycje dla `daty` przed transakcją zapisu. Blokada doradcza (do końca tej krótkiej
+    transakcji) szereguje zakładanie - drugi zapis czeka, a potem IF NOT EXISTS widzi już partycję pierwszego.
+    """
+    with conn.session as s:
+        istniejace = {r[0] for r in s.execute(text(SQL_LISTA_PARTYCJI))}
+        brakujace = brakujace_partycje(daty, istniejace)
+        if not brakujace:
+            return
+        s.execute(text("SELECT pg_advisory_xact_lock(:klucz)"), {"klucz": BLOKADA_PARTYCJI})
+        for miesiac in brakujace:
+            s.execute(text(sql_partycji_miesiaca(miesiac)))
+        s.commit()
+
+def lista_partycji(conn):
+    """Miesiące (RRRR-MM) z własną partycją, od najstarszego."""
+    with conn.session as s:
+        nazwy = [r[0] for r in s.execute(text(SQL_LISTA_PARTYCJI))]
+    return sorted(n[len(NAZWA_TABELI) + 1:].replace('_', '-') for n in nazwy if n != NAZWA_PARTYCJI_DOMYSLNEJ)
+
+def usun_miesiac(conn, miesiac):
+    """
+    Usuwa wszystkie transakcje miesiąca `miesiac` (RRRR-MM) przez DROP jego partycji, razem z jego wierszami
+    zestawienia i wpisami rejestru plików z tego okresu (te pliki można potem wgrać ponownie).
+    """
+    poczatek = pd.Timestamp(f"{miesiac}-01")
+    params = {"od": poczatek.to_pydatetime(), "do": (poczatek + pd.offsets.MonthBegin(1)).to_pydatetime()}
+    with conn.session as s:
+        s.execute(text(f"DROP TABLE IF EXISTS {NAZWA_SCHEMATU}.{nazwa_partycji(poczatek)}"))
+        for tabela, (okres, _, _) in ZESTAWIENIA.items():
+            s.execute(text(f"DELETE FROM {NAZWA_SCHEMATU}.{tabela} WHERE {okres} >= :od AND {okres} < :do"), params)
+        s.execute(text(f"""
+            DELETE FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_REJESTRU} WHERE date_min < :do AND date_max >= :od
+        """), params)
+        przelicz_zakres_danych(s)
+        s.commit()
+
+# --- MIGRACJE SCHEMATU ---
+# Każda zmiana schematu to kolejna pozycja w MIGRACJE (numer, nazwa, funkcja). Wykonane numery są zapisane
+# w schema_migrations, więc przy starcie dochodzą tylko brakujące. Funkcje są idempotentne (IF NOT EXISTS),
+# dzięki czemu istniejąca baza sprzed migracji przechodzi przez nie bez utraty danych.
+
+def migracja_tabele_podstawowe(conn):
+    with conn.session as s:
+        s.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI} (
+                id SERIAL PRIMARY KEY,
+                data_transakcji TIMESTAMP,
+                identyfikator VARCHAR(255),
+                kwota_netto FLOAT,
+                kwota_brutto FLOAT,
+                waluta VARCHAR(10),
+                ilosc FLOAT,
+                produkt VARCHAR(255),
+                typ VARCHAR(50), 
+                zrodlo VARCHAR(50),
+                kraj VARCHAR(50),
+                firma VARCHAR(50),
+                kontrahent VARCHAR(255)
+            );
+        """))
+        s.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {NAZWA_SCHEMATU}.app_settings (
+                setting_key VARCHAR(50) PRIMARY KEY,
+                setting_value TEXT
+            );
+        """))
+        s.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI_PLIKOW} (
+                file_name VARCHAR(255) PRIMARY KEY,
+                file_data BYTEA,
+                uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """))
+        s.commit()
+
+def migracja_rejestr_plikow(conn):
+    with conn.session as s:
+        s.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI_REJESTRU} (
+                file_hash CHAR(64),
+                firma VARCHAR(50),
+                file_name VARCHAR(255),
+                format VARCHAR(50),
+                row_count INTEGER,
+                rows_inserted INTEGER,
+                date_min TIMESTAMP,
+                date_max TIMESTAMP,
+                duration_s FLOAT,
+                ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (file_hash, firma)
+            );
+        """))
+        s.execute(text(f"ALTER TABLE {NAZWA_SCHEMATU}.{NAZWA_TABELI} ADD COLUMN IF NOT EXISTS row_hash CHAR(32)"))
+        s.commit()
 
-        if sukces_pliku:
-            continue
+def migracja_klucz_naturalny(conn):
+    uzupelnij_hashe_wierszy(conn)
+    zapewnij_unikalny_klucz(conn)
 
-        if not sukces_pliku:
-            st.error(f"Nie udało się rozpoznać formatu pliku: {nazwa_pliku_base}")
+def migracja_indeksy_dat(conn):
+    # Widoki filtrują po firmie albo typie i zakresie dat - indeksy złożone dają range scan,
+    # a BRIN na dacie (tabela rośnie chronologicznie) jest malutki i obsługuje sam zakres dat
+    with conn.session as s:
+        s.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{NAZWA_TABELI}_firma_data ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} (firma, data_transakcji)"))
+        s.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{NAZWA_TABELI}_typ_data ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} (typ, data_transakcji)"))
+        s.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{NAZWA_TABELI}_data_brin ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} USING brin (data_transakcji)"))
+        s.execute(text(f"ANALYZE {NAZWA_SCHEMATU}.{NAZWA_TABELI}"))
+        s.commit()
 
-    if not lista_df_zunifikowanych:
-        return None, "Nie udało się zunifikować żadnych danych."
-        
-    polaczone_df = pd.concat(lista_df_zunifikowanych, ignore_index=True)
-    return polaczone_df, None
-def setup_database(conn):
+def migracja_zestawienie_miesieczne(conn):
     with conn.session as s:
-        # 1. Najpierw usuwamy stare tabele (UWAGA: TO KASUJE DANE!)
-        s.execute(text(f"DROP TABLE IF EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI}"))
-        s.execute(text(f"DROP TABLE IF EXISTS {NAZWA_SCHEMATU}.app_settings"))
+        s.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI_MIESIECZNEJ} (
+                firma VARCHAR(50) NOT NULL DEFAULT '',
+                miesiac DATE NOT NULL,
+                identyfikator VARCHAR(255) NOT NULL DEFAULT '',
+                typ VARCHAR(50) NOT NULL DEFAULT '',
+                produkt VARCHAR(255) NOT NULL DEFAULT '',
+                waluta VARCHAR(10) NOT NULL DEFAULT '',
+                kraj VARCHAR(50) NOT NULL DEFAULT '',
+                zrodlo VARCHAR(50) NOT NULL DEFAULT '',
+                kwota_netto FLOAT NOT NULL DEFAULT 0,
+                kwota_brutto FLOAT NOT NULL DEFAULT 0,
+                ilosc FLOAT NOT NULL DEFAULT 0,
+                liczba INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (firma, miesiac, identyfikator, typ, produkt, waluta, kraj, zrodlo)
+            );
+        """))
         s.commit()
-        
-        # 2. Tworzymy tabelę transakcji na nowo
+    # Wypełnia je dopiero migracja zestawienie_miesieczne_po_pojezdzie (klucz identyfikator_clean)
+
+def migracja_zakres_danych(conn):
+    with conn.session as s:
+        s.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI_ZAKRESU} (
+                firma VARCHAR(50) NOT NULL DEFAULT '',
+                zrodlo VARCHAR(50) NOT NULL DEFAULT '',
+                data_min TIMESTAMP,
+                data_max TIMESTAMP,
+                liczba INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (firma, zrodlo)
+            );
+        """))
+        przelicz_zakres_danych(s)
+        s.commit()
+
+def migracja_identyfikator_clean(conn):
+    with conn.session as s:
+        s.execute(text(f"ALTER TABLE {NAZWA_SCHEMATU}.{NAZWA_TABELI} ADD COLUMN IF NOT EXISTS identyfikator_clean VARCHAR(255)"))
+        s.execute(text(f"""
+            CREATE INDEX IF NOT EXISTS idx_{NAZWA_TABELI}_clean_data ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} (identyfikator_clean, data_transakcji)
+        """))
+        s.commit()
+    przelicz_identyfikatory_clean(conn)
+
+def migracja_partycje_miesieczne(conn):
+    """
+    Jednorazowo (w jednej transakcji) przenosi transakcje do tabeli partycjonowanej; sekwencja id zostaje.
+    Unikalny indeks na tabeli partycjonowanej musi zawierać kolumnę partycjonowania, więc klucz naturalny to
+    (row_hash, data_transakcji) - data i tak wchodzi do row_hash, więc znaczenie klucza się nie zmienia.
+    """
+    stara = f"{NAZWA_TABELI}_przed_partycjami"
+    with conn.session as s:
+        rodzaj = s.execute(text("""
+            SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = :schemat AND c.relname = :tabela
+        """), {"schemat": NAZWA_SCHEMATU, "tabela": NAZWA_TABELI}).scalar()
+        if rodzaj == 'p':
+            return
+        sekwencja = s.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": f"{NAZWA_SCHEMATU}.{NAZWA_TABELI}"}).scalar()
+        s.execute(text(f"ALTER TABLE {NAZWA_SCHEMATU}.{NAZWA_TABELI} RENAME TO {stara}"))
+        s.execute(text(f"ALTER SEQUENCE {sekwencja} OWNED BY NONE"))
         s.execute(text(f"""
             CREATE TABLE {NAZWA_SCHEMATU}.{NAZWA_TABELI} (
-                id SERIAL PRIMARY KEY,
+                id INTEGER NOT NULL DEFAULT nextval('{sekwencja}'),
                 data_transakcji TIMESTAMP,
                 identyfikator VARCHAR(255),
                 kwota_netto FLOAT,
@@ -805,93 +2760,291 @@ def setup_database(conn):
                 waluta VARCHAR(10),
                 ilosc FLOAT,
                 produkt VARCHAR(255),
-                typ VARCHAR(50), 
+                typ VARCHAR(50),
                 zrodlo VARCHAR(50),
                 kraj VARCHAR(50),
                 firma VARCHAR(50),
-                kontrahent VARCHAR(255)
+                kontrahent VARCHAR(255),
+                row_hash CHAR(32),
+                identyfikator_clean VARCHAR(255)
+            ) PARTITION BY RANGE (data_transakcji);
+        """))
+        s.execute(text(f"ALTER SEQUENCE {sekwencja} OWNED BY {NAZWA_SCHEMATU}.{NAZWA_TABELI}.id"))
+        s.execute(text(f"CREATE TABLE {NAZWA_SCHEMATU}.{NAZWA_PARTYCJI_DOMYSLNEJ} PARTITION OF {NAZWA_SCHEMATU}.{NAZWA_TABELI} DEFAULT"))
+        daty = [r[0] for r in s.execute(text(f"""
+            SELECT DISTINCT date_trunc('month', data_transakcji) FROM {NAZWA_SCHEMATU}.{stara} WHERE data_transakcji IS NOT NULL
+        """))]
+        for miesiac in brakujace_partycje(daty, set()):
+            s.execute(text(sql_partycji_miesiaca(miesiac)))
+        kolumny = ', '.join(KOLUMNY_TRANSAKCJI)
+        s.execute(text(f"INSERT INTO {NAZWA_SCHEMATU}.{NAZWA_TABELI} ({kolumny}) SELECT {kolumny} FROM {NAZWA_SCHEMATU}.{stara}"))
+        s.execute(text(f"DROP TABLE {NAZWA_SCHEMATU}.{stara}"))
+        # Indeksy na tabeli głównej zakładają się na każdej partycji (także na nowych). BRIN na dacie zostaje
+        # jak w migracji indeksów - odcinanie partycji wybiera miesiące, BRIN zawęża zakres w obrębie miesiąca
+        s.execute(text(f"CREATE UNIQUE INDEX {INDEKS_KLUCZA_NATURALNEGO} ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} (row_hash, data_transakcji)"))
+        s.execute(text(f"CREATE INDEX idx_{NAZWA_TABELI}_firma_data ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} (firma, data_transakcji)"))
+        s.execute(text(f"CREATE INDEX idx_{NAZWA_TABELI}_typ_data ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} (typ, data_transakcji)"))
+        s.execute(text(f"CREATE INDEX idx_{NAZWA_TABELI}_clean_data ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} (identyfikator_clean, data_transakcji)"))
+        s.execute(text(f"CREATE INDEX idx_{NAZWA_TABELI}_data_brin ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} USING brin (data_transakcji)"))
+        s.commit()
+        s.execute(text(f"ANALYZE {NAZWA_SCHEMATU}.{NAZWA_TABELI}"))
+        s.commit()
+
+def migracja_wymiary(conn):
+    with conn.session as s:
+        s.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI_POJAZDOW} (
+                id SERIAL PRIMARY KEY,
+                nazwa VARCHAR(255) NOT NULL UNIQUE,
+                zakazany BOOLEAN,
+                operacyjny BOOLEAN,
+                firma_wlasciciel VARCHAR(50),
+                flota_od DATE,
+                wersja_flag VARCHAR(12)
             );
         """))
-        
-        # 3. Tworzymy tabelę ustawień (app_settings) na nowo
+        nazwy = [r[0] for r in s.execute(text(f"""
+            SELECT DISTINCT identyfikator_clean FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} WHERE identyfikator_clean IS NOT NULL
+        """))]
+        zapisz_pojazdy(s, nazwy)
+        s.commit()
+
+def migracja_zestawienie_dzienne(conn):
+    with conn.session as s:
         s.execute(text(f"""
-            CREATE TABLE {NAZWA_SCHEMATU}.app_settings (
-                setting_key VARCHAR(50) PRIMARY KEY,
-                setting_value TEXT
+            CREATE TABLE IF NOT EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI_DZIENNEJ} (
+                firma VARCHAR(50) NOT NULL DEFAULT '',
+                dzien DATE NOT NULL,
+                identyfikator_clean VARCHAR(255) NOT NULL DEFAULT '',
+                typ VARCHAR(50) NOT NULL DEFAULT '',
+                waluta VARCHAR(10) NOT NULL DEFAULT '',
+                zrodlo VARCHAR(50) NOT NULL DEFAULT '',
+                kwota_netto FLOAT NOT NULL DEFAULT 0,
+                kwota_brutto FLOAT NOT NULL DEFAULT 0,
+                ilosc FLOAT NOT NULL DEFAULT 0,
+                liczba INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (firma, dzien, identyfikator_clean, typ, waluta, zrodlo)
             );
         """))
         s.commit()
-def setup_file_database(conn):
-    try:
+    przebuduj_zestawienie_miesieczne(conn, tabele=[NAZWA_TABELI_DZIENNEJ])
+
+def migracja_brin_po_partycjach(conn):
+    # Bazy przeniesione do partycji przed dodaniem BRIN do migracji partycji - indeks na tabeli głównej
+    # zakłada się na wszystkich partycjach
+    with conn.session as s:
+        s.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{NAZWA_TABELI}_data_brin ON {NAZWA_SCHEMATU}.{NAZWA_TABELI} USING brin (data_transakcji)"))
+        s.commit()
+
+def migracja_zestawienie_miesieczne_po_pojezdzie(conn):
+    # Zestawienie w kluczu surowego identyfikatora zastępuje to samo w kluczu pojazdu (identyfikator_clean)
+    with conn.session as s:
+        s.execute(text(f"DROP TABLE IF EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI_MIESIECZNEJ}"))
+        s.execute(text(f"""
+            CREATE TABLE {NAZWA_SCHEMATU}.{NAZWA_TABELI_MIESIECZNEJ} (
+                firma VARCHAR(50) NOT NULL DEFAULT '',
+                miesiac DATE NOT NULL,
+                identyfikator_clean VARCHAR(255) NOT NULL DEFAULT '',
+                typ VARCHAR(50) NOT NULL DEFAULT '',
+                produkt VARCHAR(255) NOT NULL DEFAULT '',
+                waluta VARCHAR(10) NOT NULL DEFAULT '',
+                kraj VARCHAR(50) NOT NULL DEFAULT '',
+                zrodlo VARCHAR(50) NOT NULL DEFAULT '',
+                kwota_netto FLOAT NOT NULL DEFAULT 0,
+                kwota_brutto FLOAT NOT NULL DEFAULT 0,
+                ilosc FLOAT NOT NULL DEFAULT 0,
+                liczba INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (firma, miesiac, identyfikator_clean, typ, produkt, waluta, kraj, zrodlo)
+            );
+        """))
+        s.commit()
+    przebuduj_zestawienie_miesieczne(conn, tabele=[NAZWA_TABELI_MIESIECZNEJ])
+
+def migracja_status_rejestru_plikow(conn):
+    # Wpisy sprzed statusu są po pełnym zapisie (rejestr powstawał dopiero na końcu)
+    with conn.session as s:
+        s.execute(text(f"""
+            ALTER TABLE {NAZWA_SCHEMATU}.{NAZWA_TABELI_REJESTRU}
+            ADD COLUMN IF NOT EXISTS status VARCHAR(20) NOT NULL DEFAULT '{STATUS_PLIKU_ZAPISANY}'
+        """))
+        s.commit()
+
+MIGRACJE = [
+    (1, "tabele_podstawowe", migracja_tabele_podstawowe),
+    (2, "rejestr_plikow_i_row_hash", migracja_rejestr_plikow),
+    (3, "unikalny_klucz_naturalny", migracja_klucz_naturalny),
+    (4, "rejestr_kart", zapewnij_rejestr_kart),
+    (5, "indeksy_dat", migracja_indeksy_dat),
+    (6, "zestawienie_miesieczne", migracja_zestawienie_miesieczne),
+    (7, "zakres_danych", migracja_zakres_danych),
+    (8, "identyfikator_clean", migracja_identyfikator_clean),
+    (9, "partycje_miesieczne", migracja_partycje_miesieczne),
+    (10, "wymiary", migracja_wymiary),
+    (11, "zestawienie_dzienne", migracja_zestawienie_dzienne),
+    (12, "brin_po_partycjach", migracja_brin_po_partycjach),
+    (13, "zestawienie_miesieczne_po_pojezdzie", migracja_zestawienie_miesieczne_po_pojezdzie),
+    (14, "status_rejestru_plikow", migracja_status_rejestru_plikow),
+]
+
+def zastosuj_migracje(conn):
+    """Wykonuje po kolei migracje, których nie ma jeszcze w schema_migrations. Zwraca nazwy wykonanych."""
+    with conn.session as s:
+        s.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI_MIGRACJI} (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255),
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """))
+        s.commit()
+        wykonane = {r[0] for r in s.execute(text(f"SELECT version FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_MIGRACJI}"))}
+    nowe = []
+    for wersja, nazwa, migracja in MIGRACJE:
+        if wersja in wykonane:
+            continue
+        migracja(conn)
         with conn.session as s:
-            s.execute(text(f"DROP TABLE IF EXISTS {NAZWA_SCHEMATU}.{NAZWA_TABELI_PLIKOW}"))
-            s.commit()
             s.execute(text(f"""
-                CREATE TABLE {NAZWA_SCHEMATU}.{NAZWA_TABELI_PLIKOW} (
-                    file_name VARCHAR(255) PRIMARY KEY,
-                    file_data BYTEA,
-                    uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """))
+                INSERT INTO {NAZWA_SCHEMATU}.{NAZWA_TABELI_MIGRACJI} (version, name) VALUES (:v, :n)
+                ON CONFLICT (version) DO NOTHING
+            """), {"v": wersja, "n": nazwa})
             s.commit()
-        st.success(f"SUKCES: Tabela '{NAZWA_TABELI_PLIKOW}' została utworzona na nowo!")
-    except Exception as e:
-        st.error(f"BŁĄD przy tworzeniu tabeli: {e}")
+        nowe.append(nazwa)
+    return nowe
 
-def wyczysc_duplikaty(conn):
-    st.write("Czyszczenie duplikatów...")
+def setup_database(conn):
+    """Czyści transakcje, ustawienia i rejestr plików (UWAGA: TO KASUJE DANE!). Tabele i indeksy zostają."""
+    zastosuj_migracje(conn)
     with conn.session as s:
         s.execute(text(f"""
-        DELETE FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} a
-        WHERE a.ctid <> (
-            SELECT min(b.ctid)
-            FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} b
-            WHERE a.data_transakcji = b.data_transakcji
-              AND a.identyfikator = b.identyfikator
-              AND a.kwota_brutto = b.kwota_brutto
-              AND a.waluta = b.waluta
-              AND a.produkt = b.produkt
-              AND a.firma = b.firma
-        );
+            TRUNCATE {NAZWA_SCHEMATU}.{NAZWA_TABELI}, {NAZWA_SCHEMATU}.app_settings, {NAZWA_SCHEMATU}.{NAZWA_TABELI_REJESTRU},
+                     {NAZWA_SCHEMATU}.{NAZWA_TABELI_MIESIECZNEJ}, {NAZWA_SCHEMATU}.{NAZWA_TABELI_DZIENNEJ},
+                     {NAZWA_SCHEMATU}.{NAZWA_TABELI_ZAKRESU}
+            RESTART IDENTITY
         """))
         s.commit()
+
+def setup_file_database(conn):
+    try:
+        zastosuj_migracje(conn)
+        with conn.session as s:
+            s.execute(text(f"TRUNCATE {NAZWA_SCHEMATU}.{NAZWA_TABELI_PLIKOW}"))
+            s.commit()
+        st.success(f"SUKCES: Tabela '{NAZWA_TABELI_PLIKOW}' została wyczyszczona!")
+    except Exception as e:
+        st.error(f"BŁĄD przy czyszczeniu tabeli: {e}")
+
 def wyczysc_wynagrodzenia(conn):
     st.write("Usuwanie danych o wynagrodzeniach...")
     try:
         with conn.session as s:
             # Usuwamy tylko rekordy gdzie typ to 'WYNAGRODZENIE'
             s.execute(text(f"DELETE FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} WHERE typ = 'WYNAGRODZENIE'"))
+            for tabela in ZESTAWIENIA:
+                s.execute(text(f"DELETE FROM {NAZWA_SCHEMATU}.{tabela} WHERE typ = 'WYNAGRODZENIE'"))
+            przelicz_zakres_danych(s)
             s.commit()
         st.success("✅ Pomyślnie usunięto wszystkie wynagrodzenia z bazy.")
         time.sleep(1)
         st.rerun()
     except Exception as e:
         st.error(f"Błąd podczas usuwania wynagrodzeń: {e}")
-def pobierz_dane_z_bazy(conn, data_start, data_stop, wybrana_firma, typ=None):
-    params = {"data_start": data_start, "data_stop": data_stop, "firma": wybrana_firma}
-    base_query = f"""
-        SELECT * FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI}
-        WHERE (data_transakcji::date) >= :data_start 
-          AND (data_transakcji::date) <= :data_stop
+ZRODLA_KART_PALIWOWYCH = ['Eurowag', 'E100_PL', 'E100_EN']
+KOLUMNY_TRANSAKCJI = ['id', 'data_transakcji', 'identyfikator', 'kwota_netto', 'kwota_brutto', 'waluta', 'ilosc',
+                      'produkt', 'typ', 'zrodlo', 'kraj', 'firma', 'kontrahent', 'row_hash', 'identyfikator_clean']
+# Typy kolumn wyniku - nadawane w pd.read_sql, więc w cache conn.query leży już gotowa, otypowana ramka
+TYPY_KOLUMN_TRANSAKCJI = {
+    'kwota_netto': 'float64', 'kwota_brutto': 'float64', 'ilosc': 'float64',
+    'firma': 'category', 'typ': 'category', 'zrodlo': 'category', 'waluta': 'category', 'kraj': 'category',
+}
+# Wiersze na paczkę przy strumieniowym odczycie (czytaj_transakcje_paczkami) i na stronę podglądu transakcji pojazdu
+ROZMIAR_PACZKI_ODCZYTU = 50000
+ROZMIAR_STRONY_SZCZEGOLOW = 200
+# Kolumny, z których korzystają widoki kosztów (Raport, Rentowność, Refaktury, Porównanie)
+KOLUMNY_WIDOKU_KOSZTOW = ['data_transakcji', 'identyfikator', 'identyfikator_clean', 'kwota_netto', 'kwota_brutto', 'waluta',
+                          'ilosc', 'produkt', 'typ', 'zrodlo', 'kraj', 'firma']
+
+def zakres_dat_sql(data_start, data_stop):
+    """Półotwarty zakres [start, stop + 1 dzień) - porównanie wprost na data_transakcji może iść po indeksie."""
+    poczatek = pd.Timestamp(data_start).normalize()
+    return poczatek.to_pydatetime(), (pd.Timestamp(data_stop).normalize() + pd.Timedelta(days=1)).to_pydatetime()
+
+def zapytanie_transakcji_firmy(lista_kolumn, warunek, wybrana_firma, tabela=NAZWA_TABELI):
+    """
+    SELECT transakcji firmy (parametr :firma) spełniających `warunek`; dla UNIX-TRANS z gałęzią kart HOLIER.
+    `tabela` - transakcje albo zestawienie miesięczne (ma te same kolumny firma/zrodlo).
+    """
+    query = f"""
+        SELECT {lista_kolumn} FROM {NAZWA_SCHEMATU}.{tabela}
+        WHERE firma = :firma AND {warunek}
     """
     if wybrana_firma == "UNIX-TRANS":
-        condition = """
-          AND (
-            firma = :firma 
-            OR (zrodlo IN ('Eurowag', 'E100_PL', 'E100_EN') AND firma = 'HOLIER')
-          )
+        # Karty paliwowe wgrane na HOLIER - osobna gałąź UNION ALL zamiast OR, żeby każda szła po indeksie (firma, data)
+        zrodla = ", ".join(f"'{z}'" for z in ZRODLA_KART_PALIWOWYCH)
+        query += f"""
+        UNION ALL
+        SELECT {lista_kolumn} FROM {NAZWA_SCHEMATU}.{tabela}
+        WHERE firma = 'HOLIER' AND zrodlo IN ({zrodla}) AND {warunek}
         """
-    else:
-        condition = " AND firma = :firma"
+    return query
 
-    query = base_query + condition
+def zapytanie_pobierania(data_start, data_stop, wybrana_firma, typ=None, kolumny=None, identyfikatory=None, pojazd=None, przed=None):
+    """
+    Zapytanie, parametry i lista kolumn dla pobierz_dane_z_bazy / czytaj_transakcje_paczkami.
+    `przed` - klucz (data_transakcji, id): tylko wiersze starsze od niego (stronicowanie po kluczu).
+    """
+    kolumny = kolumny or KOLUMNY_TRANSAKCJI
+    nieznane = [k for k in kolumny if k not in KOLUMNY_TRANSAKCJI]
+    if nieznane:
+        raise ValueError(f"Nieznane kolumny transakcji: {nieznane}")
+    data_od, data_do = zakres_dat_sql(data_start, data_stop)
+    params = {"data_od": data_od, "data_do": data_do, "firma": wybrana_firma}
+    warunek = "data_transakcji >= :data_od AND data_transakcji < :data_do"
     if typ:
-        query += " AND typ = :typ"
+        warunek += " AND typ = :typ"
         params["typ"] = typ
-        
-    df = conn.query(query, params=params)
+    if identyfikatory is not None:
+        params["identyfikatory"] = [str(i) for i in identyfikatory if pd.notna(i)]
+        warunki_id = ["identyfikator = ANY(CAST(:identyfikatory AS TEXT[]))"]
+        if len(params["identyfikatory"]) < len(identyfikatory):
+            warunki_id.append("identyfikator IS NULL")
+        warunek += f" AND ({' OR '.join(warunki_id)})"
+    if pojazd is not None:
+        warunek += " AND identyfikator_clean = :pojazd"
+        params["pojazd"] = pojazd
+    if przed is not None:
+        warunek += " AND (data_transakcji, id) < (:przed_data, :przed_id)"
+        params["przed_data"], params["przed_id"] = przed
+    return zapytanie_transakcji_firmy(", ".join(kolumny), warunek, wybrana_firma), params, kolumny
+
+def typy_odczytu(kolumny):
+    """Argumenty parse_dates/dtype dla pd.read_sql - ramka jest otypowana już przy odczycie."""
+    return {
+        "parse_dates": ['data_transakcji'] if 'data_transakcji' in kolumny else None,
+        "dtype": {k: t for k, t in TYPY_KOLUMN_TRANSAKCJI.items() if k in kolumny},
+    }
+
+def pobierz_dane_z_bazy(conn, data_start, data_stop, wybrana_firma, typ=None, kolumny=None, identyfikatory=None, pojazd=None):
+    """
+    Transakcje firmy z zakresu dat. `kolumny` - lista potrzebnych kolumn (domyślnie wszystkie),
+    `identyfikatory` - opcjonalnie tylko te surowe identyfikatory (NaN na liście = także wiersze bez identyfikatora),
+    `pojazd` - opcjonalnie tylko ten oczyszczony identyfikator (indeks na identyfikator_clean).
+    Wynik jest otypowany: data_transakcji datetime64, kwoty/ilość float64, firma/typ/zrodlo/waluta/kraj category.
+    """
+    query, params, kolumny = zapytanie_pobierania(data_start, data_stop, wybrana_firma, typ, kolumny, identyfikatory, pojazd)
+    df = conn.query(query, params=params, **typy_odczytu(kolumny))
     return df
 
+def czytaj_transakcje_paczkami(conn, data_start, data_stop, wybrana_firma, typ=None, kolumny=None, rozmiar_paczki=ROZMIAR_PACZKI_ODCZYTU):
+    """
+    To samo co pobierz_dane_z_bazy, ale strumieniowo: kursor po stronie serwera (stream_results) oddaje
+    otypowane ramki po `rozmiar_paczki` wierszy, więc w pamięci jest naraz jedna paczka, a nie cały zakres.
+    Bez cache - do szerokich zakresów, które i tak są od razu zwijane.
+    """
+    query, params, kolumny = zapytanie_pobierania(data_start, data_stop, wybrana_firma, typ, kolumny)
+    with conn.engine.connect().execution_options(stream_results=True, max_row_buffer=rozmiar_paczki) as polaczenie:
+        yield from pd.read_sql(text(query), polaczenie, params=params, chunksize=rozmiar_paczki, **typy_odczytu(kolumny))
+
 def zapisz_plik_w_bazie(conn, file_name, file_bytes):
     try:
         if not isinstance(file_bytes, bytes):
@@ -945,9 +3098,25 @@ def usun_plik_z_bazy(conn, file_name):
         st.error(f"Błąd podczas usuwania pliku z bazy: {e}")
 
 # --- CZYSZCZENIE KLUCZA ---
+# Wynik czyszczenia jest zapisywany w transactions.identyfikator_clean przy każdym zapisie. Po zmianie
+# UNIX_ALIAS_MAPPING, FIRMY_DO_USUNIECIA albo WERSJA_LOGIKI_KLUCZA zmienia się WERSJA_REGUL_KLUCZA
+# i przy starcie aplikacji przelicz_identyfikatory_clean poprawia zapisane wartości.
+# WERSJA_LOGIKI_KLUCZA podbijamy przy KAŻDEJ zmianie clean_key (warunki, wyrażenie regularne, prefiks PL).
+WERSJA_LOGIKI_KLUCZA = 1
+FIRMY_DO_USUNIECIA = [
+    'TRUCK24SP', 'TRUCK24', 'EDENRED', 'MARMAR', 'SANTANDER', 
+    'LEASING', 'PZU', 'WARTA', 'INTERCARS', 'EUROWAG', 'E100', 'POLSKA', 'BANK'
+]
+WERSJA_REGUL_KLUCZA = hashlib.md5(
+    json.dumps([WERSJA_LOGIKI_KLUCZA, UNIX_ALIAS_MAPPING, FIRMY_DO_USUNIECIA], sort_keys=True).encode('utf-8')
+).hexdigest()[:12]
+KLUCZ_WERSJI_REGUL_KLUCZA = "identyfikator_clean_wersja"
+
 def bezpieczne_czyszczenie_klucza(s_identyfikatorow):
-    s_str = s_identyfikatorow.astype(str)
+    # Brak identyfikatora (NULL/NaN) traktujemy jak tekst 'nan'
+    s_str = s_identyfikatorow.astype(object).where(s_identyfikatorow.notna(), 'nan').astype(str)
     
+    # Każda zmiana tej funkcji = podbicie WERSJA_LOGIKI_KLUCZA (inaczej zapisane identyfikator_clean zostaną stare)
     def clean_key(key):
         if key == 'nan' or not key or key == 'Brak Pojazdu': 
             return 'Brak Identyfikatora'
@@ -957,11 +3126,6 @@ def bezpieczne_czyszczenie_klucza(s_identyfikatorow):
         if key_nospace in UNIX_ALIAS_MAPPING:
             return UNIX_ALIAS_MAPPING[key_nospace]
             
-        FIRMY_DO_USUNIECIA = [
-            'TRUCK24SP', 'TRUCK24', 'EDENRED', 'MARMAR', 'SANTANDER', 
-            'LEASING', 'PZU', 'WARTA', 'INTERCARS', 'EUROWAG', 'E100', 'POLSKA', 'BANK'
-        ]
-        
         for firma in FIRMY_DO_USUNIECIA:
             if firma in key_nospace:
                 return 'Brak Identyfikatora'
@@ -986,11 +3150,186 @@ def bezpieczne_czyszczenie_klucza(s_identyfikatorow):
              return key_nospace
              
         return 'Brak Identyfikatora'
-            
-    return s_str.apply(clean_key)
+    
+    # Każdy identyfikator czyścimy raz - w ramce powtarza się zwykle kilkaset razy
+    return s_str.map({k: clean_key(k) for k in s_str.unique()})
+
+def identyfikatory_clean(df):
+    """Kolumna identyfikator_clean z bazy; wiersze bez niej (np. ramki spoza bazy) są czyszczone na miejscu."""
+    if 'identyfikator_clean' not in df.columns:
+        return bezpieczne_czyszczenie_klucza(df['identyfikator'])
+    wynik = df['identyfikator_clean'].astype(object)
+    brak = wynik.isna()
+    if brak.any():
+        wynik[brak] = bezpieczne_czyszczenie_klucza(df.loc[brak, 'identyfikator'])
+    return wynik
+
+def przelicz_identyfikatory_clean(conn):
+    """
+    Backfill identyfikator_clean: różne identyfikatory (kilka tysięcy) są czyszczone w Pythonie, a poprawki idą
+    jednym UPDATE ... FROM unnest(...) na transakcjach. Zapisuje wersję reguł. Zwraca liczbę poprawionych rekordów.
+    """
+    with conn.session as s:
+        pary = pd.DataFrame(s.execute(text(f"""
+            SELECT DISTINCT identyfikator, identyfikator_clean FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI}
+        """)).fetchall(), columns=['identyfikator', 'identyfikator_clean'])
+    pary['nowy'] = bezpieczne_czyszczenie_klucza(pary['identyfikator'])
+    pary = pary[pary['nowy'] != pary['identyfikator_clean']].drop_duplicates('identyfikator')
+    z_identyfikatorem = pary[pary['identyfikator'].notna()]
+    bez_identyfikatora = pary[pary['identyfikator'].isna()]
+    with conn.session as s:
+        poprawione = s.execute(text(f"""
+            UPDATE {NAZWA_SCHEMATU}.{NAZWA_TABELI} t SET identyfikator_clean = v.identyfikator_clean
+            FROM (SELECT unnest(CAST(:identyfikatory AS TEXT[])) AS identyfikator,
+                         unnest(CAST(:oczyszczone AS TEXT[])) AS identyfikator_clean) v
+            WHERE t.identyfikator = v.identyfikator AND t.identyfikator_clean IS DISTINCT FROM v.identyfikator_clean
+        """), {"identyfikatory": z_identyfikatorem['identyfikator'].tolist(),
+               "oczyszczone": z_identyfikatorem['nowy'].tolist()}).rowcount
+        if not bez_identyfikatora.empty:
+            poprawione += s.execute(text(f"""
+                UPDATE {NAZWA_SCHEMATU}.{NAZWA_TABELI} SET identyfikator_clean = :oczyszczony
+                WHERE identyfikator IS NULL AND identyfikator_clean IS DISTINCT FROM :oczyszczony
+            """), {"oczyszczony": bez_identyfikatora['nowy'].iloc[0]}).rowcount
+        if poprawione:
+            zapisz_pojazdy(s, pary['nowy'].dropna().unique())
+            # Zestawienia są w kluczu pojazdu - kwoty przechodzą do nowych pojazdów
+            tabele = zestawienia_pojazdow(s)
+            if tabele:
+                przelicz_zestawienie(s, tabele=tabele)
+        s.commit()
+    if poprawione:
+        pobierz_kostke_kosztow.clear()
+    zapisz_ustawienie(conn, KLUCZ_WERSJI_REGUL_KLUCZA, WERSJA_REGUL_KLUCZA)
+    return poprawione
+
+def zapewnij_aktualne_identyfikatory(conn):
+    """Backfill tylko wtedy, gdy reguły czyszczenia zmieniły się od ostatniego przeliczenia."""
+    if pobierz_ustawienie(conn, KLUCZ_WERSJI_REGUL_KLUCZA) != WERSJA_REGUL_KLUCZA:
+        return przelicz_identyfikatory_clean(conn)
+    return 0
+
+def klucz_pojazdu_floty(identyfikatory_clean):
+    return identyfikatory_clean.astype(str).str.upper().str.replace(" ", "").str.replace("-", "")
+
+def maska_firmy_kontekstu(pojazd, firma, po_starcie_floty, firma_kontekst):
+    """
+    Które koszty należą do firmy z kontekstu. Pojazd z UNIX_FLOTA_CONFIG od daty wejścia do floty jest kosztem
+    UNIX-TRANS także wtedy, gdy zapłacił HOLIER; UNIX-TRANS widzi poza tym tylko swoje pojazdy (i osobowe).
+    """
+    w_flocie = pojazd.isin(list(UNIX_FLOTA_CONFIG))
+    if firma_kontekst == "UNIX-TRANS":
+        osobowy = pojazd.str.contains('TRUCK_OSOBOWY|TRUCKOSOBOWY|KACPER', regex=True)
+        return ((firma == 'UNIX-TRANS') & (w_flocie | osobowy)) | ((firma == 'HOLIER') & w_flocie & po_starcie_floty)
+    if firma_kontekst == "HOLIER":
+        return ~(w_flocie & po_starcie_floty)
+    return pd.Series(True, index=pojazd.index)
+
+# --- WYMIAR POJAZDÓW ---
+# Słownik pojazdów (identyfikator_clean) z policzonymi raz na pojazd flagami - raporty czytają flagi zamiast
+# liczyć reguły wiersz po wierszu. Przy zmianie reguł zmienia się WERSJA_FLAG_POJAZDOW
+# i uzupelnij_flagi_pojazdow liczy je od nowa.
+NAZWA_TABELI_POJAZDOW = "dim_pojazdy"
+# Frazy, które DEFINITYWNIE oznaczają koszt ogólny/biurowy (klasyfikuj_wpis)
+SLOWA_KOSZTOW_OGOLNYCH = [
+    'ZALICZKA', 'KACPER', 'BIURO', 'KSIĘGOWOŚĆ', 'PROWIZJA', 
+    'OPŁATA BANKOWA', 'INTERCARS', 'SANTANDER', 'LEASING', 
+    'UBEZPIECZENIE', 'WARTA', 'PZU', 'POCZTA', 'TELEFON'
+]
+WERSJA_FLAG_POJAZDOW = hashlib.md5(
+    json.dumps([ZAKAZANE_POJAZDY_LISTA, UNIX_ALIAS_MAPPING, UNIX_FLOTA_CONFIG, SLOWA_KOSZTOW_OGOLNYCH], sort_keys=True, default=str).encode('utf-8')
+).hexdigest()[:12]
+
+def flagi_pojazdow(nazwy):
+    """
+    Flagi wymiaru pojazdów: zakazany (czy_zakazany_pojazd_global), operacyjny (klasyfikuj_wpis),
+    firma_wlasciciel i flota_od dla floty UNIX (UNIX_FLOTA_CONFIG). Reguły liczone raz na pojazd.
+    """
+    nazwy = pd.Series(list(nazwy), dtype=object)
+    klucz = klucz_pojazdu_floty(nazwy)
+    return pd.DataFrame({
+        'nazwa': nazwy,
+        'zakazany': nazwy.map(czy_zakazany_pojazd_global).astype(bool),
+        'operacyjny': nazwy.map(klasyfikuj_wpis).astype(bool),
+        'firma_wlasciciel': klucz.map(lambda k: "UNIX-TRANS" if k in UNIX_FLOTA_CONFIG else None),
+        'flota_od': klucz.map(UNIX_FLOTA_CONFIG),
+    })
+
+def uzupelnij_flagi_pojazdow(s):
+    """Liczy flagi pojazdów bez flag albo z flagami ze starszej wersji reguł. Zwraca liczbę przeliczonych."""
+    nazwy = [r[0] for r in s.execute(text(f"""
+        SELECT nazwa FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_POJAZDOW} WHERE wersja_flag IS DISTINCT FROM :wersja
+    """), {"wersja": WERSJA_FLAG_POJAZDOW})]
+    if not nazwy:
+        return 0
+    flagi = flagi_pojazdow(nazwy)
+    s.execute(text(f"""
+        UPDATE {NAZWA_SCHEMATU}.{NAZWA_TABELI_POJAZDOW} p
+        SET zakazany = v.zakazany, operacyjny = v.operacyjny, firma_wlasciciel = v.firma_wlasciciel,
+            flota_od = v.flota_od, wersja_flag = :wersja
+        FROM (SELECT unnest(CAST(:nazwy AS TEXT[])) AS nazwa, unnest(CAST(:zakazane AS BOOLEAN[])) AS zakazany,
+                     unnest(CAST(:operacyjne AS BOOLEAN[])) AS operacyjny, unnest(CAST(:firmy AS TEXT[])) AS firma_wlasciciel,
+                     unnest(CAST(:od AS DATE[])) AS flota_od) v
+        WHERE p.nazwa = v.nazwa
+    """), {
+        "wersja": WERSJA_FLAG_POJAZDOW, "nazwy": flagi['nazwa'].tolist(),
+        "zakazane": flagi['zakazany'].tolist(), "operacyjne": flagi['operacyjny'].tolist(),
+        "firmy": flagi['firma_wlasciciel'].tolist(),
+        "od": [None if pd.isna(d) else d for d in flagi['flota_od']],
+    })
+    return len(nazwy)
+
+def zapisz_pojazdy(s, nazwy):
+    """Dopisuje do wymiaru pojazdów brakujące nazwy razem z flagami (gdy tabeli jeszcze nie ma - nic)."""
+    if not tabela_istnieje(s, NAZWA_TABELI_POJAZDOW):
+        return 0
+    nazwy = [n for n in pd.unique(pd.Series(list(nazwy), dtype=object)) if isinstance(n, str)]
+    if not nazwy:
+        return 0
+    flagi = flagi_pojazdow(nazwy)
+    wynik = s.execute(text(f"""
+        INSERT INTO {NAZWA_SCHEMATU}.{NAZWA_TABELI_POJAZDOW} (nazwa, zakazany, operacyjny, firma_wlasciciel, flota_od, wersja_flag)
+        SELECT unnest(CAST(:nazwy AS TEXT[])), unnest(CAST(:zakazane AS BOOLEAN[])), unnest(CAST(:operacyjne AS BOOLEAN[])),
+               unnest(CAST(:firmy AS TEXT[])), unnest(CAST(:od AS DATE[])), :wersja
+        ON CONFLICT (nazwa) DO NOTHING
+    """), {
+        "wersja": WERSJA_FLAG_POJAZDOW, "nazwy": flagi['nazwa'].tolist(),
+        "zakazane": flagi['zakazany'].tolist(), "operacyjne": flagi['operacyjny'].tolist(),
+        "firmy": flagi['firma_wlasciciel'].tolist(),
+        "od": [None if pd.isna(d) else d for d in flagi['flota_od']],
+    })
+    return wynik.rowcount
+
+def zapewnij_aktualne_wymiary(conn):
+    with conn.session as s:
+        przeliczone = uzupelnij_flagi_pojazdow(s)
+        s.commit()
+    return przeliczone
+
+def pobierz_flagi_pojazdow(conn):
+    """Wymiar pojazdów (indeks: identyfikator_clean); pusta ramka, gdy tabeli jeszcze nie ma."""
+    try:
+        return conn.query(f"""
+            SELECT nazwa, zakazany, operacyjny, firma_wlasciciel, flota_od FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI_POJAZDOW}
+        """, ttl=0).set_index('nazwa')
+    except Exception:
+        return pd.DataFrame()
+
+def flaga_pojazdow(pojazdy, flagi, kolumna, regula):
+    """
+    Flaga `kolumna` z wymiaru pojazdów dla każdej pozycji `pojazdy` (tablica bool). Pojazdy spoza wymiaru
+    (np. z pliku przychodów) albo jeszcze bez flag liczy `regula` - raz na pojazd.
+    """
+    pojazdy = pd.Series(list(pojazdy), dtype=object)
+    mapa = flagi[kolumna].dropna().to_dict() if kolumna in flagi.columns else {}
+    mapa.update({p: regula(p) for p in pojazdy.unique() if p not in mapa})
+    return pojazdy.map(mapa).to_numpy(dtype=bool)
 
 # --- POPRAWIONA FUNKCJA PRZYGOTOWANIA DANYCH ---
-def przygotuj_dane_paliwowe(dane_z_bazy, firma_kontekst=None):
+def przygotuj_dane_paliwowe(dane_z_bazy, firma_kontekst=None, kurs_eur=None, mapa_kursow=None):
+    """
+    `kurs_eur` i `mapa_kursow` - opcjonalnie wspólne dla kolejnych paczek tego samego zakresu: kurs nie jest
+    wtedy pobierany ponownie, a mapa (uzupełniana w miejscu) dociąga tylko waluty, których jeszcze nie ma.
+    """
     if dane_z_bazy.empty:
         return dane_z_bazy, None
     
@@ -1006,54 +3345,38 @@ def przygotuj_dane_paliwowe(dane_z_bazy, firma_kontekst=None):
         return pd.DataFrame(), None
 
     # Pobieramy kurs
-    kurs_eur = pobierz_kurs_eur_pln()
+    if not kurs_eur: kurs_eur = pobierz_kurs_eur_pln()
     if not kurs_eur: kurs_eur = 4.30 # Fallback
     
-    mapa_kursow = {}
+    if mapa_kursow is None: mapa_kursow = {}
     
     # --- A. PRZETWARZANIE PALIWA I OPŁAT ---
     if not dane_paliwo.empty:
-        dane_paliwo['data_transakcji_dt'] = pd.to_datetime(dane_paliwo['data_transakcji'])
-        dane_paliwo['identyfikator_clean'] = bezpieczne_czyszczenie_klucza(dane_paliwo['identyfikator'])
+        dane_paliwo['data_transakcji_dt'] = dane_paliwo['data_transakcji']
+        dane_paliwo['identyfikator_clean'] = identyfikatory_clean(dane_paliwo)
         
         # Filtrowanie firm (Unix/Holier)
-        if firma_kontekst == "UNIX-TRANS":
-            def filter_unix(row):
-                pojazd = str(row['identyfikator_clean']).upper().replace(" ", "").replace("-", "")
-                if row['firma'] == 'UNIX-TRANS':
-                    if pojazd in UNIX_FLOTA_CONFIG: return True
-                    if 'TRUCK_OSOBOWY' in pojazd or 'TRUCKOSOBOWY' in pojazd or 'KACPER' in pojazd: return True
-                    else: return False
-                if row['firma'] == 'HOLIER':
-                    if pojazd in UNIX_FLOTA_CONFIG:
-                        data_tr = row['data_transakcji_dt'].date()
-                        start_date = UNIX_FLOTA_CONFIG[pojazd]
-                        if data_tr >= start_date: return True
-                return False
-            dane_paliwo = dane_paliwo[dane_paliwo.apply(filter_unix, axis=1)]
-        
-        elif firma_kontekst == "HOLIER":
-            def filter_holier(row):
-                pojazd = str(row['identyfikator_clean']).upper().replace(" ", "").replace("-", "")
-                if pojazd in UNIX_FLOTA_CONFIG:
-                    data_tr = row['data_transakcji_dt'].date()
-                    start_date = UNIX_FLOTA_CONFIG[pojazd]
-                    if data_tr >= start_date: return False
-                return True
-            dane_paliwo = dane_paliwo[dane_paliwo.apply(filter_holier, axis=1)]
+        if firma_kontekst in ("UNIX-TRANS", "HOLIER"):
+            pojazd = klucz_pojazdu_floty(dane_paliwo['identyfikator_clean'])
+            start_floty = pd.to_datetime(pojazd.map(UNIX_FLOTA_CONFIG))
+            po_starcie_floty = dane_paliwo['data_transakcji_dt'].dt.normalize() >= start_floty
+            dane_paliwo = dane_paliwo[maska_firmy_kontekstu(pojazd, dane_paliwo['firma'], po_starcie_floty, firma_kontekst)]
 
         # --- POPRAWKA: Inicjalizacja kolumn nawet jak puste po filtracji ---
         if not dane_paliwo.empty:
             if 'kraj' not in dane_paliwo.columns: dane_paliwo['kraj'] = 'Nieznany'
             
-            unikalne_waluty = dane_paliwo['waluta'].unique()
-            mapa_kursow = pobierz_wszystkie_kursy(unikalne_waluty, kurs_eur)
+            brakujace_waluty = [w for w in dane_paliwo['waluta'].unique() if w not in mapa_kursow]
+            if brakujace_waluty:
+                mapa_kursow.update(pobierz_wszystkie_kursy(brakujace_waluty, kurs_eur))
             
-            dane_paliwo['kwota_netto_num'] = pd.to_numeric(dane_paliwo['kwota_netto'], errors='coerce').fillna(0.0)
-            dane_paliwo['kwota_brutto_num'] = pd.to_numeric(dane_paliwo['kwota_brutto'], errors='coerce').fillna(0.0)
+            # Kwoty przychodzą z bazy jako float64 - bez ponownego pd.to_numeric
+            dane_paliwo['kwota_netto_num'] = dane_paliwo['kwota_netto'].fillna(0.0)
+            dane_paliwo['kwota_brutto_num'] = dane_paliwo['kwota_brutto'].fillna(0.0)
             
-            dane_paliwo['kwota_netto_eur'] = dane_paliwo.apply(lambda row: row['kwota_netto_num'] * mapa_kursow.get(row['waluta'], 0.0), axis=1)
-            dane_paliwo['kwota_brutto_eur'] = dane_paliwo.apply(lambda row: row['kwota_brutto_num'] * mapa_kursow.get(row['waluta'], 0.0), axis=1)
+            kurs_waluty = dane_paliwo['waluta'].astype(object).map(mapa_kursow).astype(float).fillna(0.0)
+            dane_paliwo['kwota_netto_eur'] = dane_paliwo['kwota_netto_num'] * kurs_waluty
+            dane_paliwo['kwota_brutto_eur'] = dane_paliwo['kwota_brutto_num'] * kurs_waluty
             dane_paliwo['kwota_finalna_eur'] = dane_paliwo['kwota_brutto_eur']
         else:
             # GWARANCJA ISTNIENIA KOLUMN
@@ -1065,10 +3388,10 @@ def przygotuj_dane_paliwowe(dane_z_bazy, firma_kontekst=None):
 
     # --- B. PRZETWARZANIE WYNAGRODZEŃ ---
     if not df_wynagrodzenia.empty:
-        df_wynagrodzenia['identyfikator_clean'] = bezpieczne_czyszczenie_klucza(df_wynagrodzenia['identyfikator'])
-        df_wynagrodzenia['data_transakcji_dt'] = pd.to_datetime(df_wynagrodzenia['data_transakcji'])
-        df_wynagrodzenia['kwota_netto_num'] = pd.to_numeric(df_wynagrodzenia['kwota_netto'], errors='coerce').fillna(0.0)
-        df_wynagrodzenia['kwota_brutto_num'] = pd.to_numeric(df_wynagrodzenia['kwota_brutto'], errors='coerce').fillna(0.0)
+        df_wynagrodzenia['identyfikator_clean'] = identyfikatory_clean(df_wynagrodzenia)
+        df_wynagrodzenia['data_transakcji_dt'] = df_wynagrodzenia['data_transakcji']
+        df_wynagrodzenia['kwota_netto_num'] = df_wynagrodzenia['kwota_netto'].fillna(0.0)
+        df_wynagrodzenia['kwota_brutto_num'] = df_wynagrodzenia['kwota_brutto'].fillna(0.0)
         
         # Przeliczenie PLN -> EUR dla wynagrodzeń
         df_wynagrodzenia['kwota_netto_eur'] = df_wynagrodzenia['kwota_netto_num'] / kurs_eur
@@ -1090,54 +3413,335 @@ def przygotuj_dane_paliwowe(dane_z_bazy, firma_kontekst=None):
 
     return dane_finalne, mapa_kursow
 
+def sumy_kosztow_paczkami(conn, data_start, data_stop, wybrana_firma):
+    """
+    Sumy netto/brutto EUR per (identyfikator_clean, typ) z przygotuj_dane_paliwowe liczonej paczka po paczce
+    z czytaj_transakcje_paczkami (funkcja działa wierszami) - każda paczka od razu zwija się do sum, więc
+    przygotowane wiersze nie zbierają się w pamięci. Zwraca (sumy, kurs EUR, mapa kursów) - do szczegółów pojazdów.
+    """
+    kurs_eur = pobierz_kurs_eur_pln()
+    if not kurs_eur: kurs_eur = 4.30 # Fallback
+    czesci, mapa_kursow = [], {}
+    for paczka in czytaj_transakcje_paczkami(conn, data_start, data_stop, wybrana_firma, kolumny=KOLUMNY_WIDOKU_KOSZTOW):
+        dane, _ = przygotuj_dane_paliwowe(paczka, wybrana_firma, kurs_eur, mapa_kursow)
+        if not dane.empty:
+            czesci.append(dane.groupby(['identyfikator_clean', 'typ'], observed=True)[['kwota_netto_eur', 'kwota_brutto_eur']].sum())
+    if not czesci:
+        return pd.DataFrame(columns=['identyfikator_clean', 'typ', 'kwota_netto_eur', 'kwota_brutto_eur']), kurs_eur, mapa_kursow
+    sumy = pd.concat(czesci).groupby(level=[0, 1], observed=True).sum().reset_index()
+    return sumy, kurs_eur, mapa_kursow
+
+def transakcje_pojazdu_do_excela(conn, data_start, data_stop, wybrana_firma, pojazd, kurs_eur, mapa_kursow):
+    """Transakcje jednego pojazdu przygotowane jak w przygotuj_dane_paliwowe (arkusz pojazdu w to_excel_extended)."""
+    query, params, kolumny = zapytanie_pobierania(data_start, data_stop, wybrana_firma, kolumny=KOLUMNY_WIDOKU_KOSZTOW, pojazd=pojazd)
+    # ttl=0 - arkusze są w pliku Excela, nie ma sensu trzymać transakcji każdego pojazdu także w cache
+    surowe = conn.query(query, params=params, ttl=0, **typy_odczytu(kolumny))
+    return przygotuj_dane_paliwowe(surowe, wybrana_firma, kurs_eur, mapa_kursow)[0]
+
+# --- AGREGACJE RAPORTU (SQL) ---
+# Raport sumuje w PostgreSQL: grupy po pojeździe (zapisany identyfikator_clean), firmie, typie, kraju, produkcie, walucie i źródle
+# plus flaga "od daty wejścia pojazdu do floty UNIX". To wystarcza, żeby w pandas zrobić te same filtry firm
+# i przeliczenie na EUR co przygotuj_dane_paliwowe, tylko na sumach zamiast na wszystkich transakcjach.
+# Pełne miesiące zakresu idą z zestawienia miesięcznego, transakcje czytamy tylko dla niepełnych miesięcy
+# na brzegach i dla miesięcy, w których pojazd wszedł do floty (flaga zmienia się wtedy w środku miesiąca).
+# Surowe wiersze pobiera dopiero podgląd pojedynczego pojazdu.
+
+def starty_floty_pojazdow(pojazdy):
+    """Pojazdy (identyfikator_clean) z UNIX_FLOTA_CONFIG i ich daty wejścia do floty."""
+    s = pd.Series(list(pojazdy), dtype=object)
+    starty = klucz_pojazdu_floty(s).map(UNIX_FLOTA_CONFIG)
+    maska = starty.notna()
+    return s[maska].tolist(), starty[maska].tolist()
+
+def pelne_miesiace_sql(data_od, data_do):
+    """Pełne miesiące wewnątrz półotwartego [data_od, data_do) jako [od, do); bez pełnego miesiąca od == do == data_do."""
+    od = pd.Timestamp(data_od) + pd.offsets.MonthBegin(0)
+    do = pd.Timestamp(data_do).to_period('M').start_time
+    if od >= do:
+        return data_do, data_do
+    return od.to_pydatetime(), do.to_pydatetime()
+
+def miesiace_wejscia_do_floty(flota_id, flota_od, pelne_od, pelne_do):
+    """(identyfikator, pierwszy dzień miesiąca) dla startów floty w środku pełnego miesiąca zakresu."""
+    miesiace = []
+    for identyfikator, od in zip(flota_id, flota_od):
+        od = pd.Timestamp(od)
+        miesiac = od.to_period('M').start_time
+        if od != miesiac and pelne_od <= miesiac < pelne_do:
+            miesiace.append((identyfikator, miesiac.to_pydatetime()))
+    return miesiace
+
+def pobierz_agregaty_raportu(conn, data_start, data_stop, wybrana_firma):
+    """Sumy netto/brutto/ilości i liczba transakcji w grupach opisanych wyżej (zapytania w cache conn.query)."""
+    data_od, data_do = zakres_dat_sql(data_start, data_stop)
+    pelne_od, pelne_do = pelne_miesiace_sql(data_od, data_do)
+    miesiac_od, miesiac_do = zakres_miesiecy_sql(data_start, data_stop)
+    params = {"data_od": data_od, "data_do": data_do, "pelne_od": pelne_od, "pelne_do": pelne_do,
+              "miesiac_od": miesiac_od, "miesiac_do": miesiac_do, "firma": wybrana_firma}
+
+    # Zestawienie ma wszystkie pojazdy z każdego miesiąca - nie trzeba przeglądać transakcji
+    warunek_miesiecy = "miesiac >= :miesiac_od AND miesiac < :miesiac_do"
+    pojazdy = conn.query(
+        f"""SELECT DISTINCT NULLIF(identyfikator_clean, '') AS identyfikator_clean
+            FROM ({zapytanie_transakcji_firmy('identyfikator_clean', warunek_miesiecy, wybrana_firma, NAZWA_TABELI_MIESIECZNEJ)}) t""",
+        params=params
+    )['identyfikator_clean'].dropna()
+    params["flota_id"], params["flota_od"] = starty_floty_pojazdow(pojazdy)
+
+    warunki_surowe = ["(data_transakcji >= :data_od AND data_transakcji < :pelne_od)",
+                      "(data_transakcji >= :pelne_do AND data_transakcji < :data_do)"]
+    for i, (identyfikator, miesiac) in enumerate(miesiace_wejscia_do_floty(params["flota_id"], params["flota_od"], pelne_od, pelne_do)):
+        warunki_surowe.append(f"(identyfikator_clean = :wejscie_id_{i} AND data_transakcji >= :wejscie_od_{i} AND data_transakcji < :wejscie_do_{i})")
+        params[f"wejscie_id_{i}"] = identyfikator
+        params[f"wejscie_od_{i}"] = miesiac
+        params[f"wejscie_do_{i}"] = (pd.Timestamp(miesiac) + pd.offsets.MonthBegin(1)).to_pydatetime()
+
+    kolumny = "identyfikator_clean, firma, typ, kraj, produkt, waluta, zrodlo, data_transakcji, kwota_netto, kwota_brutto, ilosc"
+    kolumny_zestawienia = ("miesiac, NULLIF(identyfikator_clean, '') AS identyfikator_clean, NULLIF(firma, '') AS firma, NULLIF(typ, '') AS typ, "
+                           "NULLIF(kraj, '') AS kraj, NULLIF(produkt, '') AS produkt, NULLIF(waluta, '') AS waluta, "
+                           "NULLIF(zrodlo, '') AS zrodlo, kwota_netto, kwota_brutto, ilosc, liczba")
+    flota = "(SELECT unnest(CAST(:flota_id AS TEXT[])) AS identyfikator_clean, unnest(CAST(:flota_od AS DATE[])) AS od)"
+    query = f"""
+        SELECT identyfikator_clean, firma, typ, kraj, produkt, waluta, zrodlo, po_starcie_floty,
+               SUM(kwota_netto) AS kwota_netto, SUM(kwota_brutto) AS kwota_brutto,
+               SUM(ilosc) AS ilosc, SUM(liczba) AS liczba
+        FROM (
+            SELECT t.identyfikator_clean, t.firma, t.typ, t.kraj, t.produkt, t.waluta, t.zrodlo,
+                   COALESCE(t.data_transakcji >= f.od, FALSE) AS po_starcie_floty,
+                   t.kwota_netto, t.kwota_brutto, t.ilosc, 1 AS liczba
+            FROM ({zapytanie_transakcji_firmy(kolumny, f"({' OR '.join(warunki_surowe)})", wybrana_firma)}) t
+            LEFT JOIN {flota} f ON f.identyfikator_clean = t.identyfikator_clean
+            UNION ALL
+            SELECT z.identyfikator_clean, z.firma, z.typ, z.kraj, z.produkt, z.waluta, z.zrodlo,
+                   COALESCE(f.od <= z.miesiac, FALSE) AS po_starcie_floty,
+                   z.kwota_netto, z.kwota_brutto, z.ilosc, z.liczba
+            FROM ({zapytanie_transakcji_firmy(kolumny_zestawienia, "miesiac >= :pelne_od AND miesiac < :pelne_do", wybrana_firma, NAZWA_TABELI_MIESIECZNEJ)}) z
+            LEFT JOIN {flota} f ON f.identyfikator_clean = z.identyfikator_clean
+            WHERE NOT COALESCE(f.od > z.miesiac AND f.od < z.miesiac + INTERVAL '1 month', FALSE)
+        ) x
+        GROUP BY 1, 2, 3, 4, 5, 6, 7, 8
+    """
+    return conn.query(query, params=params, dtype=TYPY_KOLUMN_TRANSAKCJI)
+
+def przygotuj_agregaty_paliwowe(agregaty, firma_kontekst=None):
+    """Odpowiednik przygotuj_dane_paliwowe (część paliwo/opłaty) dla wyniku pobierz_agregaty_raportu."""
+    dane_paliwo = agregaty[(agregaty['typ'] != 'WYNAGRODZENIE') & (agregaty['zrodlo'] != 'Fakturownia')].copy()
+    if firma_kontekst in ("UNIX-TRANS", "HOLIER"):
+        pojazd = klucz_pojazdu_floty(dane_paliwo['identyfikator_clean'])
+        dane_paliwo = dane_paliwo[maska_firmy_kontekstu(pojazd, dane_paliwo['firma'], dane_paliwo['po_starcie_floty'].astype(bool), firma_kontekst)]
+
+    kurs_eur = pobierz_kurs_eur_pln()
+    if not kurs_eur: kurs_eur = 4.30 # Fallback
+    mapa_kursow = pobierz_wszystkie_kursy(dane_paliwo['waluta'].unique(), kurs_eur)
+    kurs_waluty = dane_paliwo['waluta'].astype(object).map(mapa_kursow).astype(float).fillna(0.0)
+    dane_paliwo['kwota_netto_eur'] = dane_paliwo['kwota_netto'].fillna(0.0) * kurs_waluty
+    dane_paliwo['kwota_brutto_eur'] = dane_paliwo['kwota_brutto'].fillna(0.0) * kurs_waluty
+    return dane_paliwo, mapa_kursow
+
+# --- KOSTKA SUM NARASTAJĄCYCH ---
+# Z zestawienia dziennego budujemy w pamięci tablice sum narastających (grupa × dzień): suma dowolnego zakresu
+# dat to różnica dwóch kolumn, cum[stop + 1] - cum[start], bez ponownego zapytania i agregacji przy każdej
+# zmianie dat. Start floty UNIX wypada zawsze na początek dnia, więc podział "przed/po starcie" też jest różnicą kolumn.
+# Kostka żyje we wspólnym cache (st.cache_resource, bez kopii przy każdym odczycie); zapisy zmieniające
+# zestawienie dzienne czyszczą go same, akcje administratora - razem z resztą cache (wyczysc_cache_odczytow).
+# Oś dni jest ograniczona do okna ostatnich MAKS_DNI_KOSTKI dni (grupy × dni × 4 × float64 rośnie z historią) -
+# zakresy wychodzące poza okno liczy pobierz_agregaty_raportu (sumy_okresu).
+MIARY_KOSTKI = ['kwota_netto', 'kwota_brutto', 'ilosc', 'liczba']
+MAKS_DNI_KOSTKI = 2 * 366
+ZAPAS_DNI_KOSTKI = 31 # daty transakcji z przyszłości (np. okresy rozliczeniowe opłat)
+CZAS_ZYCIA_KOSTKI = 3600 # s; okno kostki przesuwa się z datą, a zapisy spoza aplikacji nie czyszczą cache
+
+def zbuduj_kostke(dzienne, dzien0=None, liczba_dni=None):
+    """
+    Kostka z wierszy zestawienia dziennego: (grupy, pierwszy dzień, {miara: tablica grupy × (dni + 1)}),
+    kolumna 0 to zera, kolumna i + 1 - suma do dnia i włącznie. None, gdy nie ma danych.
+    Bez dzien0/liczba_dni oś dni to zakres danych; wiersze spoza podanego okna muszą być odfiltrowane wcześniej.
+    """
+    if dzienne.empty:
+        return None
+    dni = pd.to_datetime(dzienne['dzien'])
+    dzien0 = dni.min() if dzien0 is None else pd.Timestamp(dzien0)
+    if liczba_dni is None:
+        liczba_dni = (dni.max() - dzien0).days + 1
+    nr_grupy = dzienne.groupby(KOLUMNY_KLUCZA_DZIENNEGO, sort=False, dropna=False).ngroup().to_numpy()
+    grupy = dzienne[KOLUMNY_KLUCZA_DZIENNEGO].drop_duplicates().reset_index(drop=True)
+    nr_dnia = (dni - dzien0).dt.days.to_numpy() + 1
+    sumy = {}
+    for miara in MIARY_KOSTKI:
+        tablica = np.zeros((len(grupy), liczba_dni + 1))
+        tablica[nr_grupy, nr_dnia] = dzienne[miara].to_numpy(dtype=float)
+        sumy[miara] = np.cumsum(tablica, axis=1)
+    return grupy, dzien0, sumy
+
+def okno_kostki(dzisiaj=None):
+    """(pierwszy dzień, liczba dni) okna kostki: MAKS_DNI_KOSTKI wstecz i ZAPAS_DNI_KOSTKI naprzód od dzisiaj."""
+    dzisiaj = pd.Timestamp(dzisiaj or date.today())
+    return dzisiaj - pd.Timedelta(days=MAKS_DNI_KOSTKI - 1), MAKS_DNI_KOSTKI + ZAPAS_DNI_KOSTKI
+
+@st.cache_resource(ttl=CZAS_ZYCIA_KOSTKI)
+def pobierz_kostke_kosztow(_conn, wybrana_firma):
+    """Kostka firmy (z kartami HOLIER dla UNIX-TRANS) - tylko do odczytu, współdzielona przez wszystkie sesje."""
+    dzien0, liczba_dni = okno_kostki()
+    kolumny = ", ".join(["dzien"] + [f"NULLIF({k}, '') AS {k}" for k in KOLUMNY_KLUCZA_DZIENNEGO] + MIARY_KOSTKI)
+    dzienne = _conn.query(zapytanie_transakcji_firmy(kolumny, "dzien >= :od AND dzien < :do", wybrana_firma, NAZWA_TABELI_DZIENNEJ),
+                          params={"firma": wybrana_firma, "od": dzien0.date(), "do": (dzien0 + pd.Timedelta(days=liczba_dni)).date()}, ttl=0)
+    return zbuduj_kostke(dzienne, dzien0, liczba_dni)
+
+def wyczysc_cache_odczytow():
+    st.cache_data.clear()
+    pobierz_kostke_kosztow.clear()
+
+def sumy_z_kostki(kostka, data_start, data_stop):
+    """
+    Sumy grup kostki w [data_start, data_stop], rozdzielone na przed/po starcie floty - ramka o kolumnach
+    pobierz_agregaty_raportu bez produktu i kraju (nadaje się do przygotuj_agregaty_paliwowe).
+    """
+    if kostka is None:
+        return pd.DataFrame()
+    grupy, dzien0, sumy = kostka
+    liczba_dni = sumy['liczba'].shape[1] - 1
+    od = int(np.clip((pd.Timestamp(data_start) - dzien0).days, 0, liczba_dni))
+    do = int(np.clip((pd.Timestamp(data_stop) - dzien0).days + 1, 0, liczba_dni))
+
+    start_floty = pd.to_datetime(klucz_pojazdu_floty(grupy['identyfikator_clean']).map(UNIX_FLOTA_CONFIG))
+    # Kolumna startu floty przycięta do zakresu; grupy spoza floty mają cały zakres "przed startem"
+    podzial = np.clip((start_floty - dzien0).dt.days.fillna(do).to_numpy(), od, do).astype(int)
+
+    wiersze = np.arange(len(grupy))
+    czesci = []
+    for po_starcie_floty, (poczatek, koniec) in ((False, (od, podzial)), (True, (podzial, do))):
+        czesc = grupy.copy()
+        czesc['po_starcie_floty'] = po_starcie_floty
+        for miara, tablica in sumy.items():
+            czesc[miara] = tablica[wiersze, koniec] - tablica[wiersze, poczatek]
+        czesci.append(czesc)
+    wynik = pd.concat(czesci, ignore_index=True)
+    wynik['liczba'] = wynik['liczba'].round().astype(int)
+    return wynik[wynik['liczba'] > 0].reset_index(drop=True)
+
+def sumy_okresu(conn, wybrana_firma, data_start, data_stop):
+    """Sumy grup okresu z kostki, a gdy okres wychodzi poza jej okno - z pobierz_agregaty_raportu (te same kolumny + produkt i kraj)."""
+    dzien0, liczba_dni = okno_kostki()
+    if pd.Timestamp(data_start) >= dzien0 and pd.Timestamp(data_stop) < dzien0 + pd.Timedelta(days=liczba_dni):
+        return sumy_z_kostki(pobierz_kostke_kosztow(conn, wybrana_firma), data_start, data_stop)
+    return pobierz_agregaty_raportu(conn, data_start, data_stop, wybrana_firma)
+
+def pobierz_strone_transakcji_pojazdu(conn, data_start, data_stop, wybrana_firma, pojazd, typ=None, przed=None, rozmiar_strony=ROZMIAR_STRONY_SZCZEGOLOW):
+    """
+    Jedna strona transakcji pojazdu (od najnowszych), przygotowana jak w przygotuj_dane_paliwowe.
+    Stronicowanie po kluczu (data_transakcji, id) zamiast OFFSET - zapytanie idzie po indeksie
+    (identyfikator_clean, data_transakcji) i czyta tylko wiersze strony. `przed` - klucz z poprzedniej strony.
+    Zwraca (strona, klucz następnej strony albo None, gdy to ostatnia).
+    """
+    kolumny = ['id'] + KOLUMNY_WIDOKU_KOSZTOW
+    czesci, zebrane, koniec = [], 0, False
+    # przygotuj_dane_paliwowe może odrzucić część wierszy (reguły floty) - dociągamy, aż strona będzie pełna
+    while zebrane < rozmiar_strony and not koniec:
+        query, params, _ = zapytanie_pobierania(data_start, data_stop, wybrana_firma, typ, kolumny, pojazd=pojazd, przed=przed)
+        query = f"SELECT * FROM ({query}) AS t ORDER BY data_transakcji DESC, id DESC LIMIT :limit"
+        params["limit"] = rozmiar_strony
+        surowe = conn.query(query, params=params, **typy_odczytu(kolumny))
+        koniec = len(surowe) < rozmiar_strony
+        if surowe.empty:
+            break
+        przed = (surowe['data_transakcji'].iloc[-1].to_pydatetime(), int(surowe['id'].iloc[-1]))
+        dane, _ = przygotuj_dane_paliwowe(surowe, wybrana_firma)
+        if not dane.empty:
+            dane = dane[dane['identyfikator_clean'] == pojazd]
+            czesci.append(dane)
+            zebrane += len(dane)
+
+    if not czesci:
+        return pd.DataFrame(), None
+    strona = pd.concat(czesci, ignore_index=True).sort_values(by=['data_transakcji_dt', 'id'], ascending=False)
+    if len(strona) > rozmiar_strony:
+        strona, koniec = strona.head(rozmiar_strony), False
+    if koniec:
+        return strona, None
+    return strona, (strona['data_transakcji_dt'].iloc[-1].to_pydatetime(), int(strona['id'].iloc[-1]))
+
+def strona_transakcji_pojazdu(conn, klucz, data_start, data_stop, wybrana_firma, pojazd, typ=None):
+    """
+    Podgląd transakcji pojazdu strona po stronie: klucze odwiedzonych stron leżą w st.session_state[klucz],
+    przyciski przesuwają się o stronę. Zwraca (strona, numer pierwszego wiersza strony - do kolumny Lp.).
+    """
+    wybor = (data_start, data_stop, wybrana_firma, pojazd, typ)
+    stan = st.session_state.get(klucz)
+    if not stan or stan['wybor'] != wybor:
+        stan = st.session_state[klucz] = {'wybor': wybor, 'klucze': [None]}
+
+    strona, nastepny = pobierz_strone_transakcji_pojazdu(conn, data_start, data_stop, wybrana_firma, pojazd, typ, przed=stan['klucze'][-1])
+    nr_strony = len(stan['klucze'])
+
+    k1, k2, k3 = st.columns([1, 2, 1])
+    if k1.button("◀ Poprzednia", key=f"{klucz}_wstecz", disabled=nr_strony == 1):
+        stan['klucze'].pop()
+        st.rerun()
+    k2.caption(f"Strona {nr_strony}")
+    if k3.button("Następna ▶", key=f"{klucz}_dalej", disabled=nastepny is None):
+        stan['klucze'].append(nastepny)
+        st.rerun()
+    return strona, 1 + (nr_strony - 1) * ROZMIAR_STRONY_SZCZEGOLOW
+
 # --- LOGIKA REFAKTUR ---
-def pobierz_dane_do_refaktury(conn, data_start, data_stop):
-    # Pobieramy wszystko z bazy w zakresie dat
-    df_all = pobierz_dane_z_bazy(conn, data_start, data_stop, "UNIX-TRANS") # Używamy UNIX-TRANS żeby pobrać szeroki zakres (z logiką OR)
-    if df_all.empty: return None, None, None, None
-    
-    df_all = df_all[df_all['zrodlo'] != 'Fakturownia']
-    df_all['data_transakcji_dt'] = pd.to_datetime(df_all['data_transakcji'])
-    df_all['identyfikator_clean'] = bezpieczne_czyszczenie_klucza(df_all['identyfikator'])
-    
+def maski_refaktur(pojazd, firma, po_starcie_floty):
+    """(HOLIER -> UNIX, UNIX -> HOLIER) dla wierszy z pojazdem (klucz_pojazdu_floty), firmą i flagą startu floty."""
+    w_flocie = pojazd.isin(list(UNIX_FLOTA_CONFIG))
+    # 1. KIERUNEK: HOLIER -> UNIX (Unix winien Holierowi) - auto floty UNIX od daty wejścia, zapłacił HOLIER
+    # 2. KIERUNEK: UNIX -> HOLIER (Holier winien Unixowi) - auto obce, zapłacił UNIX; bez Trucków (w tym osobowego)
+    return ((firma == 'HOLIER') & w_flocie & po_starcie_floty,
+            (firma == 'UNIX-TRANS') & ~w_flocie & ~pojazd.str.contains('TRUCK', regex=False))
+
+def sumy_refaktur_z_agregatow(agregaty):
+    """
+    Sumy netto/brutto (EUR) pojazdów do refaktury w obu kierunkach z sum okresu UNIX-TRANS (z kartami HOLIER):
+    (HOLIER -> UNIX, UNIX -> HOLIER), ramki z indeksem identyfikator_clean; (None, None) bez danych lub kursu.
+    """
+    if agregaty.empty:
+        return None, None
+    agregaty = agregaty[agregaty['zrodlo'] != 'Fakturownia'].copy()
     kurs_eur = pobierz_kurs_eur_pln()
-    if not kurs_eur: return None, None, None, None
-    mapa_kursow = pobierz_wszystkie_kursy(df_all['waluta'].unique(), kurs_eur)
-    
-    df_all['kwota_netto_num'] = pd.to_numeric(df_all['kwota_netto'], errors='coerce').fillna(0.0)
-    df_all['kwota_brutto_num'] = pd.to_numeric(df_all['kwota_brutto'], errors='coerce').fillna(0.0)
-    df_all['kwota_netto_eur'] = df_all.apply(lambda row: row['kwota_netto_num'] * mapa_kursow.get(row['waluta'], 0.0), axis=1)
-    df_all['kwota_brutto_eur'] = df_all.apply(lambda row: row['kwota_brutto_num'] * mapa_kursow.get(row['waluta'], 0.0), axis=1)
-
-    # 1. KIERUNEK: HOLIER -> UNIX (Unix winien Holierowi)
-    def filter_holier_to_unix(row):
-        pojazd = str(row['identyfikator_clean']).upper().replace(" ", "").replace("-", "")
-        if row['firma'] == 'HOLIER' and pojazd in UNIX_FLOTA_CONFIG:
-            data_tr = row['data_transakcji_dt'].date()
-            start_date = UNIX_FLOTA_CONFIG[pojazd]
-            if data_tr >= start_date:
-                return True
-        return False
+    if not kurs_eur: return None, None
+    mapa_kursow = pobierz_wszystkie_kursy(agregaty['waluta'].unique(), kurs_eur)
+    kurs_waluty = agregaty['waluta'].astype(object).map(mapa_kursow).astype(float).fillna(0.0)
+    agregaty['Suma_Netto'] = agregaty['kwota_netto'].fillna(0.0) * kurs_waluty
+    agregaty['Suma_Brutto'] = agregaty['kwota_brutto'].fillna(0.0) * kurs_waluty
+    pojazd = klucz_pojazdu_floty(agregaty['identyfikator_clean'])
+    return tuple(
+        agregaty[maska].groupby('identyfikator_clean')[['Suma_Netto', 'Suma_Brutto']].sum().sort_values(by='Suma_Brutto', ascending=False)
+        for maska in maski_refaktur(pojazd, agregaty['firma'], agregaty['po_starcie_floty'].astype(bool))
+    )
 
-    # 2. KIERUNEK: UNIX -> HOLIER (Holier winien Unixowi)
-    def filter_unix_to_holier(row):
-        pojazd = str(row['identyfikator_clean']).upper().replace(" ", "").replace("-", "")
-        
-        # --- POPRAWKA: Nie refakturuj Trucka Osobowego ani zwykłego Trucka ---
-        if 'TRUCK' in pojazd:
-             return False # Blokujemy wszystko co ma w nazwie TRUCK (w tym TRUCK_OSOBOWY)
-        # ---------------------------------------------------------------------
-
-        if row['firma'] == 'UNIX-TRANS':
-            if pojazd not in UNIX_FLOTA_CONFIG:
-                return True # To auto obce (Holiera), za które zapłacił Unix
-        return False
+def pobierz_dane_do_refaktury(conn, data_start, data_stop):
+    # Czytamy szeroki zakres UNIX-TRANS (z kartami HOLIER) paczkami i z każdej zostawiamy tylko wiersze refaktur -
+    # w pamięci jest naraz jedna paczka i dwa (małe) wyniki, a nie cały rok transakcji
+    kurs_eur = pobierz_kurs_eur_pln()
+    if not kurs_eur: return None, None, None
 
-    maska_h_to_u = df_all.apply(filter_holier_to_unix, axis=1)
-    df_holier_to_unix = df_all[maska_h_to_u]
-    
-    maska_u_to_h = df_all.apply(filter_unix_to_holier, axis=1)
-    df_unix_to_holier = df_all[maska_u_to_h]
+    czesci_h_to_u, czesci_u_to_h, mapa_kursow = [], [], {}
+    for df_all in czytaj_transakcje_paczkami(conn, data_start, data_stop, "UNIX-TRANS", kolumny=KOLUMNY_WIDOKU_KOSZTOW):
+        df_all = df_all[df_all['zrodlo'] != 'Fakturownia'].copy()
+        if df_all.empty:
+            continue
+        df_all['data_transakcji_dt'] = df_all['data_transakcji']
+        df_all['identyfikator_clean'] = identyfikatory_clean(df_all)
+
+        mapa_kursow.update(pobierz_wszystkie_kursy(df_all['waluta'].unique(), kurs_eur))
+        df_all['kwota_netto_num'] = df_all['kwota_netto'].fillna(0.0)
+        df_all['kwota_brutto_num'] = df_all['kwota_brutto'].fillna(0.0)
+        kurs_waluty = df_all['waluta'].astype(object).map(mapa_kursow).astype(float).fillna(0.0)
+        df_all['kwota_netto_eur'] = df_all['kwota_netto_num'] * kurs_waluty
+        df_all['kwota_brutto_eur'] = df_all['kwota_brutto_num'] * kurs_waluty
+
+        pojazd = klucz_pojazdu_floty(df_all['identyfikator_clean'])
+        po_starcie_floty = df_all['data_transakcji_dt'].dt.normalize() >= pd.to_datetime(pojazd.map(UNIX_FLOTA_CONFIG))
+        h_to_u, u_to_h = maski_refaktur(pojazd, df_all['firma'], po_starcie_floty)
+        czesci_h_to_u.append(df_all[h_to_u])
+        czesci_u_to_h.append(df_all[u_to_h])
+
+    if not czesci_h_to_u: return None, None, None
+    df_holier_to_unix = pd.concat(czesci_h_to_u, ignore_index=True)
+    df_unix_to_holier = pd.concat(czesci_u_to_h, ignore_index=True)
 
     return df_holier_to_unix, df_unix_to_holier, mapa_kursow
 
@@ -1150,28 +3754,14 @@ def przetworz_plik_analizy(przeslany_plik_bytes, data_start, data_stop, wybrana_
         except:
             plik_content = przeslany_plik_bytes 
 
-        encodings_to_try = ['utf-8', 'utf-8-sig', 'cp1250', 'latin1']
-        separators = [',', ';', '\t']
-        
-        for enc in encodings_to_try:
-            for sep in separators:
-                try:
-                    temp_df = pd.read_csv(io.BytesIO(plik_content), sep=sep, engine='python', encoding=enc, on_bad_lines='skip')
-                    cols = temp_df.columns
-                    is_fakt = any('Sprzedaj' in c for c in cols) or any('NIP' in c for c in cols)
-                    if is_fakt:
-                        df_csv = temp_df
-                        break
-                except:
-                    continue
-            if df_csv is not None:
-                break
-        
-        if df_csv is None:
-            try:
-                df_csv = pd.read_excel(io.BytesIO(plik_content))
-            except:
-                pass
+        profil = rozpoznaj_plik(plik_content)
+        try:
+            if profil['format'] == 'Fakturownia':
+                df_csv = wczytaj_wg_profilu(plik_content, profil)
+            elif profil['typ_pliku'] == 'excel':
+                df_csv = wczytaj_arkusz(plik_content)
+        except:
+            df_csv = None
 
         if df_csv is None:
             st.error("Nie udało się odczytać pliku analizy UNIX (Fakturownia).")
@@ -1246,10 +3836,7 @@ def przetworz_plik_analizy(przeslany_plik_bytes, data_start, data_stop, wybrana_
         return None, None
     
     try:
-        df = pd.read_excel(przeslany_plik_bytes, 
-                           sheet_name='pojazdy', 
-                           engine='openpyxl', 
-                           header=[7, 8]) 
+        df = wczytaj_arkusz_subiekta(przeslany_plik_bytes, MAPA_WALUT_PLIKU)
         kolumna_etykiet_tuple = df.columns[0]
         MAPA_BRUTTO_DO_KURSU = {}
         MAPA_NETTO_DO_KURSU = {}
@@ -1274,47 +3861,27 @@ def przetworz_plik_analizy(przeslany_plik_bytes, data_start, data_stop, wybrana_
     ostatnia_etykieta_pojazdu = None
     aktualna_data = None                     
     date_regex = re.compile(r'^\d{4}-\d{2}-\d{2}$') 
-    
-    def is_vehicle_line(line):
-        if not line or line == 'nan': return False
-        line_clean = str(line).strip().upper()
-        BLACKLIST = [
-            'E100', 'EUROWAG', 'VISA', 'MASTER', 'MASTERCARD', 
-            'ORLEN', 'LOTOS', 'BP', 'SHELL', 'UTA', 'DKV', 
-            'PKO', 'SANTANDER', 'ING', 'ALIOR', 'MILLENIUM',
-            'TRUCK24SP', 'EDENRED', 'INTERCARS', 'MARMAR',
-            'LEASING', 'FINANCE', 'UBER', 'BOLT', 'FREE',
-            'SERWIS', 'POLSKA', 'SPOLKA', 'GROUP', 'LOGISTICS',
-            'TRANS', 'CONSULTING', 'SYSTEM', 'SOLUTIONS',
-            'ZALICZKA', 'WE8JP51','WH0064F','PTU6049P','PTU6050P'
-        ]
-        if line_clean in BLACKLIST: return False
-        words = re.split(r'[\s+Ii]+', line_clean) 
-        if not words: return False
-        has_vehicle_word = False
-        for word in words:
-            if not word: continue
-            word = word.replace("-", "")
-            is_blacklisted = False
-            for bad_word in BLACKLIST:
-                if bad_word in word:
-                    is_blacklisted = True
-                    break
-            if is_blacklisted: continue
-            if len(word) < 5: continue
-            if re.match(r'^[A-Z0-9]+$', word):
-                ma_litery = any(c.isalpha() for c in word)
-                ma_cyfry = any(c.isdigit() for c in word)
-                if ma_litery and ma_cyfry:
-                    has_vehicle_word = True
-                    break
-                if word.isdigit() and len(word) >= 4:
-                    has_vehicle_word = True
-                    break
-        if not has_vehicle_word: return False
-        for word in words:
-            if len(word) > 12: return False
-        return True
+    BLACKLIST = [
+        'E100', 'EUROWAG', 'VISA', 'MASTER', 'MASTERCARD', 
+        'ORLEN', 'LOTOS', 'BP', 'SHELL', 'UTA', 'DKV', 
+        'PKO', 'SANTANDER', 'ING', 'ALIOR', 'MILLENIUM',
+        'TRUCK24SP', 'EDENRED', 'INTERCARS', 'MARMAR',
+        'LEASING', 'FINANCE', 'UBER', 'BOLT', 'FREE',
+        'SERWIS', 'POLSKA', 'SPOLKA', 'GROUP', 'LOGISTICS',
+        'TRANS', 'CONSULTING', 'SYSTEM', 'SOLUTIONS',
+        'ZALICZKA', 'WE8JP51','WH0064F','PTU6049P','PTU6050P'
+    ]
+    # Wiersze z pojazdem - jeden przebieg po całej kolumnie etykiet: znany pojazd floty, a gdy go nie ma,
+    # osobne słowo (między spacjami / '+') w kształcie tablicy z cyfrą, poza NIE_POJAZDY - 'FV 2025/01/33'
+    # to nie tablica. Etykiety i pojazdy z BLACKLIST odpadają.
+    etykiety = df[kolumna_etykiet_tuple].astype(str).str.strip()
+    etykiety_upper = etykiety.str.upper()
+    ogolne = etykiety_upper.str.extract(rf"(?:^|[\s+])({WZORZEC_TABLICY})(?=$|[\s+])", expand=False)
+    ogolne = ogolne.str.replace(r'[\s-]', '', regex=True)
+    ogolne = ogolne.where(~ogolne.isin(NIE_POJAZDY) & ogolne.str.contains(r'\d', na=False))
+    pojazdy_etykiet = dopasuj_znane_pojazdy(etykiety).fillna(ogolne)
+    czy_wiersz_pojazdu = (pojazdy_etykiet.notna() & ~pojazdy_etykiet.isin(BLACKLIST)
+                          & ~etykiety_upper.isin(BLACKLIST) & (etykiety != 'nan') & (etykiety != ''))
 
     for index, row in df.iterrows():
         try:
@@ -1380,7 +3947,7 @@ def przetworz_plik_analizy(przeslany_plik_bytes, data_start, data_stop, wybrana_
                 continue 
 
         elif etykieta_wiersza != 'nan' and etykieta_wiersza:
-            if is_vehicle_line(etykieta_wiersza):
+            if czy_wiersz_pojazdu.at[index]:
                 lista_aktualnych_pojazdow = re.split(r'\s+i\s+|\s+I\s+|\s*\+\s*', etykieta_wiersza, flags=re.IGNORECASE)
                 lista_aktualnych_pojazdow = [p.strip() for p in lista_aktualnych_pojazdow if p.strip()]
             else:
@@ -1499,8 +4066,11 @@ def przetworz_plik_analizy(przeslany_plik_bytes, data_start, data_stop, wybrana_
     df_agregacja = pd.concat([df_przychody, df_przychody_netto, df_koszty, df_koszty_netto], axis=1).fillna(0)
     st.success(f"Plik analizy przetworzony pomyślnie. Znaleziono {len(df_wyniki)} wpisów.")
     return df_agregacja, df_wyniki
-@st.cache_data
-def to_excel_extended(df_summary, df_subiekt_raw, df_fuel_raw):
+def to_excel_extended(df_summary, df_subiekt_raw, pojazdy_paliwo=(), transakcje_pojazdu=None):
+    """
+    Podsumowanie i arkusz na pojazd. Transakcje z bazy dla arkusza pojazdu z `pojazdy_paliwo` daje
+    `transakcje_pojazdu(pojazd)` - pojazd po pojeździe, bez trzymania wszystkich transakcji zakresu naraz.
+    """
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
         # --- ARKUSZ PODSUMOWANIE (LOGIKA NETTO) ---
@@ -1536,9 +4106,7 @@ def to_excel_extended(df_summary, df_subiekt_raw, df_fuel_raw):
         pojazdy_subiekt = set()
         if df_subiekt_raw is not None and not df_subiekt_raw.empty:
             pojazdy_subiekt = set(df_subiekt_raw['pojazd_clean'].unique())
-        pojazdy_paliwo = set()
-        if df_fuel_raw is not None and not df_fuel_raw.empty:
-            pojazdy_paliwo = set(df_fuel_raw['identyfikator_clean'].unique())
+        pojazdy_paliwo = set(pojazdy_paliwo) if transakcje_pojazdu is not None else set()
             
         wszystkie_pojazdy = sorted(list(pojazdy_subiekt.union(pojazdy_paliwo)))
         wszystkie_pojazdy = [p for p in wszystkie_pojazdy if not czy_zakazany_pojazd_global(p)]
@@ -1570,8 +4138,8 @@ def to_excel_extended(df_summary, df_subiekt_raw, df_fuel_raw):
                     dfs_to_concat.append(sub_formatted)
             
             # Dane Paliwowe
-            if df_fuel_raw is not None and not df_fuel_raw.empty:
-                fuel_data = df_fuel_raw[df_fuel_raw['identyfikator_clean'] == pojazd].copy()
+            if pojazd in pojazdy_paliwo:
+                fuel_data = transakcje_pojazdu(pojazd)
                 if not fuel_data.empty:
                     fuel_formatted = pd.DataFrame({
                         'Data': fuel_data['data_transakcji_dt'].dt.date,
@@ -1625,15 +4193,8 @@ def klasyfikuj_wpis(pojazd_clean):
     """
     p = str(pojazd_clean).upper().strip()
     
-    # Lista fraz, które DEFINITYWNIE oznaczają koszt ogólny/biurowy
-    ADMIN_KEYWORDS = [
-        'ZALICZKA', 'KACPER', 'BIURO', 'KSIĘGOWOŚĆ', 'PROWIZJA', 
-        'OPŁATA BANKOWA', 'INTERCARS', 'SANTANDER', 'LEASING', 
-        'UBEZPIECZENIE', 'WARTA', 'PZU', 'POCZTA', 'TELEFON'
-    ]
-    
     # 1. Sprawdź słowa kluczowe administracji
-    if any(k in p for k in ADMIN_KEYWORDS):
+    if any(k in p for k in SLOWA_KOSZTOW_OGOLNYCH):
         return False
     
     # 2. Sprawdź czy pasuje do wzorca tablicy rejestracyjnej (np. WPR, WGM, PTU)
@@ -1655,9 +4216,9 @@ def render_admin_content(conn, wybrana_firma):
         d_nexo_e = c2.date_input("Data do", value=date.today(), key="n_e")
         
         if c3.button("Pobierz Dokumenty", type="primary", use_container_width=True):
-            count = synchronizuj_nexo_z_baza(d_nexo_s, d_nexo_e, wybrana_firma, conn)
+            count, czas_zapisu = synchronizuj_nexo_z_baza(d_nexo_s, d_nexo_e, wybrana_firma, conn)
             if count > 0:
-                st.success(f"Pomyślnie dodano {count} nowych dokumentów z Nexo!")
+                st.success(f"Pomyślnie dodano {count} nowych dokumentów z Nexo! (zapis: {opis_predkosci(count, czas_zapisu)})")
                 time.sleep(1)
                 st.rerun()
             else:
@@ -1679,7 +4240,31 @@ def render_admin_content(conn, wybrana_firma):
             inp_password = st.text_input("Password (Hasło)", value=pw if pw else "", type="password")
             if st.form_submit_button("Zapisz konfigurację API"):
                 zapisz_ustawienia_api(conn, inp_account, inp_username, inp_password)
-                
+
+    # 2b. KONEKTORY API KART PALIWOWYCH
+    with st.expander("⛽ Konektory API kart paliwowych (Eurowag / E100)", expanded=False):
+        st.info(f"Pobierane są tylko transakcje od ostatniego znaku wodnego firmy {wybrana_firma}, stronami po {ROZMIAR_STRONY_API:,} rekordów.")
+        for zrodlo in KONEKTORY_API:
+            url_api, token_api = pobierz_konfiguracje_konektora(conn, zrodlo)
+            znak_wodny = pobierz_ustawienie(conn, klucz_znaku_wodnego(zrodlo, wybrana_firma))
+            with st.form(f"konektor_{zrodlo}"):
+                st.markdown(f"**{zrodlo}** — znak wodny: {znak_wodny or 'brak (pierwsza synchronizacja pobierze wszystko)'}")
+                inp_url = st.text_input("Adres API", value=url_api or "", key=f"api_url_{zrodlo}")
+                inp_token = st.text_input("Token", value=token_api or "", type="password", key=f"api_token_{zrodlo}")
+                c_k1, c_k2 = st.columns(2)
+                zapisz_konf = c_k1.form_submit_button("Zapisz konfigurację")
+                synchronizuj = c_k2.form_submit_button("Synchronizuj", type="primary")
+            if zapisz_konf:
+                zapisz_konfiguracje_konektora(conn, zrodlo, inp_url, inp_token)
+                st.toast(f"Zapisano konfigurację API {zrodlo}.")
+            if synchronizuj:
+                try:
+                    with st.spinner(f"Synchronizacja {zrodlo}..."):
+                        pobrane, zapisane, znak_wodny, czas_s = synchronizuj_api(conn, zrodlo, wybrana_firma)
+                    st.success(f"{zrodlo}: pobrano {pobrane:,} rekordów, zapisano {zapisane:,} nowych w {czas_s:.1f} s (znak wodny: {znak_wodny}).")
+                except Exception as e:
+                    st.error(f"Błąd synchronizacji {zrodlo}: {e}")
+
     st.divider()
 
     # 3. ANALIZA WYNAGRODZEŃ
@@ -1702,8 +4287,7 @@ def render_admin_content(conn, wybrana_firma):
 
             for p in pliki_plac:
                 try:
-                    xls_file = pd.ExcelFile(p)
-                    for sheet in xls_file.sheet_names:
+                    for sheet in nazwy_arkuszy(p):
                         arkusz_id = f"{sheet} ({p.name})"
                         wszystkie_dostepne_arkusze.append(arkusz_id)
                         mapa_plikow[arkusz_id] = (p, sheet)
@@ -1748,7 +4332,7 @@ def render_admin_content(conn, wybrana_firma):
                                 if not df_wf.empty: unikalne_pojazdy_z_webfleet.update(df_wf['pojazd'].unique())
 
                                 # 3. Parsowanie arkusza
-                                df_sheet = pd.read_excel(plik_obj, sheet_name=nazwa_arkusza_oryg, header=None)
+                                df_sheet = wczytaj_arkusz(plik_obj, nazwa_arkusza_oryg, header=None)
                                 df_place = parsuj_dataframe_plac(df_sheet) # Tutaj działa Twoja logika z odwracaniem/mapowaniem
                                 
                                 if df_place.empty: continue
@@ -1865,8 +4449,9 @@ def render_admin_content(conn, wybrana_firma):
                                         'waluta', 'ilosc', 'produkt', 'typ', 'zrodlo', 'kraj', 'firma', 'kontrahent']
                         db_df = db_df[cols_to_save]
     
-                        db_df.to_sql(NAZWA_TABELI, conn.engine, if_exists='append', index=False, schema=NAZWA_SCHEMATU)
-                        st.success("✅ Zapisano pomyślnie z podziałem na firmy!")
+                        zapewnij_schemat_ingestu(conn)
+                        dodane, czas_zapisu = zapisz_nowe_wiersze(conn, db_df)
+                        st.success(f"✅ Zapisano pomyślnie z podziałem na firmy! ({dodane} nowych rekordów, {opis_predkosci(len(db_df), czas_zapisu)})")
                         time.sleep(1.5); st.rerun()
                     except Exception as e:
                         st.error(f"Błąd zapisu: {e}")
@@ -1881,16 +4466,130 @@ def render_admin_content(conn, wybrana_firma):
         with st.container(border=True):
             przeslane_pliki = st.file_uploader("Wybierz pliki (Eurowag, E100, Fakturownia)", accept_multiple_files=True, type=['xlsx', 'xls', 'csv'])
             if przeslane_pliki:
+                tryb_strumieniowy = st.checkbox(
+                    "Tryb strumieniowy (duże pliki)",
+                    help=f"Czyta, normalizuje i zapisuje dane paczkami po {ROZMIAR_PACZKI:,} wierszy - zużycie pamięci nie zależy od wielkości pliku."
+                )
+                pomin_znane = st.checkbox(
+                    "Pomiń pliki już wgrane (rejestr SHA-256)", value=True,
+                    help="Identyczny plik wgrany wcześniej dla tej firmy nie jest ponownie przetwarzany. Z plików częściowo pokrywających się zapisywane są tylko nowe transakcje."
+                )
+                if st.button("🔍 Podgląd (dry-run)", use_container_width=True,
+                             help=f"Parsuje tylko próbkę każdego pliku (do {ROZMIAR_PROBKI_PODGLADU:,} wierszy) - nic nie jest zapisywane."):
+                    for wynik in podglad_plikow(przeslane_pliki, firma_upload, conn):
+                        with st.container(border=True):
+                            st.markdown(f"**{wynik['nazwa']}** — {wynik['format'] or 'format nierozpoznany'}")
+                            if wynik['wpis_rejestru'] is not None:
+                                st.info(komunikat_pominietego_pliku(wynik['nazwa'], wynik['wpis_rejestru'])
+                                        if pomin_znane else "Identyczny plik był już wgrany dla tej firmy.")
+                            if wynik['blad']:
+                                st.error(wynik['blad'])
+                                continue
+                            przedrostek = "" if wynik['dokladny'] else "~"
+                            k_p1, k_p2, k_p3, k_p4 = st.columns(4)
+                            k_p1.metric("Rekordy", f"{przedrostek}{wynik['rekordy_szacowane']:,}",
+                                        help=f"Wierszy w pliku: {przedrostek}{wynik['wiersze_szacowane']:,}, w próbce: {wynik['wiersze_probki']:,}")
+                            if wynik['duplikaty_szacowane'] is None:
+                                k_p2.metric("Nowe", "?")
+                                k_p3.metric("Duplikaty", "?")
+                            else:
+                                k_p2.metric("Nowe", f"{przedrostek}{max(wynik['rekordy_szacowane'] - wynik['duplikaty_szacowane'], 0):,}")
+                                k_p3.metric("Duplikaty", f"{przedrostek}{wynik['duplikaty_szacowane']:,}")
+                            k_p4.metric("Czas podglądu", f"{wynik['czas_s']:.2f} s")
+                            zakres = (f"{pd.Timestamp(wynik['data_min']):%Y-%m-%d} – {pd.Timestamp(wynik['data_max']):%Y-%m-%d}"
+                                      if pd.notna(wynik['data_min']) else "brak dat")
+                            st.caption(f"Zakres dat w próbce: {zakres} · Próbka: {wynik['probka']} ({wynik['wiersze_probki']:,} wierszy)")
+                            c_m1, c_m2 = st.columns([3, 2])
+                            c_m1.dataframe(wynik['mapowanie'], use_container_width=True, hide_index=True)
+                            c_m2.dataframe(wynik['waluty'], use_container_width=True, hide_index=True,
+                                           column_config={'Suma brutto (szac.)': st.column_config.NumberColumn(format="%.2f")})
                 if st.button("Przetwórz i wgraj do bazy", type="primary", use_container_width=True):
-                    with st.spinner("Przetwarzanie..."):
-                        dane_do_wgrania, blad = wczytaj_i_zunifikuj_pliki(przeslane_pliki, firma_upload)
-                    if blad: st.error(blad)
-                    elif dane_do_wgrania is not None:
-                        try:
-                            dane_do_wgrania.to_sql(NAZWA_TABELI, conn.engine, if_exists='append', index=False, schema=NAZWA_SCHEMATU)
-                            st.success(f"Wgrano {len(dane_do_wgrania)} rekordów.")
-                            wyczysc_duplikaty(conn)
-                        except Exception as e: st.error(f"Błąd zapisu: {e}")
+                    try:
+                        if tryb_strumieniowy:
+                            zapisane = wczytaj_strumieniowo_do_bazy(przeslane_pliki, firma_upload, conn, pomin_znane_pliki=pomin_znane)
+                        else:
+                            with st.spinner("Przetwarzanie..."):
+                                zapisane = wgraj_pliki_do_bazy(przeslane_pliki, firma_upload, conn, pomin_znane_pliki=pomin_znane)
+                        if zapisane:
+                            st.success(f"Wgrano {zapisane} nowych rekordów.")
+                        else:
+                            st.warning("Brak nowych rekordów do zapisania.")
+                    except Exception as e: st.error(f"Błąd zapisu: {e}")
+
+        with st.expander("Rejestr wgranych plików"):
+            rejestr = pobierz_rejestr_plikow(conn)
+            if rejestr.empty:
+                st.caption("Rejestr jest pusty.")
+            else:
+                st.dataframe(rejestr, use_container_width=True, hide_index=True)
+            st.markdown("###### Zakres danych w bazie (firma / źródło)")
+            st.dataframe(pobierz_zakresy_danych(conn), use_container_width=True, hide_index=True)
+
+        with st.expander("🧮 Zestawienie miesięczne"):
+            st.caption("Sumy transakcji per firma, miesiąc (i dzień) oraz identyfikator, z których korzystają Raport, Porównanie i Refaktury. "
+                       "Aktualizuje się przy każdym zapisie; przebudowa jest potrzebna tylko po ręcznych zmianach w bazie.")
+            if st.button("Przebuduj zestawienie miesięczne"):
+                with st.spinner("Przebudowa zestawienia..."):
+                    zapewnij_schemat_ingestu(conn)
+                    liczba = przebuduj_zestawienie_miesieczne(conn)
+                wyczysc_cache_odczytow()
+                st.success(f"Zestawienie przebudowane: {liczba} wierszy.")
+            if st.button("Przelicz oczyszczone identyfikatory", help="Po zmianie UNIX_ALIAS_MAPPING lub listy firm do usunięcia (robi się też samo przy starcie)"):
+                with st.spinner("Przeliczanie identyfikatorów..."):
+                    zapewnij_schemat_ingestu(conn)
+                    poprawione = przelicz_identyfikatory_clean(conn)
+                wyczysc_cache_odczytow()
+                st.success(f"Poprawiono identyfikator_clean w {poprawione} rekordach.")
+
+        with st.expander("💳 Rejestr kart paliwowych"):
+            st.caption("Numer karty (pełny albo końcówka) -> pojazd. Źródło puste = wszystkie formaty; daty puste = bez ograniczenia. "
+                       "Zmiany obowiązują przy kolejnych importach; dla plików w stagingu użyj 'Przelicz kategorie i pojazdy w bazie'.")
+            try:
+                zapewnij_schemat_ingestu(conn)
+                karty = pobierz_rejestr_kart(conn)
+                karty['valid_from'] = pd.to_datetime(karty['valid_from']).dt.date
+                karty['valid_to'] = pd.to_datetime(karty['valid_to']).dt.date
+                karty_edytowane = st.data_editor(
+                    karty,
+                    column_config={
+                        "card_number": st.column_config.TextColumn("Numer karty / końcówka", required=True),
+                        "vehicle": st.column_config.TextColumn("Pojazd", required=True),
+                        "source": st.column_config.SelectboxColumn("Źródło", options=list(NORMALIZATORY)),
+                        "valid_from": st.column_config.DateColumn("Ważna od"),
+                        "valid_to": st.column_config.DateColumn("Ważna do"),
+                    },
+                    num_rows="dynamic",
+                    hide_index=True,
+                    use_container_width=True,
+                    key="rejestr_kart_editor"
+                )
+                if st.button("Zapisz rejestr kart"):
+                    st.success(f"Zapisano {zapisz_rejestr_kart(conn, karty_edytowane)} kart.")
+            except Exception as e:
+                st.error(f"Błąd rejestru kart: {e}")
+
+        with st.expander("📦 Staging (cache znormalizowanych plików)"):
+            staging = lista_stagingu()
+            if staging.empty:
+                st.caption("Staging jest pusty - pliki trafiają tu przy pierwszym wgraniu.")
+            else:
+                st.dataframe(staging[['nazwa', 'format', 'wiersze', 'wersja', 'aktualna', 'utworzono', 'rozmiar_mb']],
+                             use_container_width=True, hide_index=True)
+                aktualne = staging[staging['aktualna']]
+                opisy = {f"{w['nazwa']} ({w['hash'][:12]})": w['hash'] for _, w in aktualne.iterrows()}
+                wybrane = st.multiselect("Pliki do odtworzenia", list(opisy), default=list(opisy), key="staging_wybrane")
+                hashe = [opisy[o] for o in wybrane]
+                c_s1, c_s2, c_s3 = st.columns(3)
+                if c_s1.button("Wgraj ponownie do bazy", disabled=not hashe, help=f"Bez parsowania plików; firma: {firma_upload}"):
+                    with st.spinner("Odtwarzanie..."):
+                        dodane = wgraj_ze_stagingu(conn, hashe, firma_upload)
+                    st.success(f"Dodano {dodane} nowych rekordów.")
+                if c_s2.button("Przelicz kategorie i pojazdy w bazie", disabled=not hashe, help="Po zmianie reguł kategoryzacji lub rejestru kart"):
+                    with st.spinner("Przeliczanie kategorii i pojazdów..."):
+                        zmienione = przelicz_kategorie_ze_stagingu(conn, hashe)
+                    st.success(f"Zmieniono kategorię lub pojazd w {zmienione} rekordach.")
+                if c_s3.button("Usuń nieaktualne wersje"):
+                    st.success(f"Usunięto {usun_nieaktualny_staging()} wpisów.")
 
     st.markdown("---")
     
@@ -1900,6 +4599,7 @@ def render_admin_content(conn, wybrana_firma):
         with c1:
             if st.button("1. Wyczyść WSZYSTKO (Transakcje + Płace)"):
                 setup_database(conn)
+                wyczysc_cache_odczytow()
                 st.success("Wyczyszczono całą tabelę transakcji.")
         with c2:
             if st.button("2. Wyczyść PLIKI"):
@@ -1908,21 +4608,29 @@ def render_admin_content(conn, wybrana_firma):
         with c3:
             if st.button("3. Wyczyść TYLKO Wynagrodzenia"):
                 wyczysc_wynagrodzenia(conn)
+                wyczysc_cache_odczytow()
+        try:
+            partycje = lista_partycji(conn)
+        except Exception:
+            partycje = []
+        if partycje:
+            c_p1, c_p2 = st.columns([2, 1])
+            miesiac_do_usuniecia = c_p1.selectbox("Miesiąc do usunięcia (cała partycja)", partycje, key="partycja_do_usuniecia")
+            if c_p2.button("4. Usuń wybrany miesiąc"):
+                usun_miesiac(conn, miesiac_do_usuniecia)
+                wyczysc_cache_odczytow()
+                st.success(f"Usunięto transakcje z miesiąca {miesiac_do_usuniecia}.")
 def render_raport_content(conn, wybrana_firma):
     st.subheader("Raport Paliw i Opłat")
     if wybrana_firma == "UNIX-TRANS":
         st.caption("Wyświetlam wydatki UNIX-TRANS (bez pojazdów obcych).")
     
     try:
-        min_max_date_query = f"SELECT MIN(data_transakcji::date), MAX(data_transakcji::date) FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI}"
-        min_max_date = conn.query(min_max_date_query)
+        domyslny_start, domyslny_stop = pobierz_zakres_dat(conn)
         
-        if min_max_date.empty or min_max_date.iloc[0, 0] is None:
+        if domyslny_start is None:
             st.info("Baza danych jest pusta. Wgraj pliki w Panelu Admina.")
             return
-
-        domyslny_start = min_max_date.iloc[0, 0]
-        domyslny_stop = min_max_date.iloc[0, 1]
         
         with st.container(border=True):
             st.markdown("##### Zakres Raportu")
@@ -1932,12 +4640,13 @@ def render_raport_content(conn, wybrana_firma):
             with col_r2:
                 data_stop_rap = st.date_input("Data Stop", value=domyslny_stop, min_value=domyslny_start, max_value=domyslny_stop, key="rap_stop")
 
-        dane_z_bazy_full = pobierz_dane_z_bazy(conn, data_start_rap, data_stop_rap, wybrana_firma)
+        # Sumy liczone w bazie - surowe transakcje dopiero w podglądzie pojedynczego pojazdu
+        agregaty = pobierz_agregaty_raportu(conn, data_start_rap, data_stop_rap, wybrana_firma)
         
-        if dane_z_bazy_full.empty:
+        if agregaty.empty:
             st.warning(f"Brak danych dla firmy {wybrana_firma} w wybranym zakresie dat.")
         else:
-            dane_przygotowane, mapa_kursow = przygotuj_dane_paliwowe(dane_z_bazy_full.copy(), wybrana_firma)
+            dane_przygotowane, mapa_kursow = przygotuj_agregaty_paliwowe(agregaty, wybrana_firma)
             
             if dane_przygotowane is None: st.stop()
             
@@ -1952,7 +4661,7 @@ def render_raport_content(conn, wybrana_firma):
                     
                     st.markdown("##### Wydatki paliwowe wg Kraju")
                     if 'kraj' in df_paliwo.columns:
-                        df_kraje = df_paliwo.groupby('kraj').agg(
+                        df_kraje = df_paliwo.groupby('kraj', observed=True).agg(
                             Suma_Netto=pd.NamedAgg(column='kwota_netto_eur', aggfunc='sum'),
                             Suma_Brutto=pd.NamedAgg(column='kwota_brutto_eur', aggfunc='sum')
                         ).sort_values(by='Suma_Brutto', ascending=False)
@@ -2014,11 +4723,11 @@ def render_raport_content(conn, wybrana_firma):
                         lista_pojazdow_paliwo = ["--- Wybierz pojazd ---"] + sorted(list(df_paliwo['identyfikator_clean'].unique()))
                         wybrany_pojazd_paliwo = st.selectbox("Wybierz identyfikator:", lista_pojazdow_paliwo)
                         if wybrany_pojazd_paliwo != "--- Wybierz pojazd ---":
-                            df_szczegoly = df_paliwo[df_paliwo['identyfikator_clean'] == wybrany_pojazd_paliwo].sort_values(by='data_transakcji_dt', ascending=False)
+                            df_szczegoly, lp_od = strona_transakcji_pojazdu(conn, "strony_paliwo", data_start_rap, data_stop_rap, wybrana_firma, wybrany_pojazd_paliwo, 'PALIWO')
                             df_szczegoly_display = df_szczegoly[['data_transakcji_dt', 'produkt', 'kraj', 'ilosc', 'kwota_brutto_eur', 'kwota_netto_eur', 'zrodlo']]
                             
                             df_szczegoly_display = df_szczegoly_display.rename(columns={'data_transakcji_dt': 'Data', 'produkt': 'Produkt', 'kraj': 'Kraj', 'ilosc': 'Litry', 'kwota_brutto_eur': 'Brutto (EUR)', 'kwota_netto_eur': 'Netto (EUR)', 'zrodlo': 'System'})
-                            df_szczegoly_display.insert(0, 'Lp.', range(1, 1 + len(df_szczegoly_display)))
+                            df_szczegoly_display.insert(0, 'Lp.', range(lp_od, lp_od + len(df_szczegoly_display)))
                             
                             st.dataframe(
                                 df_szczegoly_display,
@@ -2044,11 +4753,11 @@ def render_raport_content(conn, wybrana_firma):
                           lista_pojazdow_oplaty = ["--- Wybierz pojazd ---"] + sorted(list(df_oplaty['identyfikator_clean'].unique()))
                           wybrany_pojazd_oplaty = st.selectbox("Wybierz identyfikator:", lista_pojazdow_oplaty, key="select_oplaty")
                           if wybrany_pojazd_oplaty != "--- Wybierz pojazd ---":
-                              df_szczegoly_oplaty = df_oplaty[df_oplaty['identyfikator_clean'] == wybrany_pojazd_oplaty].sort_values(by='data_transakcji_dt', ascending=False)
+                              df_szczegoly_oplaty, lp_od = strona_transakcji_pojazdu(conn, "strony_oplaty", data_start_rap, data_stop_rap, wybrana_firma, wybrany_pojazd_oplaty, 'OPŁATA')
                               df_szczegoly_oplaty_display = df_szczegoly_oplaty[['data_transakcji_dt', 'produkt', 'kraj', 'kwota_brutto_eur', 'kwota_netto_eur', 'zrodlo']]
                               
                               df_szczegoly_oplaty_display = df_szczegoly_oplaty_display.rename(columns={'data_transakcji_dt': 'Data', 'produkt': 'Opis', 'kraj': 'Kraj', 'kwota_brutto_eur': 'Brutto (EUR)', 'kwota_netto_eur': 'Netto (EUR)', 'zrodlo': 'System'})
-                              df_szczegoly_oplaty_display.insert(0, 'Lp.', range(1, 1 + len(df_szczegoly_oplaty_display)))
+                              df_szczegoly_oplaty_display.insert(0, 'Lp.', range(lp_od, lp_od + len(df_szczegoly_oplaty_display)))
 
                               st.dataframe(
                                   df_szczegoly_oplaty_display,
@@ -2076,11 +4785,11 @@ def render_raport_content(conn, wybrana_firma):
                           lista_pojazdow_inne = ["--- Wybierz pojazd ---"] + sorted(list(df_inne['identyfikator_clean'].unique()))
                           wybrany_pojazd_inne = st.selectbox("Wybierz identyfikator:", lista_pojazdow_inne, key="select_inne")
                           if wybrany_pojazd_inne != "--- Wybierz pojazd ---":
-                              df_szczegoly_inne = df_inne[df_inne['identyfikator_clean'] == wybrany_pojazd_inne].sort_values(by='data_transakcji_dt', ascending=False)
+                              df_szczegoly_inne, lp_od = strona_transakcji_pojazdu(conn, "strony_inne", data_start_rap, data_stop_rap, wybrana_firma, wybrany_pojazd_inne, 'INNE')
                               df_szczegoly_inne_display = df_szczegoly_inne[['data_transakcji_dt', 'produkt', 'kraj', 'kwota_brutto_eur', 'kwota_netto_eur', 'zrodlo']]
                               
                               df_szczegoly_inne_display = df_szczegoly_inne_display.rename(columns={'data_transakcji_dt': 'Data', 'produkt': 'Opis', 'kraj': 'Kraj', 'kwota_brutto_eur': 'Brutto (EUR)', 'kwota_netto_eur': 'Netto (EUR)', 'zrodlo': 'System'})
-                              df_szczegoly_inne_display.insert(0, 'Lp.', range(1, 1 + len(df_szczegoly_inne_display)))
+                              df_szczegoly_inne_display.insert(0, 'Lp.', range(lp_od, lp_od + len(df_szczegoly_inne_display)))
 
                               st.dataframe(
                                   df_szczegoly_inne_display,
@@ -2092,14 +4801,13 @@ def render_raport_content(conn, wybrana_firma):
             
             # --- ZAKŁADKA WYNAGRODZENIA (Z BAZY) ---
             with sub_tab_wynagrodzenia:
-                # Pobieramy dane o typie WYNAGRODZENIE z df_z_bazy_full (przed filtracją prepared)
-                df_w = dane_z_bazy_full[dane_z_bazy_full['typ'] == 'WYNAGRODZENIE'].copy()
+                # Sumy wynagrodzeń z agregatów (przed filtracją firm, jak dotąd)
+                df_w = agregaty[agregaty['typ'] == 'WYNAGRODZENIE'].copy()
                 
                 if df_w.empty:
                     st.info("Brak danych o wynagrodzeniach w tym okresie. Przejdź do Panelu Administratora, wgraj plik Excel i zapisz wyniki do bazy.")
                 else:
-                    # Konwersja na liczby dla pewności
-                    df_w['kwota_brutto'] = pd.to_numeric(df_w['kwota_brutto'], errors='coerce').fillna(0)
+                    df_w['kwota_brutto'] = df_w['kwota_brutto'].fillna(0)
                     
                     suma_wyn = df_w['kwota_brutto'].sum()
                     st.metric("Łączne Wynagrodzenia (Przypisane)", f"{suma_wyn:,.2f} PLN", border=True)
@@ -2113,7 +4821,9 @@ def render_raport_content(conn, wybrana_firma):
                     st.dataframe(grp_w.style.format({'Kwota (PLN)': '{:,.2f} PLN'}), use_container_width=True, hide_index=True)
                     
                     with st.expander("Szczegóły zapisów w bazie"):
-                        st.dataframe(df_w[['data_transakcji', 'identyfikator', 'kwota_brutto', 'zrodlo']])
+                        if st.toggle("Wczytaj zapisy z bazy", key="rap_wyn_szczegoly"):
+                            st.dataframe(pobierz_dane_z_bazy(conn, data_start_rap, data_stop_rap, wybrana_firma, typ='WYNAGRODZENIE',
+                                                             kolumny=['data_transakcji', 'identyfikator', 'kwota_brutto', 'zrodlo']))
 
     except Exception as e:
         st.error(f"Błąd raportu: {e}")
@@ -2123,13 +4833,9 @@ def render_rentownosc_content(conn, wybrana_firma):
     
     # 1. Pobieranie zakresu dat z bazy
     try:
-        min_max_date_query = f"SELECT MIN(data_transakcji::date), MAX(data_transakcji::date) FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI}"
-        min_max_date = conn.query(min_max_date_query)
-        domyslny_start = date.today()
-        domyslny_stop = date.today()
-        if not min_max_date.empty and min_max_date.iloc[0, 0] is not None:
-            domyslny_start = min_max_date.iloc[0, 0]
-            domyslny_stop = min_max_date.iloc[0, 1]
+        domyslny_start, domyslny_stop = pobierz_zakres_dat(conn)
+        if domyslny_start is None:
+            domyslny_start, domyslny_stop = date.today(), date.today()
     except:
         domyslny_start, domyslny_stop = date.today(), date.today()
 
@@ -2169,20 +4875,19 @@ def render_rentownosc_content(conn, wybrana_firma):
         else:
             with st.spinner("Obliczam VAT i Rentowność..."):
                 # A. Pobieramy dane z bazy (Paliwo + Wypłaty)
-                df_baza_raw = pobierz_dane_z_bazy(conn, data_start, data_stop, wybrana_firma)
-                df_baza_calc, _ = przygotuj_dane_paliwowe(df_baza_raw, wybrana_firma)
-                
-                st.session_state['dane_bazy_raw'] = df_baza_calc
+                # Sumy per pojazd i typ - transakcje są zwijane paczka po paczce
+                sumy_baza, kurs_eur, mapa_kursow = sumy_kosztow_paczkami(conn, data_start, data_stop, wybrana_firma)
 
                 # B. Inicjalizacja DataFrame'ów
                 df_koszty_paliwo_brutto = pd.DataFrame()
                 df_koszty_paliwo_netto = pd.DataFrame()
                 df_koszty_wynagr = pd.DataFrame()
 
-                if not df_baza_calc.empty:
+                if not sumy_baza.empty:
                     # Filtrujemy śmieci i zakazane pojazdy
-                    maska_zakaz = df_baza_calc['identyfikator_clean'].apply(czy_zakazany_pojazd_global)
-                    df_clean = df_baza_calc[~maska_zakaz]
+                    flagi = pobierz_flagi_pojazdow(conn)
+                    maska_zakaz = flaga_pojazdow(sumy_baza['identyfikator_clean'], flagi, 'zakazany', czy_zakazany_pojazd_global)
+                    df_clean = sumy_baza[~maska_zakaz]
                     
                     # 1. PALIWO I OPŁATY (Brutto i Netto)
                     df_paliwo = df_clean[df_clean['typ'] != 'WYNAGRODZENIE']
@@ -2265,7 +4970,7 @@ def render_rentownosc_content(conn, wybrana_firma):
                     st.session_state['df_rentownosc'] = final.sort_values(by='ZYSK_EUR', ascending=False)
                     st.session_state['raport_gotowy'] = True
                     # Dodajemy kolumnę pomocniczą do filtrowania
-                    final['czy_pojazd'] = final.index.map(klasyfikuj_wpis)
+                    final['czy_pojazd'] = flaga_pojazdow(final.index, pobierz_flagi_pojazdow(conn), 'operacyjny', klasyfikuj_wpis)
                     
                     # Rozdzielamy dane
                     df_rentownosc_pojazdy = final[final['czy_pojazd'] == True].drop(columns=['czy_pojazd'])
@@ -2274,6 +4979,10 @@ def render_rentownosc_content(conn, wybrana_firma):
                     # Zapisujemy do session_state tylko POJAZDY dla głównej tabeli
                     st.session_state['df_rentownosc'] = df_rentownosc_pojazdy.sort_values(by='ZYSK_EUR', ascending=False)
                     st.session_state['df_koszty_ogolne_suma'] = df_koszty_ogolne_do_bilansu # Zachowujemy resztę do metryk
+                    st.session_state['rentownosc_zakres'] = (data_start, data_stop)
+                    # Excel dopiero na żądanie (przycisk niżej) - arkusze pojazdów to zapytanie na pojazd
+                    st.session_state['rentownosc_do_excela'] = (sumy_baza['identyfikator_clean'].unique(), kurs_eur, mapa_kursow)
+                    st.session_state.pop('rentownosc_excel', None)
     # --- WIDOK RAPORTU ---
     if st.session_state.get('raport_gotowy'):
         st.markdown("---")
@@ -2342,15 +5051,23 @@ def render_rentownosc_content(conn, wybrana_firma):
             height=500
         )
 
-        # 4. Przycisk Excel
-        excel_bytes = to_excel_extended(df_final, df_raw_analiza, st.session_state.get('dane_bazy_raw'))
-        st.download_button(
-            label="📥 Pobierz PEŁNY Raport Excel (Ze szczegółami VAT)",
-            data=excel_bytes,
-            file_name=f"rentownosc_VAT_{wybrana_firma}_{date.today()}.xlsx",
-            mime="application/vnd.ms-excel",
-            type="primary"
-        )
+        # 4. Przycisk Excel - skoroszyt budowany dopiero na żądanie (transakcje czytane pojazd po pojeździe)
+        if 'rentownosc_excel' not in st.session_state:
+            if st.button("📊 Przygotuj PEŁNY Raport Excel (Ze szczegółami VAT)", key="rentownosc_przygotuj_excel"):
+                pojazdy_paliwo, kurs_eur, mapa_kursow = st.session_state['rentownosc_do_excela']
+                data_start_rap, data_stop_rap = st.session_state['rentownosc_zakres']
+                with st.spinner("Buduję raport Excel..."):
+                    st.session_state['rentownosc_excel'] = to_excel_extended(
+                        df_final, df_raw_analiza, pojazdy_paliwo,
+                        lambda pojazd: transakcje_pojazdu_do_excela(conn, data_start_rap, data_stop_rap, wybrana_firma, pojazd, kurs_eur, mapa_kursow))
+        if 'rentownosc_excel' in st.session_state:
+            st.download_button(
+                label="📥 Pobierz PEŁNY Raport Excel (Ze szczegółami VAT)",
+                data=st.session_state['rentownosc_excel'],
+                file_name=f"rentownosc_VAT_{wybrana_firma}_{date.today()}.xlsx",
+                mime="application/vnd.ms-excel",
+                type="primary"
+            )
 
         st.markdown("---")
 
@@ -2370,62 +5087,63 @@ def render_rentownosc_content(conn, wybrana_firma):
             d4.metric("VAT z Zakupów", f"{(row['VAT_PALIWO_EUR'] + row['VAT_INNE_EUR']):,.2f} €")
             d5.metric("Kierowca", f"{row['KOSZT_KIEROWCA_EUR']:,.2f} €")
 
-            details = []
-            
-            # Detale z Subiekta (Pokazujemy Brutto i Netto)
-            if df_raw_analiza is not None:
+            formaty_kwot = {'Brutto (EUR)': '{:,.2f} €', 'Netto (EUR)': '{:,.2f} €', 'VAT (Calc)': '{:,.2f} €'}
+
+            # Detale z Subiekta (Pokazujemy Brutto i Netto) - cały pojazd, są już w sesji
+            st.markdown("##### Przychody i koszty z pliku (Subiekt / Fakturownia)")
+            sub_rows = pd.DataFrame()
+            if df_raw_analiza is not None and not df_raw_analiza.empty:
                 sub_rows = df_raw_analiza[df_raw_analiza['pojazd_clean'] == wybrany].copy()
-                if not sub_rows.empty:
-                    # Odwracamy koszty dla wizualizacji
-                    mask_koszt = sub_rows['typ'] == 'Koszt (Subiekt)'
-                    sub_rows.loc[mask_koszt, 'kwota_brutto_eur'] *= -1
-                    sub_rows.loc[mask_koszt, 'kwota_netto_eur'] *= -1
-                    
-                    sub_rows = sub_rows[['data', 'opis', 'typ', 'kwota_brutto_eur', 'kwota_netto_eur']]
-                    sub_rows.columns = ['Data', 'Opis', 'Typ', 'Brutto (EUR)', 'Netto (EUR)']
-                    details.append(sub_rows)
-
-            # Detale z Bazy (Paliwo/Wynagr)
-            df_baza_raw = st.session_state.get('dane_bazy_raw')
-            if df_baza_raw is not None:
-                baza_rows = df_baza_raw[df_baza_raw['identyfikator_clean'] == wybrany].copy()
-                if not baza_rows.empty:
-                    baza_rows['kwota_brutto_eur'] = -baza_rows['kwota_brutto_eur'].abs()
-                    baza_rows['kwota_netto_eur'] = -baza_rows['kwota_netto_eur'].abs()
-                    
-                    baza_view = pd.DataFrame()
-                    baza_view['Data'] = baza_rows['data_transakcji_dt'].dt.date
-                    baza_view['Opis'] = baza_rows['produkt']
-                    baza_view['Typ'] = baza_rows['typ']
-                    baza_view['Brutto (EUR)'] = baza_rows['kwota_brutto_eur']
-                    baza_view['Netto (EUR)'] = baza_rows['kwota_netto_eur']
-                    details.append(baza_view)
-
-            if details:
-                full_details = pd.concat(details).sort_values(by='Data', ascending=False).reset_index(drop=True)
-                full_details['VAT (Calc)'] = full_details['Brutto (EUR)'] - full_details['Netto (EUR)']
-                
+            if not sub_rows.empty:
+                # Odwracamy koszty dla wizualizacji
+                mask_koszt = sub_rows['typ'] == 'Koszt (Subiekt)'
+                sub_rows.loc[mask_koszt, 'kwota_brutto_eur'] *= -1
+                sub_rows.loc[mask_koszt, 'kwota_netto_eur'] *= -1
+
+                sub_view = sub_rows[['data', 'opis', 'typ', 'kwota_brutto_eur', 'kwota_netto_eur']]
+                sub_view.columns = ['Data', 'Opis', 'Typ', 'Brutto (EUR)', 'Netto (EUR)']
+                sub_view = sub_view.sort_values(by='Data', ascending=False).reset_index(drop=True)
+                sub_view['VAT (Calc)'] = sub_view['Brutto (EUR)'] - sub_view['Netto (EUR)']
+                sub_view.insert(0, 'Lp.', range(1, 1 + len(sub_view)))
                 st.dataframe(
-                    full_details.style.format({'Brutto (EUR)': '{:,.2f} €', 'Netto (EUR)': '{:,.2f} €', 'VAT (Calc)': '{:,.2f} €'})
-                                      .map(lambda x: 'color: green' if x > 0 else 'color: red', subset=['Brutto (EUR)']),
+                    sub_view.style.format(formaty_kwot)
+                                  .map(lambda x: 'color: green' if x > 0 else 'color: red', subset=['Brutto (EUR)']),
                     use_container_width=True,
                     hide_index=True,
                     column_config={"Data": st.column_config.DateColumn("Data")}
                 )
             else:
-                st.info("Brak szczegółowych transakcji dla tego pojazdu.")
+                st.info("Brak pozycji z pliku dla tego pojazdu.")
+
+            # Detale z Bazy (Paliwo/Wynagr) - strona po stronie, zapytaniem tylko dla wybranego pojazdu
+            st.markdown("##### Koszty z bazy (Paliwo / Opłaty / Wynagrodzenia)")
+            data_start_rap, data_stop_rap = st.session_state.get('rentownosc_zakres', (data_start, data_stop))
+            baza_rows, lp_od = strona_transakcji_pojazdu(conn, "strony_rentownosc", data_start_rap, data_stop_rap, wybrana_firma, wybrany)
+            if not baza_rows.empty:
+                baza_view = pd.DataFrame()
+                baza_view['Data'] = baza_rows['data_transakcji_dt']
+                baza_view['Opis'] = baza_rows['produkt']
+                baza_view['Typ'] = baza_rows['typ']
+                baza_view['Brutto (EUR)'] = -baza_rows['kwota_brutto_eur'].abs()
+                baza_view['Netto (EUR)'] = -baza_rows['kwota_netto_eur'].abs()
+                baza_view['VAT (Calc)'] = baza_view['Brutto (EUR)'] - baza_view['Netto (EUR)']
+                baza_view.insert(0, 'Lp.', range(lp_od, lp_od + len(baza_view)))
+                st.dataframe(
+                    baza_view.style.format(formaty_kwot),
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={"Data": st.column_config.DatetimeColumn(format="YYYY-MM-DD HH:mm")}
+                )
+            else:
+                st.info("Brak transakcji z bazy dla tego pojazdu.")
 def render_refaktury_content(conn, wybrana_firma):
     st.subheader("Refaktury Kosztów (Wzajemne)")
     st.info("Ta sekcja pokazuje koszty paliwa/opłat poniesione przez jedną firmę na rzecz aut drugiej firmy oraz rzeczywiste faktury sprzedaży wystawione na drugą firmę.")
     
     try:
-        min_max_date_query = f"SELECT MIN(data_transakcji::date), MAX(data_transakcji::date) FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI}"
-        min_max_date = conn.query(min_max_date_query)
-        domyslny_start_ref = date.today()
-        domyslny_stop_ref = date.today()
-        if not min_max_date.empty and min_max_date.iloc[0, 0] is not None:
-            domyslny_start_ref = min_max_date.iloc[0, 0]
-            domyslny_stop_ref = min_max_date.iloc[0, 1]
+        domyslny_start_ref, domyslny_stop_ref = pobierz_zakres_dat(conn)
+        if domyslny_start_ref is None:
+            domyslny_start_ref, domyslny_stop_ref = date.today(), date.today()
             
         with st.container(border=True):
             st.markdown("##### Ustawienia")
@@ -2443,9 +5161,14 @@ def render_refaktury_content(conn, wybrana_firma):
             zapisany_plik_bytes = wczytaj_plik_z_bazy(conn, nazwa_pliku_analizy)
             if zapisany_plik_bytes:
                 plik_analizy = io.BytesIO(zapisany_plik_bytes)
+            szczegoly_ref = st.checkbox("Pokaż też pojedyncze transakcje (wolniej - czyta wszystkie transakcje zakresu)", key="ref_szczegoly")
             
         if st.button("🔎 Pokaż koszty do refaktury", type="primary"):
-            df_holier_to_unix, df_unix_to_holier, _ = pobierz_dane_do_refaktury(conn, data_start_ref, data_stop_ref)
+            # Sumy pojazdów z kostki sum narastających; transakcje czytamy tylko dla szczegółów
+            agg_ref, agg_ref_2 = sumy_refaktur_z_agregatow(sumy_okresu(conn, "UNIX-TRANS", data_start_ref, data_stop_ref))
+            df_holier_to_unix, df_unix_to_holier = None, None
+            if szczegoly_ref:
+                df_holier_to_unix, df_unix_to_holier, _ = pobierz_dane_do_refaktury(conn, data_start_ref, data_stop_ref)
             
             df_rzeczywiste_refaktury = pd.DataFrame()
             if plik_analizy:
@@ -2464,67 +5187,59 @@ def render_refaktury_content(conn, wybrana_firma):
             
             with tab_h2u:
                 st.markdown("### Koszty Holiera na rzecz aut UNIX (Obliczone z kart paliwowych)")
-                if df_holier_to_unix is None or df_holier_to_unix.empty:
+                if agg_ref is None or agg_ref.empty:
                     st.success("Brak kosztów w tym kierunku.")
                 else:
                     col_met1, col_met2 = st.columns(2)
-                    col_met1.metric("Do refaktury (Netto)", f"{df_holier_to_unix['kwota_netto_eur'].sum():,.2f} EUR", border=True)
-                    col_met2.metric("Do refaktury (Brutto)", f"{df_holier_to_unix['kwota_brutto_eur'].sum():,.2f} EUR", border=True)
+                    col_met1.metric("Do refaktury (Netto)", f"{agg_ref['Suma_Netto'].sum():,.2f} EUR", border=True)
+                    col_met2.metric("Do refaktury (Brutto)", f"{agg_ref['Suma_Brutto'].sum():,.2f} EUR", border=True)
                     
                     st.markdown("##### Podział na pojazdy")
-                    agg_ref = df_holier_to_unix.groupby('identyfikator_clean').agg(
-                        Suma_Netto=pd.NamedAgg(column='kwota_netto_eur', aggfunc='sum'),
-                        Suma_Brutto=pd.NamedAgg(column='kwota_brutto_eur', aggfunc='sum')
-                    ).sort_values(by='Suma_Brutto', ascending=False)
-                    
                     agg_ref_show = agg_ref.reset_index()
                     agg_ref_show.insert(0, 'Lp.', range(1, 1 + len(agg_ref_show)))
                     st.dataframe(agg_ref_show.style.format("{:,.2f} EUR", subset=['Suma_Netto', 'Suma_Brutto']), use_container_width=True, hide_index=True)
                     
-                    with st.expander("Szczegóły transakcji"):
-                        df_ref_show = df_holier_to_unix[['data_transakcji_dt', 'identyfikator_clean', 'produkt', 'kraj', 'kwota_netto_eur', 'kwota_brutto_eur', 'zrodlo']].sort_values(by='data_transakcji_dt', ascending=False).copy()
-                        df_ref_show.insert(0, 'Lp.', range(1, 1 + len(df_ref_show)))
+                    if df_holier_to_unix is not None and not df_holier_to_unix.empty:
+                        with st.expander("Szczegóły transakcji"):
+                            df_ref_show = df_holier_to_unix[['data_transakcji_dt', 'identyfikator_clean', 'produkt', 'kraj', 'kwota_netto_eur', 'kwota_brutto_eur', 'zrodlo']].sort_values(by='data_transakcji_dt', ascending=False).copy()
+                            df_ref_show.insert(0, 'Lp.', range(1, 1 + len(df_ref_show)))
 
-                        st.dataframe(
-                            df_ref_show,
-                            use_container_width=True,
-                            hide_index=True,
-                            column_config={
-                                "data_transakcji_dt": st.column_config.DatetimeColumn("Data", format="YYYY-MM-DD HH:mm"), "kwota_brutto_eur": st.column_config.NumberColumn("Brutto", format="%.2f EUR")
-                            }
-                        )
+                            st.dataframe(
+                                df_ref_show,
+                                use_container_width=True,
+                                hide_index=True,
+                                column_config={
+                                    "data_transakcji_dt": st.column_config.DatetimeColumn("Data", format="YYYY-MM-DD HH:mm"), "kwota_brutto_eur": st.column_config.NumberColumn("Brutto", format="%.2f EUR")
+                                }
+                            )
 
             with tab_u2h:
                 st.markdown("### Koszty UNIX na rzecz aut Holiera (Obliczone z kart paliwowych)")
-                if df_unix_to_holier is None or df_unix_to_holier.empty:
+                if agg_ref_2 is None or agg_ref_2.empty:
                     st.success("Brak kosztów w tym kierunku.")
                 else:
                     col_met1, col_met2 = st.columns(2)
-                    col_met1.metric("Do refaktury (Netto)", f"{df_unix_to_holier['kwota_netto_eur'].sum():,.2f} EUR", border=True)
-                    col_met2.metric("Do refaktury (Brutto)", f"{df_unix_to_holier['kwota_brutto_eur'].sum():,.2f} EUR", border=True)
+                    col_met1.metric("Do refaktury (Netto)", f"{agg_ref_2['Suma_Netto'].sum():,.2f} EUR", border=True)
+                    col_met2.metric("Do refaktury (Brutto)", f"{agg_ref_2['Suma_Brutto'].sum():,.2f} EUR", border=True)
                     
                     st.markdown("##### Podział na pojazdy")
-                    agg_ref_2 = df_unix_to_holier.groupby('identyfikator_clean').agg(
-                        Suma_Netto=pd.NamedAgg(column='kwota_netto_eur', aggfunc='sum'),
-                        Suma_Brutto=pd.NamedAgg(column='kwota_brutto_eur', aggfunc='sum')
-                    ).sort_values(by='Suma_Brutto', ascending=False)
-                    
                     agg_ref_2_show = agg_ref_2.reset_index()
                     agg_ref_2_show.insert(0, 'Lp.', range(1, 1 + len(agg_ref_2_show)))
                     st.dataframe(agg_ref_2_show.style.format("{:,.2f} EUR", subset=['Suma_Netto', 'Suma_Brutto']), use_container_width=True, hide_index=True)
                     
-                    with st.expander("Szczegóły transakcji"):
-                        df_ref_show_2 = df_unix_to_holier[['data_transakcji_dt', 'identyfikator_clean', 'produkt', 'kraj', 'kwota_netto_eur', 'kwota_brutto_eur', 'zrodlo']].sort_values(by='data_transakcji_dt', ascending=False).copy()
-                        df_ref_show_2.insert(0, 'Lp.', range(1, 1 + len(df_ref_show_2)))
+                    if df_unix_to_holier is not None and not df_unix_to_holier.empty:
+                        with st.expander("Szczegóły transakcji"):
+                            df_ref_show_2 = df_unix_to_holier[['data_transakcji_dt', 'identyfikator_clean', 'produkt', 'kraj', 'kwota_netto_eur', 'kwota_brutto_eur', 'zrodlo']].sort_values(by='data_transakcji_dt', ascending=False).copy()
+                            df_ref_show_2.insert(0, 'Lp.', range(1, 1 + len(df_ref_show_2)))
 
-                        st.dataframe(
-                            df_ref_show_2,
-                            use_container_width=True,
-                            hide_index=True,
-                            column_config={
-                                "data_transakcji_dt": st.column_config.DatetimeColumn("Data", format="YYYY-MM-DD HH:mm"), "kwota_brutto_eur": st.column_config.NumberColumn("Brutto", format="%.2f EUR")
-                            }
-                        )
+                            st.dataframe(
+                                df_ref_show_2,
+                                use_container_width=True,
+                                hide_index=True,
+                                column_config={
+                                    "data_transakcji_dt": st.column_config.DatetimeColumn("Data", format="YYYY-MM-DD HH:mm"), "kwota_brutto_eur": st.column_config.NumberColumn("Brutto", format="%.2f EUR")
+                                }
+                            )
             
             with tab_rzecz:
                 st.markdown(f"### Zaksięgowane Faktury Sprzedaży na rzecz drugiej firmy (z pliku)")
@@ -2611,8 +5326,9 @@ def render_porownanie_content(conn, wybrana_firma):
             plik_analizy = uploaded
 
     def pobierz_agregacje(d_start, d_stop):
-        df_baza = pobierz_dane_z_bazy(conn, d_start, d_stop, wybrana_firma)
-        df_baza, _ = przygotuj_dane_paliwowe(df_baza.copy(), wybrana_firma)
+        # Sumy pojazdów dla dowolnego okresu to różnice kolumn kostki sum narastających - bez zapytania per okres
+        agregaty = sumy_okresu(conn, wybrana_firma, d_start, d_stop)
+        df_baza = przygotuj_agregaty_paliwowe(agregaty, wybrana_firma)[0] if not agregaty.empty else None
         
         agg_baza = pd.DataFrame()
         if df_baza is not None and not df_baza.empty:
@@ -2625,7 +5341,7 @@ def render_porownanie_content(conn, wybrana_firma):
             maska_none = df_baza['identyfikator_clean'].astype(str).str.upper() == "NONE"
             df_baza = df_baza[~maska_none]
             
-            agg_baza = df_baza.groupby(['identyfikator_clean', 'typ'])['kwota_brutto_eur'].sum().unstack(fill_value=0)
+            agg_baza = df_baza.groupby(['identyfikator_clean', 'typ'], observed=True)['kwota_brutto_eur'].sum().unstack(fill_value=0)
             for col in ['PALIWO', 'OPŁATA', 'INNE']:
                 if col not in agg_baza.columns: agg_baza[col] = 0.0
             
@@ -2778,9 +5494,9 @@ def render_ogolne_content(conn, wybrana_firma):
 
     # 1. Zakres dat
     try:
-        min_max = conn.query(f"SELECT MIN(data_transakcji::date), MAX(data_transakcji::date) FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI}")
-        domyslny_start = min_max.iloc[0, 0] if not min_max.empty and min_max.iloc[0, 0] is not None else date.today()
-        domyslny_stop = min_max.iloc[0, 1] if not min_max.empty and min_max.iloc[0, 1] is not None else date.today()
+        domyslny_start, domyslny_stop = pobierz_zakres_dat(conn)
+        if domyslny_start is None:
+            domyslny_start, domyslny_stop = date.today(), date.today()
     except:
         domyslny_start, domyslny_stop = date.today(), date.today()
 
@@ -2880,6 +5596,8 @@ def pobierz_dane_z_nexo_direct(start_date, end_date):
       AND d.Symbol IN ('FS', 'FZ', 'KFS', 'KFZ', 'PA')
     """
     try:
+        # Import dopiero tutaj: pyodbc wymaga systemowego libodbc, potrzebnego tylko do połączenia z Nexo
+        import pyodbc
         conn = pyodbc.connect(conn_str)
         df = pd.read_sql(query, conn, params=[start_date, end_date])
         conn.close()
@@ -2889,42 +5607,43 @@ def pobierz_dane_z_nexo_direct(start_date, end_date):
         return pd.DataFrame()
 
 def synchronizuj_nexo_z_baza(start_date, end_date, firma_tag, conn):
-    """Pobiera z Nexo i zapisuje do lokalnej bazy, unikając duplikatów."""
+    """Pobiera z Nexo i zapisuje do lokalnej bazy (COPY), unikając duplikatów. Zwraca (dodane, czas zapisu w s)."""
     raw_df = pobierz_dane_z_nexo_direct(start_date, end_date)
     if raw_df.empty:
-        return 0
-
-    dodane = 0
+        return 0, 0.0
+    raw_df['data_transakcji'] = pd.to_datetime(raw_df['data_transakcji'])
+    df = pd.DataFrame({
+        'data_transakcji': raw_df['data_transakcji'],
+        # Rejestracje z uwag Nexo - cała kolumna naraz
+        'identyfikator': dopasuj_pojazdy(raw_df['uwagi']),
+        'kwota_netto': raw_df['kwota_netto'],
+        'kwota_brutto': raw_df['kwota_brutto'],
+        'waluta': raw_df['waluta'],
+        'ilosc': 1.0,
+        # Unikalny identyfikator dokumentu (typ + numer + data + firma)
+        'produkt': raw_df['symbol_dok'].astype(str) + ": " + raw_df['numer_doc'].astype(str),
+        'typ': np.where(raw_df['symbol_dok'].isin(['FS', 'KFS', 'PA']), 'PRZYCHÓD', 'KOSZT'),
+        'zrodlo': 'NEXO_DIRECT',
+        'kraj': 'PL',
+        'firma': firma_tag,
+        'kontrahent': raw_df['kontrahent'],
+    })
+
+    zapewnij_schemat_ingestu(conn)
+    # SPRAWDZANIE DUPLIKATU: dokumenty Nexo (produkt + data) już zapisane dla firmy - jednym zapytaniem po zakresie dat.
+    # Tylko zrodlo NEXO_DIRECT - wiersz innego źródła z tym samym produktem i datą nie jest dokumentem Nexo
     with conn.session as s:
-        for _, row in raw_df.iterrows():
-            # Unikalny identyfikator dokumentu (typ + numer + data + firma)
-            ident_wpisu = f"{row['symbol_dok']}: {row['numer_doc']}"
-            
-            # SPRAWDZANIE DUPLIKATU: Szukamy czy taki wpis już jest
-            exists = s.execute(text(f"""
-                SELECT 1 FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI} 
-                WHERE produkt = :prod AND data_transakcji = :dt AND firma = :f
-            """), {"prod": ident_wpisu, "dt": row['data_transakcji'], "f": firma_tag}).fetchone()
-
-            if not exists:
-                # Wyciąganie rejestracji z uwag Nexo (Twoja logika)
-                match = re.search(r'\b[A-Z]{2,3}[\s-]?[0-9A-Z]{4,5}\b', str(row['uwagi']).upper())
-                pojazd = match.group(0).replace(" ", "").replace("-", "") if match else "Brak Pojazdu"
-                
-                typ_fin = 'PRZYCHÓD' if row['symbol_dok'] in ['FS', 'KFS', 'PA'] else 'KOSZT'
-                
-                s.execute(text(f"""
-                    INSERT INTO {NAZWA_SCHEMATU}.{NAZWA_TABELI} 
-                    (data_transakcji, identyfikator, kwota_netto, kwota_brutto, waluta, ilosc, produkt, typ, zrodlo, kraj, firma, kontrahent)
-                    VALUES (:dt, :ident, :netto, :brutto, :wal, 1.0, :prod, :typ, 'NEXO_DIRECT', 'PL', :f, :kontr)
-                """), {
-                    "dt": row['data_transakcji'], "ident": pojazd, "netto": row['kwota_netto'],
-                    "brutto": row['kwota_brutto'], "wal": row['waluta'], "prod": ident_wpisu,
-                    "typ": typ_fin, "f": firma_tag, "kontr": row['kontrahent']
-                })
-                dodane += 1
-        s.commit()
-    return dodane
+        zapisane = pd.DataFrame(s.execute(text(f"""
+            SELECT produkt, data_transakcji FROM {NAZWA_SCHEMATU}.{NAZWA_TABELI}
+            WHERE firma = :f AND zrodlo = 'NEXO_DIRECT' AND data_transakcji >= :od AND data_transakcji <= :do
+        """), {"f": firma_tag, "od": df['data_transakcji'].min().to_pydatetime(),
+               "do": df['data_transakcji'].max().to_pydatetime()}).fetchall(), columns=['produkt', 'data_transakcji'])
+    df = df.drop_duplicates(subset=['produkt', 'data_transakcji'])
+    if not zapisane.empty:
+        zapisane['data_transakcji'] = pd.to_datetime(zapisane['data_transakcji'])
+        klucze = pd.MultiIndex.from_frame(df[['produkt', 'data_transakcji']])
+        df = df[~klucze.isin(pd.MultiIndex.from_frame(zapisane))]
+    return zapisz_nowe_wiersze(conn, df)
 def main_app():
     if 'active_company' not in st.session_state: st.session_state.active_company = FIRMY[0]
     if 'active_view' not in st.session_state: st.session_state.active_view = 'Raport'
@@ -2989,11 +5708,21 @@ def main_app():
             st.session_state.show_admin = True
             st.rerun()
         if st.button("🧹 Wyczyść Cache"):
-            st.cache_data.clear()
+            wyczysc_cache_odczytow()
             st.rerun() 
             
     try: conn = st.connection(NAZWA_POLACZENIA_DB, type="sql")
     except Exception as e: st.error("Błąd połączenia z DB."); st.stop()
+    if not st.session_state.get('migracje_wykonane'):
+        try:
+            zastosuj_migracje(conn)
+            zapewnij_aktualne_identyfikatory(conn)
+            zapewnij_aktualne_wymiary(conn)
+            st.session_state.migracje_wykonane = True
+        except Exception as e:
+            st.warning(f"Nie udało się zaktualizować schematu bazy: {e}")
+    try: odswiez_flote(conn)
+    except Exception: pass
 
     firma = st.session_state.active_company
     
@@ -0,0 +1,132 @@
+"""
+Lokalny zastępnik API kart paliwowych (Eurowag / E100) do testów i pomiarów konektorów bez sieci.
+
+Pomiar przepustowości z wiersza poleceń (z katalogu repozytorium, nic nie trafia do bazy):
+    python -m tests.api_testowe Eurowag HOLIER 20000
+"""
+import json
+import math
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+
+import analizator as a
+
+# Transakcja nr i ma czas poczatek + i * odstep_s (UTC), a jej pola wynikają z numeru, więc serwer nie trzyma
+# danych w pamięci i odpowiada tak samo przy każdym zapytaniu. Czas wysyłany jest z przesunięciem strefy
+# Europe/Warsaw - jak w prawdziwych API, łącznie ze zmianą przesunięcia przy zmianie czasu.
+TABLICE_TESTOWE_API = ['WGM8463A', 'WPR9335N', 'WPR9685N', 'PTU3287F', 'WPR0103U']
+USLUGI_TESTOWE_API = ['Diesel', 'AdBlue', 'Toll', 'Parking', 'Diesel']
+KRAJE_TESTOWE_API = [('PL', 'PLN'), ('DE', 'EUR'), ('CZ', 'CZK'), ('AT', 'EUR')]
+
+def czas_testowy_api(poczatek, nr, odstep_s):
+    return poczatek + pd.Timedelta(seconds=nr * odstep_s)
+
+def rekord_testowy_api(zrodlo, nr, czas):
+    # Różne ziarno i pojazd per źródło - inaczej transakcje nr i z obu API miałyby ten sam klucz naturalny
+    ziarno = nr * (7919 if zrodlo == 'Eurowag' else 104729)
+    kraj, waluta = KRAJE_TESTOWE_API[nr % len(KRAJE_TESTOWE_API)]
+    usluga = USLUGI_TESTOWE_API[nr % len(USLUGI_TESTOWE_API)]
+    ilosc = round(20 + ziarno % 400 / 2, 2)
+    brutto = round(ilosc * 1.55 + ziarno % 97 / 100, 2)
+    tablica = TABLICE_TESTOWE_API[(nr // 3 + (0 if zrodlo == 'Eurowag' else 1)) % len(TABLICE_TESTOWE_API)]
+    karta = f"70012345{nr % 100:02d}"
+    czas = czas.tz_convert('Europe/Warsaw').isoformat()
+    if zrodlo == 'Eurowag':
+        return {
+            'transactionDateTime': czas, 'licensePlate': tablica, 'cardHolder': None, 'cardNumber': karta,
+            'netAmount': round(brutto / (1 + a.VAT_RATES[kraj]), 2), 'grossAmount': brutto, 'currency': waluta,
+            'quantity': ilosc, 'country': kraj, 'serviceName': usluga, 'articleName': usluga.upper(), 'productName': None,
+        }
+    return {
+        'transactionDate': czas, 'carNumber': tablica, 'cardNumber': karta, 'sum': brutto, 'country': kraj,
+        'currency': waluta, 'volume': ilosc, 'service': usluga, 'category': 'Fuel' if usluga in ('Diesel', 'AdBlue') else 'Other',
+    }
+
+def uruchom_serwer_testowy_api(liczba_transakcji=100000, poczatek='2025-01-01', odstep_s=60, port=0):
+    """
+    Startuje w tle serwer HTTP z API Eurowag (/eurowag/transactions) i E100 (/e100/transactions).
+    Zwraca (serwer, adres bazowy). Zwiększenie serwer.liczba_transakcji symuluje nowe transakcje;
+    serwer.zapytania liczy obsłużone strony. `since` bez strefy jest czytane jako UTC.
+    """
+    poczatek = pd.Timestamp(poczatek, tz='UTC')
+    zrodla = {nazwa.lower(): nazwa for nazwa in a.KONEKTORY_API}
+
+    class ObslugaApi(BaseHTTPRequestHandler):
+        def do_GET(self):
+            adres = urlparse(self.path)
+            czesci = adres.path.strip('/').split('/', 1)
+            zrodlo = zrodla.get(czesci[0])
+            if zrodlo is None or '/' + czesci[-1] != a.KONEKTORY_API[zrodlo]['sciezka']:
+                self.send_error(404)
+                return
+            params = parse_qs(adres.query)
+            limit = int(params.get('limit', [a.ROZMIAR_STRONY_API])[0])
+            if 'cursor' in params:
+                nr = int(params['cursor'][0])
+            elif 'since' in params:
+                od = pd.Timestamp(params['since'][0])
+                od = od.tz_localize('UTC') if od.tzinfo is None else od
+                nr = max(0, math.ceil((od - poczatek).total_seconds() / odstep_s))
+            else:
+                nr = 0
+            koniec = min(nr + limit, serwer.liczba_transakcji)
+            items = [rekord_testowy_api(zrodlo, i, czas_testowy_api(poczatek, i, odstep_s)) for i in range(nr, koniec)]
+            tresc = json.dumps({'items': items, 'next_cursor': str(koniec) if koniec < serwer.liczba_transakcji else None}).encode('utf-8')
+            serwer.zapytania += 1
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(tresc)))
+            self.end_headers()
+            self.wfile.write(tresc)
+
+        def log_message(self, format, *args):
+            pass
+
+    serwer = ThreadingHTTPServer(('127.0.0.1', port), ObslugaApi)
+    serwer.liczba_transakcji = liczba_transakcji
+    serwer.zapytania = 0
+    serwer.poczatek = poczatek
+    serwer.odstep_s = odstep_s
+    threading.Thread(target=serwer.serve_forever, daemon=True).start()
+    return serwer, f"http://127.0.0.1:{serwer.server_port}"
+
+def pomiar_konektora_api(zrodlo, firma_tag, liczba_transakcji=20000, nowe_transakcje=1500, rozmiar_strony=a.ROZMIAR_STRONY_API):
+    """
+    Pełne pobranie z lokalnego serwera, potem przyrostowe od znaku wodnego po dopisaniu
+    `nowe_transakcje`. Nic nie trafia do bazy. Zwraca tabelę z liczbami rekordów i przepustowością.
+    """
+    serwer, adres = uruchom_serwer_testowy_api(liczba_transakcji)
+    url = f"{adres}/{zrodlo.lower()}{a.KONEKTORY_API[zrodlo]['sciezka']}"
+    wyniki = []
+    znak_wodny = None
+    try:
+        for etap in ('pełna', 'przyrostowa'):
+            zapytania_przed = serwer.zapytania
+            start = time.time()
+            pobrane, rekordy = 0, 0
+            for liczba, df, czas_max in a.pobierz_transakcje_api(zrodlo, url, None, firma_tag, znak_wodny, rozmiar_strony):
+                pobrane += liczba
+                rekordy += len(df)
+                znak_wodny = a.nowszy_znak_wodny(znak_wodny, czas_max)
+            czas_s = time.time() - start
+            wyniki.append({
+                'Synchronizacja': etap, 'Strony': serwer.zapytania - zapytania_przed, 'Pobrane': pobrane,
+                'Po normalizacji': rekordy, 'Znak wodny': znak_wodny, 'Czas [s]': round(czas_s, 2),
+                'Rekordów/s': round(pobrane / czas_s) if czas_s else 0,
+            })
+            serwer.liczba_transakcji += nowe_transakcje
+    finally:
+        serwer.shutdown()
+        serwer.server_close()
+    return pd.DataFrame(wyniki)
+
+if __name__ == '__main__':
+    zrodlo = sys.argv[1] if len(sys.argv) > 1 else 'Eurowag'
+    firma = sys.argv[2] if len(sys.argv) > 2 else 'HOLIER'
+    liczba = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+    print(pomiar_konektora_api(zrodlo, firma, liczba).to_string(index=False))
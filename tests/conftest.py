@@ -0,0 +1,5 @@
+import os
+import sys
+
+# analizator.py leży w katalogu głównym repozytorium (poza pakietem)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
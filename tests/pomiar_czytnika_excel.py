@@ -0,0 +1,50 @@
+"""
+Pomiar czytnika Excela: pd.read_excel (openpyxl) vs wczytaj_arkusz na tym samym arkuszu.
+
+Z wiersza poleceń (z katalogu repozytorium):
+    python -m tests.pomiar_czytnika_excel plik.xlsx [arkusz] [naglowek]
+naglowek: numer wiersza (domyślnie 0), 'brak' (płace) albo lista wierszy, np. '7,8' (Subiekt).
+"""
+import io
+import sys
+import time
+
+import pandas as pd
+
+import analizator as a
+
+def porownaj_czytniki_excel(plik_bytes, arkusz=0, header=0, powtorzenia=3):
+    """Najlepsze czasy obu czytników, liczba wierszy i zgodność wyników."""
+    czasy = {'pd.read_excel': [], 'wczytaj_arkusz': []}
+    for _ in range(powtorzenia):
+        start = time.perf_counter()
+        df_pandas = pd.read_excel(io.BytesIO(plik_bytes), sheet_name=arkusz, header=header, engine='openpyxl')
+        czasy['pd.read_excel'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        df_nowy = a.wczytaj_arkusz(plik_bytes, arkusz, header=header)
+        czasy['wczytaj_arkusz'].append(time.perf_counter() - start)
+    try:
+        pd.testing.assert_frame_equal(df_nowy, df_pandas, check_column_type=False, check_index_type=False)
+        zgodne = True
+    except AssertionError:
+        zgodne = False
+    najlepsze = {nazwa: min(t) for nazwa, t in czasy.items()}
+    return najlepsze, len(df_pandas), zgodne
+
+def naglowek_z_argumentu(tekst):
+    if tekst == 'brak':
+        return None
+    if ',' in tekst:
+        return [int(w) for w in tekst.split(',')]
+    return int(tekst)
+
+if __name__ == '__main__':
+    with open(sys.argv[1], 'rb') as f:
+        plik_bytes = f.read()
+    arkusz = sys.argv[2] if len(sys.argv) > 2 else 0
+    naglowek = naglowek_z_argumentu(sys.argv[3]) if len(sys.argv) > 3 else 0
+    czasy, liczba_wierszy, zgodne = porownaj_czytniki_excel(plik_bytes, arkusz, naglowek)
+    for nazwa, czas in czasy.items():
+        print(f"{nazwa:>15}: {czas:.3f} s")
+    print(f"{'Wierszy':>15}: {liczba_wierszy:,}")
+    print(f"{'Zgodne':>15}: {'tak' if zgodne else 'NIE - zgłoś plik do sprawdzenia'}")
@@ -0,0 +1,97 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import analizator as a
+
+
+def kategoryzuj_wierszowo(row, zrodlo):
+    """Dawna kategoryzacja wiersz po wierszu (sprzed kategoryzuj_ramke) - wzorzec do porównania."""
+    usluga = ""
+    artykul = ""
+    full_text = ""
+
+    if zrodlo == 'Eurowag':
+        usluga = str(row.get('Usługa', '')).upper()
+        artykul = str(row.get('Artykuł', '')).strip().upper()
+        produkt = str(row.get('Produkt', '')).strip().upper() if 'Produkt' in row else ""
+        full_text = (usluga + " " + artykul + " " + produkt).upper()
+    elif zrodlo == 'E100_PL':
+        usluga = str(row.get('Usługa', '')).strip().upper()
+        kategoria = str(row.get('Kategoria', '')).strip().upper()
+        brand = str(row.get('Brand', '')).strip().upper()
+        full_text = (usluga + " " + kategoria + " " + brand).upper()
+        artykul = kategoria if kategoria else usluga
+    elif zrodlo == 'E100_EN':
+        usluga = str(row.get('Service', '')).strip().upper()
+        artykul = str(row.get('Category', '')).strip().upper()
+        full_text = (usluga + " " + artykul).upper()
+    elif zrodlo == 'Fakturownia':
+        return 'PRZYCHÓD', 'Usługa transportowa'
+
+    if 'TOLL' in full_text or 'OPŁATA DROGOWA' in full_text or 'VIATOLL' in full_text or 'E-TOLL' in full_text or 'DROGOWE' in full_text:
+        return 'OPŁATA', usluga if usluga else 'Opłata drogowa'
+    if any(k in full_text for k in ['LPG', 'AUTOGAZ', 'GAZ PŁYNNY', 'GPL', 'PROPANE', 'BUTANE']):
+        return 'PALIWO', 'LPG'
+    if any(k in full_text for k in ['BENZYNA', 'GASOLINE', 'PETROL', 'MOGAS', 'EUROSUPER', 'SUPER 95', 'SUPER 98', 'NATURAL 95', 'UNLEADED', 'PB95', 'PB98', ' E5 ', ' E10 ']):
+        return 'PALIWO', 'Benzyna'
+    if 'PB ' in full_text or ' PB' in full_text:
+        return 'PALIWO', 'Benzyna'
+    if 'ADBLUE' in full_text or 'AD BLUE' in full_text:
+        return 'PALIWO', 'AdBlue'
+    if 'DIESEL' in full_text or 'OLEJ NAPĘDOWY' in full_text:
+        return 'PALIWO', 'Diesel'
+    if ' ON ' in (" " + full_text + " "):
+        return 'PALIWO', 'Diesel'
+    if 'OPENLOOP' in full_text or 'VISA' in full_text or 'MYJNIA' in full_text or 'WASH' in full_text or 'PARKING' in full_text:
+        return 'INNE', 'Płatność kartą/Inne'
+    if 'POWER MAX' in full_text or 'ECTO' in full_text:
+        return 'PALIWO', 'Diesel'
+    return 'INNE', usluga.title() if usluga else "Inne"
+
+
+# Teksty trafiające w każdą regułę, granice słów (ON, PB, E5) i braki danych (czytniki dają NaN, nie None)
+TEKSTY = [
+    'Diesel', ' olej napędowy ', 'ON', 'on ', 'BONUS', 'LPG', 'Autogaz', 'PB95', 'pb 98', 'Super 95', ' e5 ',
+    'AdBlue', 'ad blue', 'Toll', 'e-toll PL', 'Opłata drogowa', 'Myjnia', 'Parking', 'VISA openloop',
+    'Power Max', 'ECTO Plus', 'Kawa', 'ŁOŻYSKO', '', '  ', np.nan, 12.5,
+]
+
+
+def ramka_testowa(kolumny, liczba_wierszy=400, ziarno=0):
+    rng = np.random.default_rng(ziarno)
+    dane = {kol: [TEKSTY[i] for i in rng.integers(0, len(TEKSTY), liczba_wierszy)] for kol in kolumny}
+    return pd.DataFrame(dane, dtype=object)
+
+
+@pytest.mark.parametrize("zrodlo", ['Eurowag', 'E100_PL', 'E100_EN', 'Fakturownia'])
+def test_kategoryzuj_ramke_jak_wiersz_po_wierszu(zrodlo):
+    kolumny = [kol for kol, _ in a.KOLUMNY_KATEGORYZACJI.get(zrodlo, (('Produkt/usługa', False),))]
+    df = ramka_testowa(kolumny)
+    typ, produkt = a.kategoryzuj_ramke(df, zrodlo)
+
+    oczekiwane = [kategoryzuj_wierszowo(wiersz, zrodlo) for _, wiersz in df.iterrows()]
+    assert list(zip(typ, produkt)) == oczekiwane
+    assert typ.index.equals(df.index)
+
+
+def test_kategoryzuj_ramke_bez_kolumny_produkt():
+    # Eksport Eurowag bez kolumny Produkt - tak jak w dawnym `'Produkt' in row`
+    df = ramka_testowa(['Usługa', 'Artykuł'], ziarno=1)
+    typ, produkt = a.kategoryzuj_ramke(df, 'Eurowag')
+    oczekiwane = [kategoryzuj_wierszowo(wiersz, 'Eurowag') for _, wiersz in df.iterrows()]
+    assert list(zip(typ, produkt)) == oczekiwane
+
+
+def test_kategoryzuj_ramke_wszystkie_pary_tekstow():
+    df = pd.DataFrame(list(itertools.product(TEKSTY, TEKSTY)), columns=['Service', 'Category'], dtype=object)
+    typ, produkt = a.kategoryzuj_ramke(df, 'E100_EN')
+    oczekiwane = [kategoryzuj_wierszowo(wiersz, 'E100_EN') for _, wiersz in df.iterrows()]
+    assert list(zip(typ, produkt)) == oczekiwane
+
+
+def test_kategoryzuj_ramke_pusta_ramka():
+    typ, produkt = a.kategoryzuj_ramke(pd.DataFrame(columns=['Usługa', 'Kategoria', 'Brand']), 'E100_PL')
+    assert typ.empty and produkt.empty
@@ -0,0 +1,76 @@
+import pandas as pd
+import pytest
+
+import analizator as a
+from api_testowe import czas_testowy_api, uruchom_serwer_testowy_api
+
+# Start tuż przed zmianą czasu (30.03.2025), żeby strony miały rekordy z przesunięciem +01:00 i +02:00
+POCZATEK = '2025-03-29 20:00'
+ODSTEP_S = 60
+PELNA = 3000
+NOWE = 700
+
+
+class BazaTestowa:
+    """Ustawienia i transakcje w pamięci zamiast PostgreSQL; dubel klucza naturalnego odpada jak w ON CONFLICT."""
+
+    def __init__(self):
+        self.ustawienia = {}
+        self.transakcje = {}
+
+    def zapisz_nowe_wiersze(self, conn, df):
+        dodane = 0
+        for row_hash, (_, wiersz) in zip(a.oblicz_hashe_wierszy(df), df.iterrows()):
+            if row_hash not in self.transakcje:
+                self.transakcje[row_hash] = wiersz
+                dodane += 1
+        return dodane, 0.0
+
+
+@pytest.fixture
+def serwer():
+    serwer, adres = uruchom_serwer_testowy_api(PELNA, POCZATEK, ODSTEP_S)
+    yield serwer, adres
+    serwer.shutdown()
+    serwer.server_close()
+
+
+@pytest.fixture
+def baza(monkeypatch, serwer):
+    _, adres = serwer
+    baza = BazaTestowa()
+    monkeypatch.setattr(a, 'pobierz_konfiguracje_konektora', lambda conn, zrodlo: (f"{adres}/{zrodlo.lower()}", None))
+    monkeypatch.setattr(a, 'zapewnij_schemat_ingestu', lambda conn: None)
+    monkeypatch.setattr(a, 'pobierz_ustawienie', lambda conn, klucz: baza.ustawienia.get(klucz))
+    monkeypatch.setattr(a, 'zapisz_ustawienie', lambda conn, klucz, wartosc: baza.ustawienia.__setitem__(klucz, wartosc))
+    monkeypatch.setattr(a, 'zapisz_nowe_wiersze', baza.zapisz_nowe_wiersze)
+    return baza
+
+
+@pytest.mark.parametrize('zrodlo', list(a.KONEKTORY_API))
+def test_synchronizacja_pelna_i_przyrostowa(serwer, baza, zrodlo):
+    serwer, _ = serwer
+    poczatek = pd.Timestamp(POCZATEK, tz='UTC')
+
+    pobrane, zapisane, znak_wodny, _ = a.synchronizuj_api(None, zrodlo, 'HOLIER')
+    assert (pobrane, zapisane) == (PELNA, PELNA)
+    assert znak_wodny == czas_testowy_api(poczatek, PELNA - 1, ODSTEP_S)
+    # Znak wodny zapisany ze strefą - z powrotem do API idzie ta sama chwila, nie czas lokalny
+    zapisany = pd.Timestamp(baza.ustawienia[a.klucz_znaku_wodnego(zrodlo, 'HOLIER')])
+    assert zapisany.tzinfo is not None and zapisany == znak_wodny
+
+    serwer.liczba_transakcji += NOWE
+    zapytania_przed = serwer.zapytania
+    pobrane, zapisane, znak_wodny, _ = a.synchronizuj_api(None, zrodlo, 'HOLIER')
+    # Przyrostowo: tylko nowe rekordy i jeden z granicy (since włącznie), żaden nie przepada
+    assert (pobrane, zapisane) == (NOWE + 1, NOWE)
+    assert serwer.zapytania - zapytania_przed == 1
+    assert znak_wodny == czas_testowy_api(poczatek, PELNA + NOWE - 1, ODSTEP_S)
+    assert len(baza.transakcje) == PELNA + NOWE
+
+    # Zapisana data transakcji to czas lokalny bez strefy
+    daty = pd.Series([w['data_transakcji'] for w in baza.transakcje.values()]).sort_values()
+    lokalne = [czas_testowy_api(poczatek, nr, ODSTEP_S).tz_convert('Europe/Warsaw').tz_localize(None)
+               for nr in range(PELNA + NOWE)]
+    assert daty.dt.tz is None
+    assert daty.tolist() == lokalne
@@ -0,0 +1,89 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import analizator as a
+
+POJAZDY = ['WGM8463A', 'WPR9335N', 'XYZ12345', None]
+KLUCZ = a.KOLUMNY_KLUCZA_DZIENNEGO + ['po_starcie_floty']
+
+
+@pytest.fixture
+def dzienne():
+    """Syntetyczne zestawienie dzienne (jeden wiersz na dzień i grupę), z pojazdami floty UNIX i bez pojazdu."""
+    rng = np.random.default_rng(0)
+    n = 5000
+    df = pd.DataFrame({
+        'dzien': (pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 400, n), unit='D')).date,
+        'firma': rng.choice(['HOLIER', 'UNIX-TRANS'], n),
+        'identyfikator_clean': rng.choice(np.array(POJAZDY, dtype=object), n),
+        'typ': rng.choice(['PALIWO', 'OPŁATA'], n),
+        'waluta': rng.choice(['PLN', 'EUR'], n),
+        'zrodlo': rng.choice(['Eurowag', 'E100_PL'], n),
+        'kwota_netto': rng.random(n) * 100,
+        'kwota_brutto': rng.random(n) * 123,
+        'ilosc': rng.random(n) * 50,
+        'liczba': rng.integers(1, 5, n),
+    })
+    return df.groupby(['dzien'] + a.KOLUMNY_KLUCZA_DZIENNEGO, as_index=False, dropna=False).sum()
+
+
+def sumy_groupby(dzienne, data_start, data_stop):
+    """Te same sumy wprost: filtr dat i groupby, flaga startu floty z UNIX_FLOTA_CONFIG."""
+    dni = pd.to_datetime(dzienne['dzien'])
+    df = dzienne[(dni >= pd.Timestamp(data_start)) & (dni <= pd.Timestamp(data_stop))].copy()
+    start_floty = pd.to_datetime(a.klucz_pojazdu_floty(df['identyfikator_clean']).map(a.UNIX_FLOTA_CONFIG))
+    df['po_starcie_floty'] = (pd.to_datetime(df['dzien']) >= start_floty).to_numpy()
+    return df.groupby(KLUCZ, dropna=False)[a.MIARY_KOSTKI].sum().reset_index()
+
+
+def porownaj(wynik, oczekiwane):
+    wynik = wynik.sort_values(KLUCZ, na_position='first').reset_index(drop=True)
+    oczekiwane = oczekiwane.sort_values(KLUCZ, na_position='first').reset_index(drop=True)
+    assert len(wynik) == len(oczekiwane)
+    for kol in KLUCZ:
+        assert wynik[kol].astype(object).fillna('-').tolist() == oczekiwane[kol].astype(object).fillna('-').tolist()
+    for miara in a.MIARY_KOSTKI:
+        np.testing.assert_allclose(wynik[miara].to_numpy(dtype=float), oczekiwane[miara].to_numpy(dtype=float))
+
+
+@pytest.mark.parametrize("data_start, data_stop", [
+    (date(2025, 1, 1), date(2026, 2, 4)),    # cały zakres danych
+    (date(2025, 3, 15), date(2025, 3, 15)),  # jeden dzień
+    (date(2025, 9, 20), date(2025, 10, 31)), # przez start floty (8.10 i 7.10)
+    (date(2024, 6, 1), date(2025, 2, 10)),   # początek przed danymi
+    (date(2025, 12, 1), date(2027, 1, 1)),   # koniec po danych
+])
+def test_sumy_z_kostki_jak_groupby(dzienne, data_start, data_stop):
+    kostka = a.zbuduj_kostke(dzienne)
+    porownaj(a.sumy_z_kostki(kostka, data_start, data_stop), sumy_groupby(dzienne, data_start, data_stop))
+
+
+def test_sumy_z_kostki_w_oknie(dzienne):
+    # Kostka z ograniczoną osią dni (jak w pobierz_kostke_kosztow) - zakresy wewnątrz okna liczone tak samo
+    dzien0, liczba_dni = pd.Timestamp('2025-06-01'), 120
+    dni = pd.to_datetime(dzienne['dzien'])
+    w_oknie = dzienne[(dni >= dzien0) & (dni < dzien0 + pd.Timedelta(days=liczba_dni))]
+    kostka = a.zbuduj_kostke(w_oknie, dzien0, liczba_dni)
+    assert kostka[2]['liczba'].shape[1] == liczba_dni + 1
+    porownaj(a.sumy_z_kostki(kostka, date(2025, 7, 3), date(2025, 9, 1)), sumy_groupby(dzienne, date(2025, 7, 3), date(2025, 9, 1)))
+
+
+def test_sumy_z_kostki_bez_danych():
+    assert a.zbuduj_kostke(pd.DataFrame(columns=['dzien'] + a.KOLUMNY_KLUCZA_DZIENNEGO + a.MIARY_KOSTKI)) is None
+    assert a.sumy_z_kostki(None, date(2025, 1, 1), date(2025, 1, 31)).empty
+
+
+def test_sumy_okresu_poza_oknem_z_agregatow(monkeypatch):
+    dzien0, liczba_dni = a.okno_kostki()
+    wywolania = []
+    monkeypatch.setattr(a, 'pobierz_kostke_kosztow', lambda conn, firma: wywolania.append('kostka'))
+    monkeypatch.setattr(a, 'sumy_z_kostki', lambda kostka, od, do: pd.DataFrame())
+    monkeypatch.setattr(a, 'pobierz_agregaty_raportu', lambda conn, od, do, firma: wywolania.append('sql') or pd.DataFrame())
+
+    a.sumy_okresu(None, 'HOLIER', dzien0.date(), date.today())
+    a.sumy_okresu(None, 'HOLIER', (dzien0 - pd.Timedelta(days=1)).date(), date.today())
+    a.sumy_okresu(None, 'HOLIER', date.today(), (dzien0 + pd.Timedelta(days=liczba_dni)).date())
+    assert wywolania == ['kostka', 'sql', 'sql']
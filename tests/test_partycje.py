@@ -0,0 +1,86 @@
+import re
+
+import pandas as pd
+import pytest
+
+import analizator as a
+
+
+class SesjaTestowa:
+    """conn.session zapisujące wykonane SQL; lista partycji z `istniejace`."""
+
+    def __init__(self, istniejace):
+        self.istniejace = istniejace
+        self.polecenia = []
+        self.zatwierdzone = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, polecenie, params=None):
+        sql = " ".join(str(polecenie).split())
+        self.polecenia.append(sql)
+        if 'pg_inherits' in sql:
+            return [(nazwa,) for nazwa in self.istniejace]
+        return []
+
+    def commit(self):
+        self.zatwierdzone = True
+
+
+class PolaczenieTestowe:
+    def __init__(self, istniejace=()):
+        self.session = SesjaTestowa(list(istniejace))
+
+
+def test_nazwa_partycji():
+    assert a.nazwa_partycji(pd.Timestamp('2025-03-01')) == 'transactions_2025_03'
+    assert a.nazwa_partycji(pd.Timestamp('2025-12-01')) == 'transactions_2025_12'
+
+
+@pytest.mark.parametrize("miesiac, od, do", [
+    ('2025-03-01', '2025-03-01', '2025-04-01'),
+    ('2025-12-01', '2025-12-01', '2026-01-01'),
+    ('2024-02-01', '2024-02-01', '2024-03-01'),
+])
+def test_sql_partycji_miesiaca(miesiac, od, do):
+    sql = " ".join(a.sql_partycji_miesiaca(pd.Timestamp(miesiac)).split())
+    nazwa = a.nazwa_partycji(pd.Timestamp(miesiac))
+    assert sql == (f"CREATE TABLE IF NOT EXISTS public.{nazwa} PARTITION OF public.transactions "
+                   f"FOR VALUES FROM ('{od}') TO ('{do}')")
+
+
+def test_brakujace_partycje():
+    daty = pd.Series(pd.to_datetime(['2025-03-31 23:59', '2025-01-15 08:00', pd.NaT, '2025-03-01 00:00', '2024-12-31 12:00']))
+    istniejace = {'transactions_2025_01', 'transactions_default'}
+    assert a.brakujace_partycje(daty, istniejace) == [pd.Timestamp('2024-12-01'), pd.Timestamp('2025-03-01')]
+    assert a.brakujace_partycje(daty.iloc[[1]], istniejace) == []
+    assert a.brakujace_partycje(pd.Series([], dtype='datetime64[ns]'), set()) == []
+
+
+def test_zapewnij_partycje_bez_brakujacych_nie_blokuje():
+    conn = PolaczenieTestowe(['transactions_2025_01', 'transactions_default'])
+    a.zapewnij_partycje(conn, pd.Series(pd.to_datetime(['2025-01-02', '2025-01-30'])))
+    assert len(conn.session.polecenia) == 1
+    assert not conn.session.zatwierdzone
+
+
+def test_zapewnij_partycje_blokada_przed_create():
+    conn = PolaczenieTestowe(['transactions_2025_01'])
+    a.zapewnij_partycje(conn, pd.Series(pd.to_datetime(['2025-01-02', '2025-02-10', '2025-04-01'])))
+    polecenia = conn.session.polecenia
+    assert 'pg_advisory_xact_lock' in polecenia[1]
+    utworzone = [re.search(r'public\.(\w+) PARTITION OF', p).group(1) for p in polecenia[2:]]
+    assert utworzone == ['transactions_2025_02', 'transactions_2025_04']
+    assert conn.session.zatwierdzone
+
+
+def test_migracje_numerowane_po_kolei():
+    numery = [numer for numer, _, _ in a.MIGRACJE]
+    nazwy = [nazwa for _, nazwa, _ in a.MIGRACJE]
+    assert numery == list(range(1, len(a.MIGRACJE) + 1))
+    assert len(set(nazwy)) == len(nazwy)
+    assert all(callable(migracja) for _, _, migracja in a.MIGRACJE)
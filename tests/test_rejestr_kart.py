@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import analizator as a
+
+
+@pytest.fixture(autouse=True)
+def domyslny_rejestr(monkeypatch):
+    monkeypatch.setattr(a, 'REJESTR_KART', a.przygotuj_rejestr_kart(a.DOMYSLNE_KARTY))
+
+
+def ramka_e100_pl(numery_kart, numery_aut):
+    n = len(numery_kart)
+    return pd.DataFrame({
+        'Data': ['05.03.2025'] * n, 'Czas': ['10:00:00'] * n,
+        'Numer samochodu': numery_aut, 'Numer karty': numery_kart,
+        'Kwota': ['100.0'] * n, 'Kraj': ['PL'] * n, 'Waluta': ['PLN'] * n, 'Ilość': ['50'] * n,
+        'Usługa': ['Diesel'] * n, 'Kategoria': [''] * n, 'Brand': [''] * n,
+    })
+
+
+def identyfikatory_dawnymi_regulami(df):
+    """Dawne reguły z normalizuj_e100_PL: końcówka karty 24 -> WGM8463A, 40 -> KACPER (nadpisują numer auta)."""
+    identyfikator = df['Numer samochodu'].fillna(df['Numer karty'])
+    numer_karty_str = df['Numer karty'].astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
+    identyfikator[numer_karty_str.str.endswith('24')] = 'WGM8463A'
+    identyfikator[numer_karty_str.str.endswith('40')] = 'KACPER'
+    return identyfikator
+
+
+def test_domyslne_karty_jak_dawne_reguly_e100_pl():
+    numery_kart = pd.Series(['7000123424', 7000123440.0, '7000123455', ' 7000123424 ', np.nan, '240', '7000123440'], dtype=object)
+    numery_aut = pd.Series(['WPR1111A', np.nan, 'WPR2222B', np.nan, 'WPR3333C', 'WPR4444D', 'WPR5555E'], dtype=object)
+    df = ramka_e100_pl(numery_kart, numery_aut)
+
+    wynik = a.normalizuj_wg_formatu(df.copy(), 'E100_PL', 'HOLIER')
+    assert wynik['identyfikator'].tolist() == identyfikatory_dawnymi_regulami(df).tolist()
+    assert wynik['identyfikator'].tolist()[:3] == ['WGM8463A', 'KACPER', 'WPR2222B']
+
+
+def test_domyslne_karty_tylko_dla_e100_pl():
+    identyfikatory = pd.Series(['AUTO1', 'AUTO2'])
+    numery = pd.Series(['7000123424', '7000123440'])
+    daty = pd.Series(pd.to_datetime(['2025-03-05', '2025-03-05']))
+    assert a.przypisz_pojazdy_z_kart(identyfikatory, numery, daty, 'E100_EN').tolist() == ['AUTO1', 'AUTO2']
+    assert a.przypisz_pojazdy_z_kart(identyfikatory, numery, daty, 'E100_PL').tolist() == ['WGM8463A', 'KACPER']
+
+
+def test_rejestr_okres_waznosci_i_dluzszy_numer():
+    karty = a.przygotuj_rejestr_kart([
+        {'card_number': '24', 'vehicle': 'KROTKI', 'source': None, 'valid_from': None, 'valid_to': None},
+        {'card_number': '3424', 'vehicle': 'DLUGI', 'source': None, 'valid_from': '2025-03-01', 'valid_to': '2025-03-31'},
+    ])
+    identyfikatory = pd.Series(['A', 'B', 'C', 'D'], index=[10, 11, 12, 13])
+    numery = pd.Series(['7000123424', '7000123424', '7000123424', '7000123455'])
+    daty = pd.Series(pd.to_datetime(['2025-03-31 23:59', '2025-04-01 00:00', '2025-02-28 12:00', '2025-03-05 12:00']))
+
+    wynik = a.przypisz_pojazdy_z_kart(identyfikatory, numery, daty, 'Eurowag', karty=karty)
+    # valid_to obejmuje cały ostatni dzień; poza okresem działa krótszy numer bez ograniczeń
+    assert wynik.tolist() == ['DLUGI', 'KROTKI', 'KROTKI', 'D']
+    assert wynik.index.tolist() == [10, 11, 12, 13]
@@ -0,0 +1,79 @@
+import io
+
+import openpyxl
+import pytest
+
+import analizator as a
+
+NAGLOWEK_FAKTUROWNI = ['Numer', 'Data wystawienia', 'Sprzedający', 'Nabywca', 'Wartość netto', 'Wartość brutto']
+
+
+def plik_csv(naglowek, separator, kodowanie, wiersze=3):
+    linie = [separator.join(naglowek)]
+    linie += [separator.join(['FV/1/2025', '2025-03-05', 'Holier', 'Żółć Sp. z o.o.', '100,00', '123,00'])] * wiersze
+    return "\n".join(linie).encode(kodowanie)
+
+
+def plik_xlsx(arkusze):
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    for nazwa, naglowek in arkusze.items():
+        ws = wb.create_sheet(nazwa)
+        if naglowek:
+            ws.append(naglowek)
+    bufor = io.BytesIO()
+    wb.save(bufor)
+    return bufor.getvalue()
+
+
+@pytest.mark.parametrize("separator", [',', ';', '\t'])
+@pytest.mark.parametrize("kodowanie", ['utf-8-sig', 'cp1250'])
+def test_rozpoznaj_csv_separator_i_kodowanie(separator, kodowanie):
+    format_pliku, enc, sep, kolumny = a.rozpoznaj_csv(plik_csv(NAGLOWEK_FAKTUROWNI, separator, kodowanie), ucieta=False)
+    assert (format_pliku, enc, sep) == ('Fakturownia', kodowanie, separator)
+    assert kolumny == NAGLOWEK_FAKTUROWNI
+
+
+def test_rozpoznaj_csv_proba_przecina_znak_wielobajtowy():
+    # Próbka ucięta w połowie "ć" (2 bajty w UTF-8) - to nadal UTF-8, nie cp1250
+    plik = plik_csv(NAGLOWEK_FAKTUROWNI, ';', 'utf-8-sig')
+    koniec = plik.rindex('ć'.encode('utf-8')) + 1
+    format_pliku, enc, sep, _ = a.rozpoznaj_csv(plik[:koniec], ucieta=True)
+    assert (format_pliku, enc, sep) == ('Fakturownia', 'utf-8-sig', ';')
+    assert a.rozpoznaj_csv(plik[:koniec], ucieta=False)[1] == 'cp1250'
+
+
+def test_rozpoznaj_csv_nieznany_naglowek():
+    format_pliku, _, sep, kolumny = a.rozpoznaj_csv("a;b;c\n1;2;3\n".encode('utf-8'), ucieta=False)
+    assert format_pliku is None
+    assert (sep, kolumny) == (';', ['a', 'b', 'c'])
+
+
+def test_rozpoznaj_plik_csv():
+    profil = a.rozpoznaj_plik(plik_csv(NAGLOWEK_FAKTUROWNI, ';', 'cp1250', wiersze=5000))
+    assert profil == {'format': 'Fakturownia', 'typ_pliku': 'csv', 'kodowanie': 'cp1250', 'separator': ';',
+                      'kolumny': NAGLOWEK_FAKTUROWNI}
+
+
+@pytest.mark.parametrize("arkusze, oczekiwane", [
+    ({'Transactions': ['Data', 'Czas', 'Numer samochodu', 'Numer karty', 'Kwota']}, ('E100_PL', 'Transactions')),
+    ({'Info': ['x'], 'Transactions': ['Date', 'Car registration number', 'Sum']}, ('E100_EN', 'Transactions')),
+    ({'Arkusz1': ['Data i godzina', 'Posiadacz karty', 'Usługa']}, ('Eurowag', 'Arkusz1')),
+    ({'Arkusz1': ['Numer', 'Sprzedający', 'Nabywca']}, ('Fakturownia', 'Arkusz1')),
+    ({'raport': None, 'pojazdy': ['Kontrahent']}, ('Subiekt', 'pojazdy')),
+    ({'Arkusz1': ['a', 'b']}, (None, 'Arkusz1')),
+])
+def test_rozpoznaj_plik_excel(arkusze, oczekiwane):
+    profil = a.rozpoznaj_plik(plik_xlsx(arkusze))
+    assert profil['typ_pliku'] == 'excel'
+    assert (profil['format'], profil['arkusz']) == oczekiwane
+
+
+def test_rozpoznaj_plik_excel_nazwy_kolumn_jak_read_excel():
+    profil = a.rozpoznaj_plik(plik_xlsx({'Arkusz1': ['Data i godzina', None, 'Artykuł', 'Artykuł']}))
+    assert profil['kolumny'] == ['Data i godzina', 'Unnamed: 1', 'Artykuł', 'Artykuł.1']
+
+
+def test_rozpoznaj_plik_uszkodzony_excel():
+    profil = a.rozpoznaj_plik(b'PK\x03\x04' + b'\x00' * 100)
+    assert profil == {'format': None, 'typ_pliku': 'excel', 'arkusz': None, 'kolumny': []}